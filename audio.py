@@ -0,0 +1,193 @@
+# Zen Tetris audio mixer - sound effects started off the game loop
+# Test the mixer without audio: python audio.py
+
+import argparse
+import queue
+import threading
+import time
+
+MAX_VOICES = 4  # effects sounding at the same time
+COOLDOWN = 0.05  # default sec before the same effect can start again
+QUEUE_SIZE = 64  # play requests waiting for the worker
+
+
+class ArcadeBackend():
+    """Plays arcade.Sound objects (loaded with arcade.load_sound(), so
+    they are decoded in memory)"""
+    def length(self, sound):
+        return sound.get_length()
+
+    def play(self, sound, volume):
+        sound.play(volume)
+
+
+class NullBackend():
+    """Plays nothing and records the schedule instead
+
+    played is [(time, sound, volume)] in the order they would start;
+    sounds are anything (e.g. names), lengths gives their length in sec."""
+    def __init__(self, lengths=None, default_length=0.5,
+                 clock=time.perf_counter):
+        self.lengths = lengths or {}
+        self.default_length = default_length
+        self.clock = clock
+        self.played = []
+
+    def length(self, sound):
+        return self.lengths.get(sound, self.default_length)
+
+    def play(self, sound, volume):
+        self.played.append((self.clock(), sound, volume))
+
+
+class Mixer():
+    """Plays sound effects from a worker thread
+
+    play(name) only queues a request, so the game loop never waits for
+    the audio system (a request that doesn't fit in the queue is
+    dropped).  The worker starts effects in the order requested, except
+    that:
+
+    * an effect is skipped if the same one started less than its cooldown
+      ago, e.g. both players lock a shape in the same frame
+    * at most max_voices effects sound at the same time; a request over
+      the cap is dropped
+
+    With threaded=False there is no worker; call pump() to start what is
+    queued (tests)."""
+    def __init__(self, backend, max_voices=MAX_VOICES, volume=1.0,
+                 clock=time.perf_counter, threaded=True):
+        self.backend = backend
+        self.max_voices = max_voices
+        self.volume = volume
+        self.clock = clock
+        self.sounds = {}  # name -> (sound, length, cooldown)
+        self.requests = queue.Queue(QUEUE_SIZE)
+        self.last_start = {}  # name -> time the effect last started
+        self.voice_ends = []  # end times of effects sounding
+        self.played = 0
+        self.skipped = 0  # within the cooldown
+        self.dropped = 0  # over the voice cap or the queue size
+        self.max_latency = 0.0  # sec from play() to the start
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def add(self, name, sound, cooldown=COOLDOWN):
+        """Register a loaded sound as effect name"""
+        self.sounds[name] = (sound, self.backend.length(sound), cooldown)
+
+    def play(self, name):
+        """Queue effect name to start as soon as possible"""
+        if name not in self.sounds:
+            return
+        try:
+            self.requests.put_nowait((name, self.clock()))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            self.start(*request)
+
+    def pump(self):
+        """Start the queued effects now (threaded=False)"""
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                self.start(*request)
+
+    def start(self, name, request_time):
+        sound, length, cooldown = self.sounds[name]
+        now = self.clock()
+        if now - self.last_start.get(name, float("-inf")) < cooldown:
+            self.skipped += 1
+            return
+        self.voice_ends = [end for end in self.voice_ends if end > now]
+        if len(self.voice_ends) >= self.max_voices:
+            self.dropped += 1
+            return
+        self.backend.play(sound, self.volume)
+        self.last_start[name] = now
+        self.voice_ends.append(now + length)
+        self.played += 1
+        self.max_latency = max(self.max_latency, now - request_time)
+
+    def close(self):
+        """Stop the worker (queued effects are still started)"""
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def simulate(requests, max_voices=MAX_VOICES, cooldowns=None, length=0.5):
+    """Play requests [(time, name)] on a NullBackend with a simulated clock
+
+    Returns the mixer; its backend.played is the schedule."""
+    clock_time = [0.0]
+    backend = NullBackend(default_length=length,
+                          clock=lambda: clock_time[0])
+    mixer = Mixer(backend, max_voices, clock=lambda: clock_time[0],
+                  threaded=False)
+    for name in sorted({name for request_time, name in requests}):
+        mixer.add(name, name, (cooldowns or {}).get(name, COOLDOWN))
+    for request_time, name in sorted(requests):
+        clock_time[0] = request_time
+        mixer.play(name)
+        mixer.pump()
+    return mixer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Play a burst of effects on a null audio backend and "
+        "print the schedule")
+    parser.add_argument("--players", type=int, default=8,
+                        help="players locking and clearing lines in the "
+                        "same frames (default: 8)")
+    parser.add_argument("--max-voices", type=int, default=MAX_VOICES,
+                        help=f"voice cap (default: {MAX_VOICES})")
+    parser.add_argument("--threaded", action="store_true",
+                        help="use the worker thread and the real clock, "
+                        "and print the request to start latency")
+    args = parser.parse_args(argv)
+
+    frame = 1/60
+    requests = []
+    for player in range(args.players):
+        requests.append((player * frame / 4, "lock"))
+        requests.append((10 * frame, "line_clear"))
+        requests.append((11 * frame + player * frame * 4, "attacked"))
+    if args.threaded:
+        backend = NullBackend()
+        mixer = Mixer(backend, args.max_voices)
+        for name in ("lock", "line_clear", "attacked"):
+            mixer.add(name, name)
+        start_time = time.perf_counter()
+        for request_time, name in sorted(requests):
+            time.sleep(max(0.0, start_time + request_time -
+                           time.perf_counter()))
+            mixer.play(name)
+        mixer.close()
+    else:
+        mixer = simulate(requests, args.max_voices)
+        backend = mixer.backend
+        start_time = 0.0
+    for play_time, name, volume in backend.played:
+        print(f"{(play_time - start_time) * 1000:8.2f} msec  {name}")
+    print(f"{len(requests)} requests: {mixer.played} played, "
+          f"{mixer.skipped} skipped (cooldown), {mixer.dropped} dropped "
+          f"(voice cap), max latency {mixer.max_latency * 1000:.2f} msec")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
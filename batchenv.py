@@ -0,0 +1,432 @@
+# Zen Tetris batch environment - many boards stepped at once with NumPy
+# For bot research: one step places the current shape of every board,
+# with the same rules as engine.Game.  Needs numpy (not needed by the
+# game itself).
+#   python batchenv.py verify  # random, CPU and 4-player CPU games
+#   python batchenv.py bench --batch 10000
+
+import argparse
+import time
+
+import numpy as np
+
+import bot
+import engine
+from engine import PLWIDTH, PLHEIGHT, FULL_ROW, TETRIS_SHAPES
+
+FLOOR_ROWS = 4  # full rows below the game area, as engine.FLOOR
+SPAWN_X = PLWIDTH // 2 - 2  # where engine.Game spawns shapes
+SPAWN_Y = PLHEIGHT - 1
+MAX_LEVEL = len(engine.FALL_COUNTER_INIT) - 1
+RANDOM_ACTIONS = 0.03  # actions of the "bot" policy that are random
+# verify runs: (players, policy, games, placements)
+VERIFY_RUNS = [
+    (1, "random", 200, 200),  # short games, random garbage
+    (1, "bot", 20, 500),  # long games with line clears
+    (4, "bot", 40, 300),  # battles with attacks
+    ]
+
+
+def shape_tensors():
+    """Return (MASKS, PACKED_MASKS, VALID, ROTATIONS) of all shapes
+
+    MASKS[shape, shape_cnt, x+3, dy] is the row mask of line dy of the
+    shape at x (as engine.SHAPE_MASKS), PACKED_MASKS[shape, shape_cnt,
+    x+3] its 4-row mask (as engine.SHAPE_PACKED_MASKS), VALID[shape,
+    shape_cnt, x+3] False where the shape hits a side wall.
+    ROTATIONS[shape] is the num of rotations; shapes with fewer than four
+    rotations repeat them."""
+    masks = np.zeros((len(TETRIS_SHAPES), 4, PLWIDTH + 3, 4), np.uint16)
+    packed_masks = np.zeros((len(TETRIS_SHAPES), 4, PLWIDTH + 3), np.uint64)
+    valid = np.zeros((len(TETRIS_SHAPES), 4, PLWIDTH + 3), bool)
+    rotations = np.zeros(len(TETRIS_SHAPES), np.int64)
+    for shape, (color, shape_rotations) in enumerate(TETRIS_SHAPES):
+        rotations[shape] = len(shape_rotations)
+        for cnt in range(4):
+            shape_cnt = cnt % len(shape_rotations)
+            for x, rows in engine.SHAPE_MASKS[shape][shape_cnt].items():
+                valid[shape, cnt, x + 3] = True
+                packed_masks[shape, cnt, x + 3] = \
+                    engine.SHAPE_PACKED_MASKS[shape][shape_cnt][x]
+                for dy, mask in rows:
+                    masks[shape, cnt, x + 3, dy] = mask
+    return masks, packed_masks, valid, rotations
+
+
+MASKS, PACKED_MASKS, VALID, ROTATIONS = shape_tensors()
+DY = np.arange(4)
+
+
+def rng_state(seed):
+    """Initial state of engine.Rng(seed)"""
+    return engine.Rng(seed).state
+
+
+def rng_next(state):
+    """Advance xorshift32 states (uint32 array) in place like
+    engine.Rng.next() and return the new states"""
+    state ^= state << np.uint32(13)
+    state ^= state >> np.uint32(17)
+    state ^= state << np.uint32(5)
+    return state
+
+
+def rng_randint(state, a, b):
+    """engine.Rng.randint() for every state"""
+    value = rng_next(state).astype(np.uint64) * np.uint64(b - a + 1)
+    return (value >> np.uint64(32)).astype(np.int64) + a
+
+
+class BatchEnv():
+    """batch boards played one placement per step with array operations
+
+    Board i plays with seed + i, so its shapes and garbage lines are the
+    same as those of engine.Game(seed=seed + i).  An action is (rotation,
+    x): the shape is rotated that many times (0-3), moved left/right
+    step by step to x and dropped, like a player pressing UP, LEFT/RIGHT
+    and DOWN; blocked moves are skipped just like in the game.
+
+    Boards are grouped into matches of players boards.  Deleting two or
+    more lines attacks every other board of the match still playing (as
+    engine.Match targeting "all"); all boards place at the same time, so
+    attacks arrive at the start of the next step."""
+    def __init__(self, batch, players=1, seed=0):
+        if batch % players:
+            raise ValueError("batch must be a multiple of players")
+        self.batch = batch
+        self.players = players
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        """Start all boards over; returns rows (see below)"""
+        batch = self.batch
+        # Game area rows as bitmasks (bit x: block at x), standing on
+        # FLOOR_ROWS full rows; rows[i, FLOOR_ROWS + y] is line y
+        self.padded = np.zeros((batch, FLOOR_ROWS + PLHEIGHT), np.uint16)
+        self.padded[:, :FLOOR_ROWS] = FULL_ROW
+        seeds = [self.seed + i for i in range(batch)]
+        self.shape_rng = np.array([rng_state(seed) for seed in seeds],
+                                  np.uint32)
+        self.garbage_rng = np.array(
+            [rng_state(seed + 0x9E3779B9) for seed in seeds], np.uint32)
+        self.score = np.zeros(batch, np.int64)
+        self.level = np.zeros(batch, np.int64)
+        self.lines = np.zeros(batch, np.int64)
+        self.delete_counter = np.zeros(batch, np.int64)
+        self.garbage = np.zeros(batch, np.int64)  # lines to be added
+        self.done = np.zeros(batch, bool)
+        self.shape = np.zeros(batch, np.int64)
+        # engine.Game draws a shape in setup() and the first one spawned
+        # is the next one
+        rng_randint(self.shape_rng, 0, 6)
+        self.spawn(np.arange(batch))
+        return self.rows
+
+    @property
+    def rows(self):
+        """Game area row bitmasks, rows[i, y] with y=0 at the bottom"""
+        return self.padded[:, FLOOR_ROWS:]
+
+    def windows(self, boards, low=-1, high=SPAWN_Y):
+        """Return the 4 lines a shape at y covers, packed like
+        engine.BitBoard.packed, for y in low..high (boards, y)
+
+        Line y-dy is at bits (3-dy)*PLWIDTH, so a shape fits at y if its
+        PACKED_MASKS and the window don't overlap."""
+        padded = self.padded[boards].astype(np.uint64)
+        start = low + 1  # lowest line of the window at low, in padded
+        stop = high + 2
+        window = padded[:, start:stop]
+        for i in range(1, 4):
+            window = window | (padded[:, start + i:stop + i]
+                               << np.uint64(i * PLWIDTH))
+        return window
+
+    def spawn(self, boards):
+        """Generate the next shapes; boards they don't fit are done"""
+        state = self.shape_rng[boards]
+        self.shape[boards] = rng_randint(state, 0, 6)
+        self.shape_rng[boards] = state
+        masks = PACKED_MASKS[self.shape[boards], 0, SPAWN_X + 3]
+        top = self.windows(boards, SPAWN_Y)[:, 0]
+        self.done[boards[(top & masks) != 0]] = True
+
+    def add_garbage(self, boards):
+        """Insert the queued garbage lines at the bottom of boards"""
+        boards = boards[self.garbage[boards] > 0]
+        line = 0
+        while len(boards):
+            state = self.garbage_rng[boards]
+            row = np.zeros(len(boards), np.uint16)
+            for x in range(PLWIDTH):
+                # engine.Game.player_attacked(): randint(0, 99) >= 50
+                row |= (rng_randint(state, 0, 99) >= 50).astype(
+                    np.uint16) << np.uint16(x)
+            self.garbage_rng[boards] = state
+            padded = self.padded[boards]
+            padded[:, FLOOR_ROWS + 1:] = padded[:, FLOOR_ROWS:-1]
+            padded[:, FLOOR_ROWS] = row
+            self.padded[boards] = padded
+            line += 1
+            boards = boards[self.garbage[boards] > line]
+
+    def step(self, actions, garbage=None):
+        """Place the current shape of every board still playing
+
+        actions is an int array of (rotation, x) per board.  garbage
+        optionally gives more lines to add to each board first (as if
+        attacked before the shape moved).  Returns (rewards, done):
+        the score each board gained (as engine.Game.score) and whether
+        its game is over."""
+        actions = np.asarray(actions)
+        if garbage is not None:
+            self.garbage += np.asarray(garbage)
+        rewards = np.zeros(self.batch, np.int64)
+        boards = np.flatnonzero(~self.done)
+        if not len(boards):
+            return rewards, self.done.copy()
+        self.add_garbage(boards)
+        self.garbage[boards] = 0
+
+        count = len(boards)
+        shape = self.shape[boards]
+        cnt = np.zeros(count, np.int64)
+        x = np.full(count, SPAWN_X)
+        windows = self.windows(boards)  # y=-1..SPAWN_Y
+        top = windows[:, -1]
+
+        # Rotate, then move one column at a time (engine.Game.shape_move)
+        rotation = actions[boards, 0]
+        for turn in range(3):
+            moving = rotation > turn
+            if not moving.any():
+                break
+            new_cnt = (cnt + 1) % ROTATIONS[shape]
+            fits = VALID[shape, new_cnt, x + 3] & \
+                ((PACKED_MASKS[shape, new_cnt, x + 3] & top) == 0)
+            cnt = np.where(moving & fits, new_cnt, cnt)
+        target = actions[boards, 1]
+        direction = np.sign(target - SPAWN_X)
+        moves = np.abs(target - SPAWN_X)
+        for move in range(int(moves.max(initial=0))):
+            new_x = x + direction
+            # Off the mask table is beyond the walls, as off the dict
+            inside = (new_x >= -3) & (new_x < PLWIDTH)
+            column = np.where(inside, new_x, x) + 3
+            fits = inside & VALID[shape, cnt, column] & \
+                ((PACKED_MASKS[shape, cnt, column] & top) == 0)
+            x = np.where((moves > move) & fits, new_x, x)
+
+        # Drop: the shape falls to one above the highest y it doesn't fit
+        # at (the floor at y=-1 at the latest).  The game scores 2 for
+        # each fall, and 2 for the last try
+        masks = PACKED_MASKS[shape, cnt, x + 3]
+        hits = (windows[:, :-1] & masks[:, None]) != 0
+        falls = np.argmax(hits[:, ::-1], axis=1)
+        y = SPAWN_Y - falls
+        rewards[boards] += 2 * (falls + 1)
+
+        # Lock and check the lines touched by the shape, as
+        # engine.BitBoard.lock() does
+        masks = MASKS[shape, cnt, x + 3]
+        lines = y[:, None] + FLOOR_ROWS - DY
+        lines = np.clip(lines, 0, FLOOR_ROWS + PLHEIGHT - 1)
+        padded = self.padded[boards]
+        index = np.arange(count)[:, None]
+        padded[index, lines] |= masks
+        full_lines = np.zeros(padded.shape, bool)
+        full_lines[index, lines] = (padded[index, lines] == FULL_ROW) & \
+            (masks != 0)
+        full_lines = full_lines[:, FLOOR_ROWS:]
+        deleted = full_lines.sum(axis=1)
+
+        # Delete full lines: keep the others in order, empty lines on top
+        clearing = np.flatnonzero(deleted)
+        if len(clearing):
+            rows = padded[clearing, FLOOR_ROWS:]
+            order = np.argsort(full_lines[clearing], axis=1, kind="stable")
+            rows = np.take_along_axis(rows, order, axis=1)
+            rows[np.arange(PLHEIGHT) >= PLHEIGHT - deleted[clearing, None]] = 0
+            padded[clearing, FLOOR_ROWS:] = rows
+        self.padded[boards] = padded
+
+        # Score, level and attacks (engine.Game.animation)
+        cleared = boards[clearing]
+        deleted = deleted[clearing]
+        rewards[cleared] += 10 * 2 ** (deleted - 1)
+        self.lines[cleared] += deleted
+        counter = self.delete_counter[cleared] + deleted
+        level_up = counter >= 4
+        self.delete_counter[cleared] = np.where(level_up, 0, counter)
+        self.level[cleared] = np.minimum(self.level[cleared] + level_up,
+                                         MAX_LEVEL)
+        self.score += rewards
+
+        self.spawn(boards)
+        if self.players > 1:
+            attacks = np.zeros(self.batch, np.int64)
+            attacks[cleared] = np.maximum(deleted - 1, 0)
+            attacks = attacks.reshape(-1, self.players)
+            received = attacks.sum(axis=1, keepdims=True) - attacks
+            self.garbage += np.where(self.done, 0, received.reshape(-1))
+        return rewards, self.done.copy()
+
+
+def game_inputs(rotation, x):
+    """Inputs of engine.Game for the action (rotation, x) of BatchEnv"""
+    inputs = [engine.UP] * rotation
+    if x < SPAWN_X:
+        inputs += [engine.LEFT] * (SPAWN_X - x)
+    else:
+        inputs += [engine.RIGHT] * (x - SPAWN_X)
+    return inputs + [engine.DOWN]
+
+
+def play_until_spawn(game):
+    """Step a game without inputs until a shape spawns or it's over"""
+    # fall_flag is set by DOWN until the next shape spawns
+    while (game.fall_flag or game.generate_tetris) and not game.game_over:
+        game.step([], engine.DELETE_ANIMATION_TIME)
+
+
+def bot_actions(env, rng):
+    """Actions of bot.search() for every board, with RANDOM_ACTIONS of
+    them random (so boards get holes and games differ)"""
+    actions = np.stack([rng.integers(0, 4, env.batch),
+                        rng.integers(-2, PLWIDTH, env.batch)], axis=1)
+    for i in np.flatnonzero(~env.done & (rng.random(env.batch) >=
+                                         RANDOM_ACTIONS)):
+        best = bot.search(env.rows[i].tolist(), int(env.shape[i]), 0,
+                          SPAWN_X, SPAWN_Y)
+        if best is not None:
+            actions[i] = best
+    return actions
+
+
+def verify(games, placements, seed=0, players=1, policy="random"):
+    """Play games with BatchEnv and with engine.Match and compare them
+
+    policy "random" plays random actions, "bot" mostly bot.search()
+    placements.  Random garbage lines are added too, and with players
+    > 1 the boards also attack each other.  Returns (differences, num of
+    placements compared, lines cleared, garbage lines of attacks);
+    differences is empty if all games played the same."""
+    env = BatchEnv(games * players, players, seed)
+    # Match i has the seeds of boards i*players.. of env
+    matches = [engine.Match(players, True, seed + i * players)
+               for i in range(games)]
+    scalar = [game for match in matches for game in match.games]
+    for game in scalar:
+        play_until_spawn(game)
+    rng = np.random.default_rng(seed)
+    # Random garbage lines; CPU games last longer with fewer
+    garbage_rate = 0.01 if policy == "bot" else 0.05
+    differences = []
+    compared = 0
+    attack_lines = 0
+    for placement in range(placements):
+        if policy == "bot":
+            actions = bot_actions(env, rng)
+        else:
+            actions = np.stack([rng.integers(0, 4, env.batch),
+                                rng.integers(-2, PLWIDTH, env.batch)],
+                               axis=1)
+        garbage = np.where(rng.random(env.batch) < garbage_rate,
+                           rng.integers(1, 4, env.batch), 0)
+        env.step(actions, garbage)
+        # Attacks arrive in the next step (done boards keep theirs)
+        attack_lines += int(env.garbage[~env.done].sum())
+        # All boards of a BatchEnv place at the same time, so attacks
+        # made in this round are held back from the games placing after
+        # the attacker until the round is over
+        held = [[] for game in scalar]
+        for i, game in enumerate(scalar):
+            if game.game_over:
+                continue
+            compared += 1
+            if garbage[i]:
+                game.add_garbage(int(garbage[i]))
+            queued = [len(other.garbage) for other in scalar]
+            game.step(game_inputs(*actions[i]),
+                      engine.DELETE_ANIMATION_TIME)
+            play_until_spawn(game)
+            for j, other in enumerate(scalar):
+                while len(other.garbage) > queued[j]:
+                    held[j].insert(0, other.garbage.pop())
+        for game, game_held in zip(scalar, held):
+            game.garbage.extend(game_held)
+        for i, game in enumerate(scalar):
+            got = (env.rows[i].tolist(), int(env.score[i]), int(env.level[i]),
+                   bool(env.done[i]))
+            expected = (game.board.rows, game.score, game.level,
+                        game.game_over)
+            if got != expected:
+                differences.append(f"game {i} placement {placement}")
+        if env.done.all():
+            break
+    return differences, compared, int(env.lines.sum()), attack_lines
+
+
+def bench(batch, steps, seed=0):
+    """Return placements/sec of BatchEnv with random actions"""
+    env = BatchEnv(batch, seed=seed)
+    rng = np.random.default_rng(seed)
+    placements = 0
+    start_time = time.perf_counter()
+    for step in range(steps):
+        if env.done.all():
+            env.reset()
+        placements += int((~env.done).sum())
+        actions = np.stack([rng.integers(0, 4, batch),
+                            rng.integers(-2, PLWIDTH, batch)], axis=1)
+        env.step(actions)
+    return placements / (time.perf_counter() - start_time)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Zen Tetris NumPy batch environment")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    verify_parser = subparsers.add_parser(
+        "verify", help="check that boards play the same as engine.Match "
+        "(all of VERIFY_RUNS unless --players or --policy is given)")
+    verify_parser.add_argument("--players", type=int,
+                               help="boards per match (default: 1)")
+    verify_parser.add_argument("--policy", choices=["random", "bot"],
+                               help="random actions, or mostly CPU "
+                               "placements (default: random)")
+    verify_parser.add_argument("--games", type=int, default=200,
+                               help="matches (default: 200)")
+    verify_parser.add_argument("--placements", type=int, default=200)
+    verify_parser.add_argument("--seed", type=int, default=0)
+    bench_parser = subparsers.add_parser(
+        "bench", help="measure placements/sec with random actions")
+    bench_parser.add_argument("--batch", type=int, default=10000)
+    bench_parser.add_argument("--steps", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if args.command == "verify":
+        runs = VERIFY_RUNS
+        if args.players is not None or args.policy is not None:
+            runs = [(args.players or 1, args.policy or "random", args.games,
+                     args.placements)]
+        failed = False
+        for players, policy, games, placements in runs:
+            differences, compared, lines, attack_lines = verify(
+                games, placements, args.seed, players, policy)
+            for difference in differences[:20]:
+                print(f"MISMATCH: {difference}")
+            print(f"{games} games of {players} players ({policy}), "
+                  f"{compared} placements, {lines} lines cleared, "
+                  f"{attack_lines} attack lines: "
+                  f"{'OK' if not differences else 'MISMATCH'}")
+            failed = failed or bool(differences)
+        return 1 if failed else 0
+    placements_per_sec = bench(args.batch, args.steps)
+    print(f"{args.batch} boards: {placements_per_sec:,.0f} placements/sec")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,355 @@
+# Zen Tetris benchmarks - time core game operations on fixed boards
+# Save results as a baseline and compare later runs against it:
+#   python bench.py --save baseline.json
+#   python bench.py --compare baseline.json --threshold 0.1
+
+import argparse
+import json
+import platform
+import sys
+import time
+import types
+
+import bot
+import engine
+from engine import PLWIDTH, PLHEIGHT, GRAY
+
+BENCH_VERSION = 1
+REPEAT = 5  # timings per benchmark, the fastest one is reported
+
+# Rows filled per fixture (the rest of the game area is empty)
+FIXTURES = {
+    "empty": 0,
+    "half": PLHEIGHT // 2,
+    "near_top": PLHEIGHT - 3,
+    "garbage": PLHEIGHT - 6,  # filled by garbage lines, see fixture()
+    }
+
+
+def fixture(name, bitboard=True, seed=1):
+    """Return a Game whose game area is filled per FIXTURES[name]
+
+    Every filled row has one or more holes, so no line is full.  The
+    same name and seed always give the same board."""
+    game = engine.Game(bitboard, seed)
+    if name == "garbage":
+        game.add_garbage(FIXTURES[name])
+        game.player_attacked()
+        return game
+    rng = engine.Rng(seed)
+    game_area = [[0] * PLWIDTH for y in range(PLHEIGHT)]
+    for y in range(FIXTURES[name]):
+        hole = rng.randint(0, PLWIDTH - 1)
+        for x in range(PLWIDTH):
+            if x != hole and rng.randint(0, 99) >= 20:
+                game_area[y][x] = rng.randint(1, GRAY)
+    game.board.set_area(game_area)
+    return game
+
+
+def timed(setup, op, number):
+    """Return the fastest of REPEAT mean times of op(setup()) in sec
+
+    setup() runs outside the timing, so op can change what it gets."""
+    best = None
+    for i in range(REPEAT):
+        total = 0.0
+        for j in range(number):
+            arg = setup()
+            start_time = time.perf_counter()
+            op(arg)
+            total += time.perf_counter() - start_time
+        if best is None or total < best:
+            best = total
+    return best / number
+
+
+def bench_can_move(game):
+    """Check every rotation and x at the spawn line and at y=1"""
+    for shape_cnt in range(len(engine.TETRIS_SHAPES[game.shape][1])):
+        game.shape_cnt = shape_cnt
+        for y in (1, PLHEIGHT - 1):
+            game.y = y
+            for x in range(-1, PLWIDTH):
+                game.x = x
+                game.can_move()
+
+
+def bench_lock(game):
+    """Drop an I shape at the left wall and check for full lines"""
+    y = game.board.drop(0, 1, 0, PLHEIGHT - 1)
+    if y is not None:
+        game.board.lock(0, 1, 0, y)
+
+
+def bench_landing(game):
+    """Find the landing y (ghost piece) of every rotation and x from the
+    spawn line"""
+    for shape_cnt in range(len(engine.TETRIS_SHAPES[game.shape][1])):
+        for x in range(-1, PLWIDTH):
+            game.board.landing(game.shape, shape_cnt, x, PLHEIGHT - 1)
+
+
+def bench_delete_lines(game):
+    game.board.delete_lines([1, 0])
+
+
+def bench_attacked(game):
+    game.add_garbage(3)
+    game.player_attacked()
+
+
+BOARD_BENCHES = {
+    "can_move": (bench_can_move, 200),
+    "lock": (bench_lock, 2000),
+    "landing": (bench_landing, 200),
+    "delete_lines": (bench_delete_lines, 2000),
+    "attacked": (bench_attacked, 2000),
+    }
+
+
+def script_inputs(rng):
+    """Inputs of a busy player: rotate and move often, drop sometimes"""
+    inputs = set()
+    value = rng.randint(0, 99)
+    if value < 15:
+        inputs.add(engine.UP)
+    elif value < 40:
+        inputs.add(engine.LEFT)
+    elif value < 65:
+        inputs.add(engine.RIGHT)
+    if rng.randint(0, 99) < 10:
+        inputs.add(engine.DOWN)
+    return inputs
+
+
+def play(num_players, ticks, bitboard=True, players=None, seed=1):
+    """Step a match ticks times with scripted inputs
+
+    Returns (seconds per tick, num of shapes spawned).  players are
+    Player objects whose sprites are updated every tick, like
+    GameView.on_update does."""
+    match = engine.Match(num_players, bitboard, seed)
+    spawned = [0]
+
+    def count(game, event, data):
+        if event == engine.SPAWN:
+            spawned[0] += 1
+        elif event == engine.GAME_OVER:
+            game.setup()  # keep playing on a fresh board
+
+    for game in match.games:
+        game.subscribe(count)
+    if players is not None:
+        for player, game in zip(players, match.games):
+            player.game = game
+            game.subscribe(player.on_game_event)
+    rng = engine.Rng(seed)
+    dt = 1/60
+    start_time = time.perf_counter()
+    for tick in range(ticks):
+        match.step([script_inputs(rng) for game in match.games], dt)
+        if players is not None:
+            for player in players:
+                player.update_sprites()
+    elapsed = time.perf_counter() - start_time
+    return elapsed / ticks, spawned[0]
+
+
+def lookahead(pieces, seed=1):
+    """Place pieces shapes where bot.LookaheadSearch (the hint search)
+    puts them, and search every position twice, like the hint does after
+    the shape moved
+
+    Returns (nodes/sec, cache hit rate)."""
+    search = bot.LookaheadSearch()
+    rng = engine.Rng(seed)
+    rows = [0] * PLHEIGHT
+    shape = rng.randint(0, 6)
+    for piece in range(pieces):
+        next_shape = rng.randint(0, 6)
+        search.run(rows, shape, 0, bot.SPAWN_X, bot.SPAWN_Y, next_shape)
+        best = search.run(rows, shape, 0, bot.SPAWN_X, bot.SPAWN_Y - 1,
+                          next_shape)
+        if best is None:
+            rows = [0] * PLHEIGHT  # game over, start again
+        else:
+            rows = bot.place(rows, engine.pack_rows(rows), shape, best[0],
+                             best[1], bot.SPAWN_Y - 1)[0]
+        shape = next_shape
+    return search.nodes_per_sec(), search.cache.hit_rate()
+
+
+def sprite_players(num_players, bitboard=True):
+    """Return tet.Player objects for sprite benchmarks, or None if arcade
+    isn't available or can't open a display (e.g. headless CI)"""
+    try:
+        import tet
+    except Exception as e:  # pyglet raises its own display exceptions
+        print(f"sprite benchmarks skipped: {type(e).__name__}: {e}",
+              file=sys.stderr)
+        return None
+    assets = tet.Assets()
+    view = types.SimpleNamespace(
+        block_textures={color: assets.block_textures(color)
+                        for color in tet.BLOCK_IMAGES},
+        block_list=tet.arcade.SpriteList(),
+        window=types.SimpleNamespace(das=engine.DAS, arr=engine.ARR))
+    players = []
+    for i, (left_edge, bottom_edge, scale) in enumerate(
+            tet.board_layout(num_players)):
+        player = tet.Player()
+        player.game_view = view
+        player.game = engine.Game(bitboard, 1)
+        player.left_edge = left_edge
+        player.bottom_edge = bottom_edge
+        player.scale = scale
+        player.player_num = i + 1 if num_players > 1 else 0
+        player.setup()
+        players.append(player)
+    return players
+
+
+def bench_sprites(player, name, bitboard):
+    """Update every block sprite of a fixture board (worst case frame)"""
+    game = fixture(name, bitboard)
+
+    def setup():
+        player.game = game
+        player.block_shown = [[None] * PLWIDTH for y in range(PLHEIGHT)]
+        player.block_changed = True
+        player.player_moved = True
+        return player
+
+    return timed(setup, lambda player: player.update_sprites(), 50)
+
+
+def batch_placements_per_sec(quick=False):
+    """Return placements/sec of batchenv.BatchEnv, or None if numpy isn't
+    available"""
+    try:
+        import batchenv
+    except ImportError:
+        return None
+    return batchenv.bench(10000, 10 if quick else 100)
+
+
+def run(quick=False):
+    """Run all benchmarks and return {name: value}
+
+    Times are in sec per operation (lower is better), except *_per_sec
+    (higher is better)."""
+    ticks = 2000 if quick else 20000
+    play(2, ticks // 4)  # warm up
+    results = {}
+    for board_name, bitboard in (("bitboard", True), ("listboard", False)):
+        for fixture_name in FIXTURES:
+            for bench_name, (op, number) in BOARD_BENCHES.items():
+                if quick:
+                    number = max(1, number // 10)
+
+                results[f"{board_name}/{bench_name}/{fixture_name}"] = \
+                    timed(lambda: fixture(fixture_name, bitboard), op, number)
+        for num_players in (1, 2, 8):
+            # The same games every time, so only the time differs
+            tick_time, spawned = min(play(num_players, ticks, bitboard)
+                                     for i in range(REPEAT))
+            results[f"{board_name}/frame/{num_players}p"] = tick_time
+            results[f"{board_name}/pieces_per_sec/{num_players}p"] = \
+                spawned / (tick_time * ticks)
+
+    results["search/lookahead_nodes_per_sec"] = \
+        lookahead(20 if quick else 200)[0]
+
+    players = sprite_players(8)
+    if players is not None:
+        for fixture_name in FIXTURES:
+            results[f"sprites/update/{fixture_name}"] = \
+                bench_sprites(players[0], fixture_name, True)
+        for num_players in (1, 2, 8):
+            tick_time, spawned = play(num_players, ticks // 4,
+                                      players=players[:num_players])
+            results[f"sprites/frame/{num_players}p"] = tick_time
+
+    placements_per_sec = batch_placements_per_sec(quick)
+    if placements_per_sec is not None:
+        results["batch/placements_per_sec"] = placements_per_sec
+    return results
+
+
+def higher_is_better(name):
+    return "per_sec" in name
+
+
+def compare(results, baseline, threshold):
+    """Compare results with baseline results
+
+    Returns (lines to print, num of regressions).  A benchmark regresses
+    if it's more than threshold (0.1: 10%) slower than the baseline."""
+    lines = []
+    regressions = 0
+    for name, value in results.items():
+        if name not in baseline:
+            lines.append(f"{name:40} {format_value(name, value):>12}  (new)")
+            continue
+        base = baseline[name]
+        if higher_is_better(name):
+            slowdown = base / value - 1 if value else float("inf")
+        else:
+            slowdown = value / base - 1 if base else 0.0
+        mark = ""
+        if slowdown > threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        lines.append(f"{name:40} {format_value(name, value):>12} "
+                     f"{format_value(name, base):>12} {-slowdown:+7.1%}{mark}")
+    return lines, regressions
+
+
+def format_value(name, value):
+    if higher_is_better(name):
+        return f"{value:.0f}"
+    return f"{value * 1e6:.2f}us"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark Zen Tetris game operations")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare results with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="flag benchmarks slower than the baseline by "
+                        "more than this ratio (default: 0.1)")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer iterations, for a quick check")
+    args = parser.parse_args(argv)
+
+    results = run(args.quick)
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BENCH_VERSION:
+            raise SystemExit(f"{args.compare}: unsupported baseline version "
+                             f"{baseline.get('version')}")
+        print(f"{'benchmark':40} {'result':>12} {'baseline':>12} speedup")
+        lines, regressions = compare(results, baseline["results"],
+                                     args.threshold)
+        print("\n".join(lines))
+        print(f"{regressions} regressions (threshold {args.threshold:.0%})")
+    else:
+        for name, value in results.items():
+            print(f"{name:40} {format_value(name, value):>12}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"version": BENCH_VERSION,
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "python": platform.python_version(),
+                       "results": results}, f, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
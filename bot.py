@@ -0,0 +1,414 @@
+# Zen Tetris CPU player - placement search with a tunable board heuristic
+# The search runs in a worker process or thread, so the game loop never
+# waits for it; headless tools can also run it inline.
+
+import collections
+import concurrent.futures
+import time
+
+import engine
+from engine import PLWIDTH, PLHEIGHT, FULL_ROW
+from engine import SHAPE_PACKED_MASKS, SHAPE_MASKS
+
+# Heuristic weights (higher score is better)
+WEIGHTS = {
+    "height": -0.510066,  # aggregate column height
+    "lines": 0.760666,  # lines deleted by the placement
+    "holes": -0.35663,  # empty cells below a block
+    "bumpiness": -0.184483,  # sum of height differences between columns
+    }
+
+# Difficulty levels
+# think_time - sec before starting to move a new shape
+# move_time - sec between two moves (0: move every update)
+# budget - search time limit per shape in sec
+# nodes - search limit per shape in placements scored, used instead of
+#         budget when results must not depend on the machine speed (about
+#         the same search as budget at 10 usec per placement)
+# noise - random error added to placement scores, makes mistakes
+LEVELS = {
+    "easy": {"think_time": 0.5, "move_time": 0.2, "budget": 0.002,
+             "nodes": 200, "noise": 1.0},
+    "normal": {"think_time": 0.2, "move_time": 0.08, "budget": 0.005,
+               "nodes": 500, "noise": 0.2},
+    "hard": {"think_time": 0.0, "move_time": 0.0, "budget": 0.02,
+             "nodes": 2000, "noise": 0.0},
+    }
+
+
+CACHE_SIZE = 50000  # boards in the transposition table of LookaheadSearch
+LOST = -1e9  # score of a board the next shape can't spawn on
+SPAWN_X = PLWIDTH // 2 - 2  # where engine.Game spawns shapes
+SPAWN_Y = PLHEIGHT - 1
+
+
+def popcount(x):
+    return bin(x).count("1")
+
+
+def evaluate(rows, lines, weights):
+    """Score a game area (row bitmasks, after deleting full lines)"""
+    heights = [0] * PLWIDTH
+    covered = 0  # columns having a block above the current line
+    holes = 0
+    for y in range(PLHEIGHT-1, -1, -1):
+        row = rows[y]
+        holes += popcount(covered & ~row)
+        new = row & ~covered
+        while new:
+            bit = new & -new
+            heights[bit.bit_length() - 1] = y + 1
+            new ^= bit
+        covered |= row
+    bumpiness = 0
+    for x in range(PLWIDTH - 1):
+        bumpiness += abs(heights[x] - heights[x+1])
+    return (weights["height"] * sum(heights) +
+            weights["lines"] * lines +
+            weights["holes"] * holes +
+            weights["bumpiness"] * bumpiness)
+
+
+def place(rows, packed, shape, shape_cnt, x, y):
+    """Drop a shape from x, y and lock it
+
+    Returns (rows after deleting full lines, num of deleted lines, landing
+    y), or None if the shape doesn't fit at x, y."""
+    mask = SHAPE_PACKED_MASKS[shape][shape_cnt].get(x)
+    if mask is None:
+        return None
+    shift = (y + 1) * PLWIDTH
+    if packed & (mask << shift):
+        return None
+    while not packed & (mask << (shift - PLWIDTH)):
+        shift -= PLWIDTH
+    y = shift // PLWIDTH - 1
+    rows = rows[:]
+    for dy, row_mask in SHAPE_MASKS[shape][shape_cnt][x]:
+        rows[y - dy] |= row_mask
+    lines = 0
+    for line in range(PLHEIGHT-1, -1, -1):
+        if rows[line] == FULL_ROW:
+            del rows[line]
+            rows.append(0)
+            lines += 1
+    return rows, lines, y
+
+
+def reachable(packed, shape, shape_cnt, x, y, rotate=True):
+    """Return list of (shape_cnt, x) the shape can be moved to from x, y
+    by rotating first (unless rotate is False) and then moving left/right"""
+    masks = SHAPE_PACKED_MASKS[shape]
+    shift = (y + 1) * PLWIDTH
+
+    def fits(cnt, x):
+        mask = masks[cnt].get(x)
+        return mask is not None and not packed & (mask << shift)
+
+    result = []
+    for turn in range(len(masks) if rotate else 1):
+        cnt = (shape_cnt + turn) % len(masks)
+        if not fits(cnt, x):
+            break  # can't rotate any further
+        result.append((cnt, x))
+        for step in (-1, 1):
+            to_x = x + step
+            while fits(cnt, to_x):
+                result.append((cnt, to_x))
+                to_x += step
+    return result
+
+
+def search(rows, shape, shape_cnt, x, y, weights=WEIGHTS, budget=None,
+           noise=0.0, seed=0, nodes=None, rotate=True):
+    """Find the best placement of a shape at x, y with rotation shape_cnt
+
+    Returns (shape_cnt, x) to move to, or None if the shape can't move.
+    The search stops early (with the best placement found) when budget
+    sec passed or nodes placements were scored; only nodes gives the same
+    result on any machine.  noise adds a random error of up to +-noise to
+    each placement score.  rotate=False only searches shape_cnt."""
+    deadline = None if budget is None else time.perf_counter() + budget
+    rng = engine.Rng(seed)
+    packed = engine.pack_rows(rows)
+    best = None
+    best_score = None
+    scored = 0
+    for cnt, to_x in reachable(packed, shape, shape_cnt, x, y, rotate):
+        placed = place(rows, packed, shape, cnt, to_x, y)
+        if placed is None:
+            continue
+        scored += 1
+        new_rows, lines, land_y = placed
+        score = evaluate(new_rows, lines, weights)
+        if noise:
+            score += noise * (rng.randint(0, 2000) / 1000 - 1)
+        if best_score is None or score > best_score:
+            best_score = score
+            best = (cnt, to_x)
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        if nodes is not None and scored >= nodes:
+            break
+    return best
+
+
+class TranspositionTable():
+    """Scores of searched positions, the least recently used dropped
+    first when more than size are kept"""
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.table = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        score = self.table.get(key)
+        if score is None:
+            self.misses += 1
+            return None
+        self.table.move_to_end(key)
+        self.hits += 1
+        return score
+
+    def put(self, key, score):
+        self.table[key] = score
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class LookaheadSearch():
+    """Two-ply placement search: the current shape and the next one
+
+    Every placement the shape can reach is scored by the best placement
+    of the next shape after it (from its spawn position).  Positions are
+    kept in a TranspositionTable keyed by the packed board: the heuristic
+    score of a board, and the best next-ply score of a board and shape.
+
+    The search is incremental: start() sets up a position, step(budget)
+    searches for at most budget sec and returns True once it's done
+    (best is the best (shape_cnt, x) so far).  start() again cancels the
+    running search, but the table is kept, so a search after the shape
+    moved or fell a line finds most positions in it.  run() searches a
+    position to the end at once."""
+    def __init__(self, weights=WEIGHTS, cache_size=CACHE_SIZE):
+        self.weights = weights
+        self.cache = TranspositionTable(cache_size)
+        self.best = None
+        self.best_score = None
+        self.done = True
+        self.nodes = 0  # placements scored, over all searches
+        self.search_time = 0.0  # sec spent in step(), over all searches
+        self.node_iter = None
+
+    def start(self, rows, shape, shape_cnt, x, y, next_shape):
+        self.best = None
+        self.best_score = None
+        self.done = False
+        self.node_iter = self.search_nodes(list(rows), shape, shape_cnt,
+                                           x, y, next_shape)
+
+    def step(self, budget):
+        if self.done:
+            return True
+        start_time = time.perf_counter()
+        deadline = start_time + budget
+        try:
+            while True:
+                next(self.node_iter)
+                if time.perf_counter() > deadline:
+                    break
+        except StopIteration:
+            self.done = True
+            self.node_iter = None
+        self.search_time += time.perf_counter() - start_time
+        return self.done
+
+    def run(self, rows, shape, shape_cnt, x, y, next_shape):
+        """Search a position to the end and return the best
+        (shape_cnt, x), or None if the shape can't move"""
+        self.start(rows, shape, shape_cnt, x, y, next_shape)
+        self.step(float("inf"))
+        return self.best
+
+    def nodes_per_sec(self):
+        return self.nodes / self.search_time if self.search_time else 0.0
+
+    def search_nodes(self, rows, shape, shape_cnt, x, y, next_shape):
+        """Generator of the search, yields after each placement"""
+        packed = engine.pack_rows(rows)
+        lines_weight = self.weights["lines"]
+        for cnt, to_x in reachable(packed, shape, shape_cnt, x, y):
+            placed = place(rows, packed, shape, cnt, to_x, y)
+            if placed is None:
+                continue
+            new_rows, lines, land_y = placed
+            self.nodes += 1
+            score = yield from self.next_ply(new_rows, next_shape)
+            score += lines_weight * lines
+            if self.best_score is None or score > self.best_score:
+                self.best_score = score
+                self.best = (cnt, to_x)
+            yield
+
+    def next_ply(self, rows, shape):
+        """Best score of placing shape on rows, from its spawn position
+        (a generator, yields after each placement)"""
+        packed = engine.pack_rows(rows)
+        key = (packed, shape)
+        best_score = self.cache.get(key)
+        if best_score is not None:
+            return best_score
+        best_score = LOST
+        lines_weight = self.weights["lines"]
+        for cnt, to_x in reachable(packed, shape, 0, SPAWN_X, SPAWN_Y):
+            placed = place(rows, packed, shape, cnt, to_x, SPAWN_Y)
+            if placed is None:
+                continue
+            new_rows, lines, land_y = placed
+            self.nodes += 1
+            score = self.board_score(new_rows) + lines_weight * lines
+            best_score = max(best_score, score)
+            yield
+        self.cache.put(key, best_score)
+        return best_score
+
+    def board_score(self, rows):
+        """Heuristic score of a board without the lines term"""
+        key = engine.pack_rows(rows)
+        score = self.cache.get(key)
+        if score is None:
+            score = evaluate(rows, 0, self.weights)
+            self.cache.put(key, score)
+        return score
+
+
+class BotController():
+    """CPU player that plays a Game through the same inputs as a human
+
+    Call inputs(dt) once per update and add the result to the inputs
+    passed to game.step().  worker is "process", "thread" or None (search
+    inline, for headless games), or an executor shared by several bots
+    (close() leaves it running).  limit is "time" (search for the level's
+    budget) or "nodes" (the level's nodes, so seeded headless games play
+    the same on any machine).
+
+    When a rotation or move is blocked (e.g. by garbage lines), the bot
+    searches again from where the shape is, without rotating."""
+    def __init__(self, game, level="normal", weights=WEIGHTS,
+                 worker="process", limit="time"):
+        self.game = game
+        self.level = LEVELS[level]
+        self.weights = weights
+        self.limit = limit
+        self.executor = None
+        self.own_executor = True
+        if worker == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(1)
+        elif worker == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        elif worker is not None:
+            self.executor = worker
+            self.own_executor = False
+        self.pieces = 0  # num of shapes searched so far
+        self.future = None
+        self.target = None  # (shape_cnt, x) to move the shape to
+        self.wait = 0  # sec until the next move
+        self.moves = 0  # moves tried for the current shape
+        self.sent = None  # (input, shape_cnt, x) waiting for its MOVE
+        self.blocked = False  # the last rotation or move didn't happen
+        game.subscribe(self.on_game_event)
+
+    def on_game_event(self, game, event, data):
+        if event == engine.SPAWN:
+            self.start_search()
+        elif event == engine.MOVE:
+            if self.sent is not None:
+                # The first MOVE after an input is the step that took it
+                player_input, cnt, x = self.sent
+                self.sent = None
+                if (game.shape_cnt, game.x) == (cnt, x):
+                    self.blocked = True
+        elif event == engine.GAME_OVER:
+            self.cancel()
+
+    def search_args(self):
+        game = self.game
+        if self.limit == "nodes":
+            budget, nodes = None, self.level["nodes"]
+        else:
+            budget, nodes = self.level["budget"], None
+        return (list(game.board.rows), game.shape, game.shape_cnt,
+                game.x, game.y, self.weights, budget, self.level["noise"],
+                game.seed + self.pieces, nodes)
+
+    def start_search(self):
+        self.cancel()
+        self.pieces += 1
+        args = self.search_args()
+        self.wait = self.level["think_time"]
+        self.moves = 0
+        if self.executor is None:
+            self.target = search(*args)
+        else:
+            self.future = self.executor.submit(search, *args)
+
+    def replan(self):
+        """Search again from the shape's position without rotating (a
+        few placements, inline)"""
+        self.blocked = False
+        self.target = search(*self.search_args(), rotate=False)
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        self.target = None
+        self.sent = None
+        self.blocked = False
+
+    def inputs(self, dt):
+        """Return the inputs (a list) for this update"""
+        if self.future is not None and self.future.done():
+            if not self.future.cancelled():
+                self.target = self.future.result()
+            self.future = None
+        self.wait -= dt
+        if self.target is None or self.wait > 0 or self.sent is not None:
+            return []
+        game = self.game
+        if game.game_over or game.delete_animation or game.generate_tetris:
+            return []
+        if self.blocked:
+            self.replan()
+            if self.target is None:
+                return []
+        self.wait = self.level["move_time"]
+        cnt, x = self.target
+        self.moves += 1
+        if self.moves > 4 * PLWIDTH:
+            # Blocked (e.g. by garbage lines), just drop it
+            player_input = engine.DOWN
+        elif game.shape_cnt != cnt:
+            player_input = engine.UP
+        elif game.x < x:
+            player_input = engine.RIGHT
+        elif game.x > x:
+            player_input = engine.LEFT
+        else:
+            player_input = engine.DOWN
+        if player_input == engine.DOWN:
+            self.target = None
+        else:
+            self.sent = (player_input, game.shape_cnt, game.x)
+        return [player_input]
+
+    def close(self):
+        self.cancel()
+        if self.executor is not None and self.own_executor:
+            self.executor.shutdown(wait=False)
+        self.executor = None
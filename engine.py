@@ -0,0 +1,951 @@
+# Zen Tetris game engine - game rules without window, sprites or sounds
+# tet.py subscribes to engine events for sounds and sprites, while
+# headless tools can run games as fast as the CPU allows.
+
+import collections
+import random
+import struct
+
+PLWIDTH = 10  # game area width in number of blocks
+PLHEIGHT = 20  # game area height in number of blocks
+
+# Tetris shape colors
+BLUE = 1
+RED = 2
+PURPLE = 3
+GREEN = 4
+AQUA = 5
+YELLOW = 6
+ORANGE = 7
+GRAY = 8  # for wall/frame
+
+# Tetris shapes
+# A shape consists of four blocks, each is assigned a location
+# number in 4x4 matrix.  The first line are 0-3, the 2nd: 4-7, etc.
+TETRIS_SHAPES = [
+    [RED, [[2, 6, 10, 14], [4, 5, 6, 7]]],
+    [YELLOW, [[1, 2, 5, 6]]],
+    [AQUA, [[1, 4, 5, 6], [1, 4, 5, 9], [4, 5, 6, 9],
+            [1, 5, 6, 9]]],
+    [BLUE, [[1, 2, 5, 9], [0, 4, 5, 6], [1, 5, 8, 9],
+            [4, 5, 6, 10]]],
+    [ORANGE, [[0, 1, 5, 9], [4, 5, 6, 8], [1, 5, 9, 10],
+              [2, 4, 5, 6]]],
+    [GREEN, [[1, 5, 6, 10], [1, 2, 4, 5]]],
+    [PURPLE, [[1, 4, 5, 8], [0, 1, 5, 6]]],
+    ]
+
+# Fall speed by level (in sec)
+FALL_COUNTER_INIT = [60/60, 50/60, 40/60, 30/60,
+                     25/60, 20/60, 15/60, 10/60,
+                     7/60, 5/60, 3/60]
+
+FULL_ROW = (1 << PLWIDTH) - 1  # bitboard row with no empty cell
+
+DELETE_ANIMATION_TIME = 0.1  # sec/frame of delete animation
+DELETE_ANIMATION_FRAMES = 7  # frames in the block image strips
+
+TICK = 1/120  # sec per game step in the game window (see FixedStep)
+MAX_CATCH_UP = 0.25  # max sec of steps run for one (slow) frame
+
+# Player inputs
+UP = "up"  # rotate
+LEFT = "left"
+RIGHT = "right"
+DOWN = "down"  # drop
+HARD_DROP = "hard_drop"  # drop to the bottom and lock at once
+# Order of inputs given as a set
+INPUT_ORDER = [UP, LEFT, RIGHT, DOWN, HARD_DROP]
+
+DAS = 10/60  # sec a left/right key is held before it auto-repeats
+ARR = 2/60  # sec between auto-repeated moves (0: move to the wall)
+
+# Events sent to listeners as listener(game, event, data)
+SPAWN = "spawn"  # new shape generated at top of game area
+MOVE = "move"  # shape moved, rotated or fell
+LOCK = "lock"  # shape stuck at bottom
+BOARD = "board"  # game_area (or delete animation frame) changed
+LINE_CLEAR = "line_clear"  # data: list of deleted lines
+LEVEL_UP = "level_up"  # data: new level
+ATTACK = "attack"  # data: num of lines to add to the other players
+ATTACKED = "attacked"  # data: num of lines added by one attack
+GAME_OVER = "game_over"
+
+# Game.snapshot(): rng states, score, timers, shape and flags, then
+# num of delete_animation_lines and of garbage entries
+GAME_STATE = struct.Struct("<IIIddBBbbBB???B?BBB")
+MATCH_STATE = struct.Struct("<IB")  # target_rng state, num of players
+
+# Who the lines of an attack are sent to in battles (see Match)
+TARGETING = {
+    "all": "every other player",
+    "next": "the next player still playing, in turn",
+    "random": "a random other player",
+    "leader": "the player with the highest score",
+    "attacker": "the last player who attacked, else a random one",
+    }
+
+
+class Rng():
+    """Small deterministic random number generator (xorshift32)
+
+    The state is a single int, so it's cheap to save and restore, and a
+    seed gives the same numbers on every Python version."""
+    def __init__(self, seed):
+        # Scramble the seed so that close seeds give different numbers
+        x = seed & 0xFFFFFFFF
+        x = ((x ^ (x >> 16)) * 0x45d9f3b) & 0xFFFFFFFF
+        x = ((x ^ (x >> 16)) * 0x45d9f3b) & 0xFFFFFFFF
+        self.state = (x ^ (x >> 16)) or 1  # xorshift state must not be 0
+
+    def next(self):
+        """Return the next 32-bit random number"""
+        x = self.state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self.state = x
+        return x
+
+    def randint(self, a, b):
+        """Return random int in range [a, b], including both end points"""
+        return a + ((self.next() * (b - a + 1)) >> 32)
+
+
+def shape_cells(shape, shape_cnt):
+    """Return (dx, dy) of each block of a shape; y goes down from shape y"""
+    return [(pos % 4, pos // 4) for pos in TETRIS_SHAPES[shape][1][shape_cnt]]
+
+
+def shape_masks(shape, shape_cnt):
+    """Precompute bitboard row masks of a shape for every x
+
+    Returns a dict x -> [(dy, row mask), ...] for each x at which the shape
+    stays within the side walls."""
+    masks = {}
+    cells = shape_cells(shape, shape_cnt)
+    for x in range(-3, PLWIDTH):
+        rows = {}
+        for dx, dy in cells:
+            if x + dx < 0 or x + dx >= PLWIDTH:
+                break
+            rows[dy] = rows.get(dy, 0) | (1 << (x + dx))
+        else:
+            masks[x] = sorted(rows.items())
+    return masks
+
+
+def shape_packed_masks(shape, shape_cnt):
+    """Precompute a shape as one 4-row int for every x (see BitBoard.packed)
+
+    Line dy of the shape is at bits (3-dy)*PLWIDTH.. so that the mask is
+    placed at shape y by shifting it left (y+1)*PLWIDTH bits."""
+    packed_masks = {}
+    for x, masks in shape_masks(shape, shape_cnt).items():
+        packed_masks[x] = 0
+        for dy, mask in masks:
+            packed_masks[x] |= mask << ((3 - dy) * PLWIDTH)
+    return packed_masks
+
+
+def shape_column_masks(shape, shape_cnt):
+    """Precompute the columns of a shape over the whole packed board
+    (floor and game area) for every x"""
+    column_masks = {}
+    for x, masks in shape_masks(shape, shape_cnt).items():
+        columns = 0
+        for dy, mask in masks:
+            columns |= mask
+        column_masks[x] = sum(columns << (y * PLWIDTH)
+                              for y in range(PLHEIGHT + 4))
+    return column_masks
+
+
+def shape_bottoms(shape, shape_cnt):
+    """Return [(dx, dy of the lowest block), ...] for each column of a
+    shape"""
+    bottoms = {}
+    for dx, dy in shape_cells(shape, shape_cnt):
+        bottoms[dx] = max(bottoms.get(dx, 0), dy)
+    return sorted(bottoms.items())
+
+
+# SHAPE_MASKS[shape][shape_cnt][x] -> [(dy, row mask), ...]
+SHAPE_MASKS = [[shape_masks(shape, cnt) for cnt in range(len(rotations))]
+               for shape, (color, rotations) in enumerate(TETRIS_SHAPES)]
+# SHAPE_PACKED_MASKS[shape][shape_cnt][x] -> 4-row int mask
+SHAPE_PACKED_MASKS = [[shape_packed_masks(shape, cnt)
+                       for cnt in range(len(rotations))]
+                      for shape, (color, rotations)
+                      in enumerate(TETRIS_SHAPES)]
+# SHAPE_COLUMN_MASKS[shape][shape_cnt][x] -> packed board int mask
+SHAPE_COLUMN_MASKS = [[shape_column_masks(shape, cnt)
+                       for cnt in range(len(rotations))]
+                      for shape, (color, rotations)
+                      in enumerate(TETRIS_SHAPES)]
+# SHAPE_BOTTOMS[shape][shape_cnt] -> [(dx, lowest dy), ...]
+SHAPE_BOTTOMS = [[shape_bottoms(shape, cnt) for cnt in range(len(rotations))]
+                 for shape, (color, rotations) in enumerate(TETRIS_SHAPES)]
+# SHAPE_LINES[shape][shape_cnt] -> dy of each line of the shape, ascending
+SHAPE_LINES = [[sorted({dy for dx, dy in shape_cells(shape, cnt)})
+                for cnt in range(len(rotations))]
+               for shape, (color, rotations) in enumerate(TETRIS_SHAPES)]
+
+FLOOR = (1 << (4 * PLWIDTH)) - 1  # 4 full lines below the game area
+# Bits of the game area lines in a packed board (see pack_rows())
+AREA_BITS = ((1 << (PLHEIGHT * PLWIDTH)) - 1) << (4 * PLWIDTH)
+
+
+def pack_rows(rows):
+    """Pack row bitmasks into one int standing on FLOOR"""
+    packed = FLOOR
+    for y, row in enumerate(rows):
+        packed |= row << ((y + 4) * PLWIDTH)
+    return packed
+
+
+class ListBoard():
+    """Game area as PLHEIGHT lists of PLWIDTH colors
+
+    Column heights and line fill counts are kept up to date as shapes
+    lock and lines are deleted or inserted, so the landing y of a shape
+    (landing()) and full lines (lock()) are found without scanning the
+    game area."""
+    def __init__(self):
+        # 0: no block, color: block of color is there
+        self.game_area = []
+        for y in range(0, PLHEIGHT):
+            self.game_area.append([0] * PLWIDTH)
+        self.heights = [0] * PLWIDTH  # y of the top block + 1, 0: empty
+        self.fills = [0] * PLHEIGHT  # blocks in each line
+
+    def fits(self, shape, shape_cnt, x, y):
+        """Check if shape can be located at x, y with rotation count"""
+        for pos in TETRIS_SHAPES[shape][1][shape_cnt]:
+            cell_x = x + pos % 4
+            cell_y = y - pos // 4
+            if cell_x < 0 or cell_x >= PLWIDTH:
+                return False
+            if cell_y < 0:
+                return False
+            if self.game_area[cell_y][cell_x] != 0:
+                return False
+        return True
+
+    def drop(self, shape, shape_cnt, x, y):
+        """Return the lowest y the shape falls to from y, or None if the
+        shape doesn't fit at y"""
+        if not self.fits(shape, shape_cnt, x, y):
+            return None
+        while self.fits(shape, shape_cnt, x, y - 1):
+            y -= 1
+        return y
+
+    def landing(self, shape, shape_cnt, x, y):
+        """Same as drop(), but from the column heights if the shape is
+        above the top block of each of its columns (no overhang to slide
+        under), which takes a few operations"""
+        heights = self.heights
+        land_y = 0
+        for dx, dy in SHAPE_BOTTOMS[shape][shape_cnt]:
+            if x + dx < 0 or x + dx >= PLWIDTH:
+                return None
+            if heights[x + dx] + dy > land_y:
+                land_y = heights[x + dx] + dy
+        if land_y <= y:
+            return land_y
+        return self.drop(shape, shape_cnt, x, y)
+
+    def lock(self, shape, shape_cnt, x, y):
+        """Put shape blocks into game area and return full lines (top
+        to bottom)"""
+        color = TETRIS_SHAPES[shape][0]
+        heights = self.heights
+        fills = self.fills
+        for pos in TETRIS_SHAPES[shape][1][shape_cnt]:
+            cell_x = x + pos % 4
+            cell_y = y - pos // 4
+            # Garbage lines may have pushed blocks into the shape
+            if self.game_area[cell_y][cell_x] == 0:
+                fills[cell_y] += 1
+            self.game_area[cell_y][cell_x] = color
+            if heights[cell_x] <= cell_y:
+                heights[cell_x] = cell_y + 1
+        # Only lines touched by the shape can become full
+        return [y - dy for dy in SHAPE_LINES[shape][shape_cnt]
+                if fills[y - dy] == PLWIDTH]
+
+    def delete_lines(self, lines):
+        """Delete lines (top to bottom) and append empty lines on top
+
+        The deleted line lists are cleared and reused, so deleting
+        doesn't create garbage."""
+        for y in lines:
+            area_line = self.game_area.pop(y)
+            for x in range(PLWIDTH):
+                area_line[x] = 0
+            self.game_area.append(area_line)
+            del self.fills[y]
+            self.fills.append(0)
+        # Full lines have a block in every column, so each column loses
+        # len(lines) blocks below its top; the new top is at or below
+        game_area = self.game_area
+        for x in range(PLWIDTH):
+            height = self.heights[x] - len(lines)
+            while height > 0 and game_area[height - 1][x] == 0:
+                height -= 1
+            self.heights[x] = height
+
+    def insert_line(self, area_line):
+        """Push up game area and insert a line of colors at the bottom
+
+        The colors are copied into the list of the pushed out top line."""
+        top_line = self.game_area.pop()
+        top_line[:] = area_line
+        self.game_area.insert(0, top_line)
+        del self.fills[PLHEIGHT-1]
+        self.fills.insert(0, PLWIDTH - area_line.count(0))
+        game_area = self.game_area
+        for x in range(PLWIDTH):
+            height = self.heights[x]
+            if height > 0:
+                height = min(height + 1, PLHEIGHT)
+                # The top block may have been pushed out
+                while height > 0 and game_area[height - 1][x] == 0:
+                    height -= 1
+            elif area_line[x] != 0:
+                height = 1
+            self.heights[x] = height
+
+    def set_area(self, game_area):
+        """Replace all colors of game area (e.g. restoring a snapshot)"""
+        self.game_area = [area_line[:] for area_line in game_area]
+        self.fills = [PLWIDTH - area_line.count(0)
+                      for area_line in self.game_area]
+        self.heights = [0] * PLWIDTH
+        for y, area_line in enumerate(self.game_area):
+            for x in range(PLWIDTH):
+                if area_line[x] != 0:
+                    self.heights[x] = y + 1
+
+    def gray_line(self, y):
+        """Change block color of a line to GRAY"""
+        area_line = self.game_area[y]
+        for x in range(PLWIDTH):
+            if area_line[x] != 0:
+                area_line[x] = GRAY
+
+
+class BitBoard(ListBoard):
+    """Game area packed into a single int, PLWIDTH bits per line (bit x
+    set: block at x) on top of FLOOR, line y at bit (y+4)*PLWIDTH
+
+    A collision check is one shift and one and, and the landing y and
+    full lines come from the same int, so the column heights and line
+    fill counts of ListBoard aren't kept.  game_area is kept as a
+    parallel color plane for rendering."""
+    def __init__(self):
+        self.game_area = [[0] * PLWIDTH for y in range(PLHEIGHT)]
+        self.packed = FLOOR
+
+    @property
+    def rows(self):
+        """Row bitmasks, rows[y] with y=0 at the bottom"""
+        packed = self.packed >> (4 * PLWIDTH)
+        return [packed >> (y * PLWIDTH) & FULL_ROW for y in range(PLHEIGHT)]
+
+    def fits(self, shape, shape_cnt, x, y):
+        mask = SHAPE_PACKED_MASKS[shape][shape_cnt].get(x)
+        if mask is None:
+            return False  # hits the wall
+        return not self.packed & (mask << ((y + 1) * PLWIDTH))
+
+    def drop(self, shape, shape_cnt, x, y):
+        mask = SHAPE_PACKED_MASKS[shape][shape_cnt].get(x)
+        if mask is None:
+            return None
+        packed = self.packed
+        shift = (y + 1) * PLWIDTH
+        if packed & (mask << shift):
+            return None
+        # Nothing is above the top block of the shape's columns: start
+        # from where the shape is just above it
+        top = packed & SHAPE_COLUMN_MASKS[shape][shape_cnt][x]
+        top = ((top.bit_length() - 1) // PLWIDTH + 1) * PLWIDTH
+        if shift > top:
+            shift = top
+        # FLOOR stops the shape at y=0 at the latest
+        while not packed & (mask << (shift - PLWIDTH)):
+            shift -= PLWIDTH
+        return shift // PLWIDTH - 1
+
+    landing = drop
+
+    def lock(self, shape, shape_cnt, x, y):
+        color = TETRIS_SHAPES[shape][0]
+        game_area = self.game_area
+        for pos in TETRIS_SHAPES[shape][1][shape_cnt]:
+            game_area[y - pos // 4][x + pos % 4] = color
+        packed = self.packed | \
+            SHAPE_PACKED_MASKS[shape][shape_cnt][x] << ((y + 1) * PLWIDTH)
+        self.packed = packed
+        # Only lines touched by the shape can become full
+        return [y - dy for dy in SHAPE_LINES[shape][shape_cnt]
+                if packed >> ((y - dy + 4) * PLWIDTH) & FULL_ROW == FULL_ROW]
+
+    def delete_lines(self, lines):
+        game_area = self.game_area
+        packed = self.packed
+        for y in lines:
+            area_line = game_area.pop(y)
+            for x in range(PLWIDTH):
+                area_line[x] = 0
+            game_area.append(area_line)
+            # Keep the bits below line y and shift the ones above it down
+            shift = (y + 4) * PLWIDTH
+            packed = packed & ((1 << shift) - 1) | \
+                packed >> (shift + PLWIDTH) << shift
+        self.packed = packed
+
+    def set_area(self, game_area):
+        self.game_area = [area_line[:] for area_line in game_area]
+        self.packed = pack_rows(
+            [sum(1 << x for x in range(PLWIDTH) if area_line[x])
+             for area_line in self.game_area])
+
+    def insert_line(self, area_line):
+        top_line = self.game_area.pop()
+        top_line[:] = area_line
+        self.game_area.insert(0, top_line)
+        row = 0
+        for x in range(PLWIDTH):
+            if area_line[x] != 0:
+                row |= 1 << x
+        # Shift the game area up one line (the top line falls off) and put
+        # the new line on FLOOR
+        self.packed = (self.packed & AREA_BITS) << PLWIDTH & AREA_BITS | \
+            row << (4 * PLWIDTH) | FLOOR
+
+
+class Game():
+    """One player's game area, falling shape, score and level
+
+    bitboard selects BitBoard (fast collision checks) or the plain
+    ListBoard for the game area; both behave the same.  Shapes and
+    garbage lines come from separate random streams derived from seed,
+    so a game with the same seed and inputs always plays the same."""
+    def __init__(self, bitboard=True, seed=None):
+        self.listeners = []
+        self.bitboard = bitboard
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.setup()
+
+    def setup(self):
+        self.shape_rng = Rng(self.seed)
+        self.garbage_rng = Rng(self.seed + 0x9E3779B9)
+        self.score = 0
+        self.fall_counter = 0
+        self.level = 0
+        self.delete_counter = 0
+        self.x = 4
+        self.y = PLHEIGHT-1
+        self.shape = self.shape_rng.randint(0, 6)
+        self.shape_cnt = 0
+        self.fall_flag = False
+        self.generate_tetris = True
+        self.delete_animation = False
+        self.delete_animation_counter = 0
+        self.delete_animation_index = 0
+        self.delete_animation_lines = []
+        # Lines of each attack received, added at the start of the next
+        # step; attacks of several players in the same step all count
+        self.garbage = collections.deque()
+        self.game_over = False
+        self.gameover_counter = 0
+
+        # Initialize game area
+        if self.bitboard:
+            self.board = BitBoard()
+        else:
+            self.board = ListBoard()
+
+    @property
+    def game_area(self):
+        """Colors of game area blocks; game_area[y][x], y=0 at bottom"""
+        return self.board.game_area
+
+    def subscribe(self, listener):
+        """Call listener(game, event, data) on every game event"""
+        self.listeners.append(listener)
+
+    def emit(self, event, data=None):
+        for listener in self.listeners:
+            listener(self, event, data)
+
+    def step(self, inputs=(), dt=0):
+        """Advance the game by dt seconds with the given player inputs"""
+        self.fall_counter -= dt
+
+        if self.game_over is True:
+            # Gameover effect (turn blocks to GRAY)
+            self.player_game_over()
+        elif self.delete_animation is True:
+            # Delete animation
+            self.delete_animation_counter -= dt
+            self.animation()
+        else:
+            # Player key move and fall
+            self.player_attacked()
+            if not self.shape_move(inputs):
+                self.shape_fall()
+
+    def can_move(self):
+        """Check if shape can be located in current x, y, rotation count"""
+        return self.board.fits(self.shape, self.shape_cnt, self.x, self.y)
+
+    def landing_y(self):
+        """Return y where player shape would land if dropped (ghost
+        piece), or None if it doesn't fit where it is"""
+        return self.board.landing(self.shape, self.shape_cnt, self.x,
+                                  self.y)
+
+    def animation(self):
+        """Delete animation"""
+        # Animate to-be-deleted lines before actually delete them
+        if self.delete_animation_counter <= 0:
+            self.delete_animation_counter = carry_over(
+                self.delete_animation_counter, DELETE_ANIMATION_TIME)
+            self.delete_animation_index += 1
+            if self.delete_animation_index > DELETE_ANIMATION_FRAMES:
+                # Animation done
+                self.delete_animation = False
+                self.generate_tetris = True
+                self.fall_counter = 0  # spawn now (it ran down meanwhile)
+                self.delete_animation_index = 0
+                lines = self.delete_animation_lines
+                self.delete_counter += len(lines)
+                # delete 4 lines -> level up
+                if self.delete_counter >= 4:
+                    self.delete_counter = 0
+                    if self.level < len(FALL_COUNTER_INIT) - 1:
+                        self.level += 1
+                        self.emit(LEVEL_UP, self.level)
+                self.score += 10 * (2**(len(lines)-1))
+                # Attack the other player
+                self.emit(ATTACK, len(lines) - 1)
+
+                # Delete lines and append new lines
+                self.board.delete_lines(lines)
+                self.delete_animation_lines = []
+                self.emit(LINE_CLEAR, lines)
+            self.emit(BOARD)
+
+    def shape_move(self, inputs):
+        """Move player shape based on key input (see ordered_inputs)
+
+        Returns True if the shape was hard dropped and locked, so it
+        doesn't fall in this step anymore."""
+        if not inputs:
+            return False
+        for player_input in ordered_inputs(inputs):
+            if player_input == UP:
+                prev_cnt = self.shape_cnt
+                self.shape_cnt += 1
+                if self.shape_cnt >= len(TETRIS_SHAPES[self.shape][1]):
+                    self.shape_cnt = 0
+                if not self.can_move():
+                    self.shape_cnt = prev_cnt
+            elif player_input == LEFT:
+                prev_x = self.x
+                self.x -= 1
+                if not self.can_move():
+                    self.x = prev_x
+            elif player_input == RIGHT:
+                prev_x = self.x
+                self.x += 1
+                if not self.can_move():
+                    self.x = prev_x
+            elif player_input == DOWN:
+                self.fall_flag = True
+            elif player_input == HARD_DROP and not self.generate_tetris:
+                land_y = self.landing_y()
+                if land_y is not None:
+                    self.score += 2 * (self.y - land_y)
+                    self.y = land_y
+                    self.emit(MOVE)
+                    self.lock_shape()
+                    self.fall_counter = 0
+                    return True
+        self.emit(MOVE)
+        return False
+
+    def shape_fall(self):
+        """Drop player shape one line or reach the bottom"""
+        if self.fall_counter <= 0 or self.fall_flag is True:
+            self.fall_counter = carry_over(self.fall_counter,
+                                           FALL_COUNTER_INIT[self.level])
+            if self.generate_tetris is True:
+                # Generate new shape at top of game area
+                self.shape = self.shape_rng.randint(0, 6)
+                self.shape_cnt = 0
+                self.x = PLWIDTH // 2 - 2
+                self.y = PLHEIGHT - 1
+                self.fall_flag = False
+                self.generate_tetris = False
+                self.emit(SPAWN)
+                # Gameover check
+                if not self.can_move():
+                    self.game_over = True
+                    self.gameover_counter = 0
+                    self.emit(GAME_OVER)
+            else:
+                # Fall one line
+                prev_y = self.y
+                self.y -= 1
+                self.score += 2
+                if not self.can_move():
+                    # Stuck at bottom and can't move anymore
+                    self.y = prev_y
+                    self.lock_shape()
+                else:
+                    self.emit(MOVE)
+
+    def lock_shape(self):
+        """Put player shape into game area where it is and start deleting
+        full lines"""
+        lines = self.board.lock(self.shape, self.shape_cnt, self.x, self.y)
+        self.emit(LOCK)
+
+        # Delete line check (and delete)
+        if lines:
+            # Start delete animation
+            self.delete_animation = True
+            self.delete_animation_counter = DELETE_ANIMATION_TIME
+            self.delete_animation_index = 1
+            self.delete_animation_lines = lines
+        else:
+            # No delete line
+            self.generate_tetris = True
+        self.emit(BOARD)
+
+    def next_shape(self):
+        """Return the shape that spawns after the current one (preview)"""
+        rng = Rng(0)
+        rng.state = self.shape_rng.state
+        return rng.randint(0, 6)
+
+    def add_garbage(self, lines):
+        """Queue lines of an attack, added by player_attacked()"""
+        self.garbage.append(lines)
+
+    def player_attacked(self):
+        """Other players deleted two or more lines and incurred
+        additional lines to me"""
+        if not self.garbage:
+            return
+        area_line = [0] * PLWIDTH  # copied by insert_line()
+        while self.garbage:
+            lines = self.garbage.popleft()
+            for i in range(lines):
+                for x in range(PLWIDTH):
+                    if self.garbage_rng.randint(0, 99) < 50:  # 50%
+                        area_line[x] = 0
+                    else:
+                        area_line[x] = GRAY
+                self.board.insert_line(area_line)
+            self.emit(ATTACKED, lines)
+        self.emit(BOARD)
+
+    def snapshot(self):
+        """Return the whole game state as bytes (see restore())
+
+        Colors of game area take 4 bits per cell, so a snapshot is
+        about 150 bytes."""
+        lines = self.delete_animation_lines
+        data = GAME_STATE.pack(
+            self.shape_rng.state, self.garbage_rng.state, self.score,
+            self.fall_counter, self.delete_animation_counter, self.level,
+            self.delete_counter, self.x, self.y, self.shape, self.shape_cnt,
+            self.fall_flag, self.generate_tetris, self.delete_animation,
+            self.delete_animation_index, self.game_over,
+            self.gameover_counter, len(lines), len(self.garbage))
+        cells = [color for area_line in self.game_area
+                 for color in area_line]
+        area = bytes(cells[i] << 4 | cells[i+1]
+                     for i in range(0, len(cells), 2))
+        return data + bytes(lines) + bytes(self.garbage) + area
+
+    @staticmethod
+    def parse_snapshot(data):
+        """Check snapshot() bytes and return them as (fields, delete
+        animation lines, garbage, game area), see set_state()
+
+        Raises ValueError if data isn't a whole snapshot."""
+        if len(data) < GAME_STATE.size:
+            raise ValueError(f"game snapshot of {len(data)} bytes")
+        fields = GAME_STATE.unpack_from(data)
+        num_lines, num_garbage = fields[-2:]
+        offset = GAME_STATE.size
+        if len(data) != offset + num_lines + num_garbage + \
+           PLWIDTH*PLHEIGHT//2:
+            raise ValueError(f"game snapshot of {len(data)} bytes")
+        lines = list(data[offset:offset+num_lines])
+        offset += num_lines
+        garbage = collections.deque(data[offset:offset+num_garbage])
+        offset += num_garbage
+        cells = []
+        for byte in data[offset:offset + PLWIDTH*PLHEIGHT//2]:
+            cells += (byte >> 4, byte & 0xF)
+        area = [cells[y*PLWIDTH:(y+1)*PLWIDTH] for y in range(PLHEIGHT)]
+        return fields[:-2], lines, garbage, area
+
+    def restore(self, data):
+        """Set the game state from snapshot() bytes
+
+        Listeners stay subscribed; no events are sent, so views must
+        redraw everything.  Raises ValueError (and changes nothing) if
+        data isn't a whole snapshot."""
+        self.set_state(*self.parse_snapshot(data))
+
+    def set_state(self, fields, lines, garbage, area):
+        """Set the game state from parse_snapshot()"""
+        (self.shape_rng.state, self.garbage_rng.state, self.score,
+         self.fall_counter, self.delete_animation_counter, self.level,
+         self.delete_counter, self.x, self.y, self.shape, self.shape_cnt,
+         self.fall_flag, self.generate_tetris, self.delete_animation,
+         self.delete_animation_index, self.game_over,
+         self.gameover_counter) = fields
+        self.delete_animation_lines = lines
+        self.garbage = garbage
+        self.board.set_area(area)
+
+    def player_game_over(self):
+        """Change block color to GRAY from bottom to top"""
+        if self.gameover_counter >= PLHEIGHT:
+            return
+        self.board.gray_line(self.gameover_counter)
+        self.gameover_counter += 1
+        self.emit(BOARD)
+
+
+def ordered_inputs(inputs):
+    """Return inputs of a step as a list in the order they are played
+
+    A list (or tuple) is played as is, so a key tapped twice in a step
+    moves twice.  A set has no order, so it's played in INPUT_ORDER."""
+    if isinstance(inputs, (set, frozenset)):
+        return [player_input for player_input in INPUT_ORDER
+                if player_input in inputs]
+    return list(inputs)
+
+
+class InputQueue():
+    """Timestamped key presses and releases of a player
+
+    press() and release() queue key events as they come; inputs(end)
+    returns the inputs up to time end in order, adding the auto-repeats
+    of held left/right keys: the first after das sec, then every arr
+    sec.  Times are in sec of any clock, e.g. time.perf_counter()."""
+    REPEAT = (LEFT, RIGHT)
+
+    def __init__(self, das=DAS, arr=ARR):
+        self.das = das
+        self.arr = arr
+        self.events = collections.deque()  # (time, pressed, input)
+        self.held = {}  # repeated input -> time of the next repeat
+
+    def press(self, player_input, event_time):
+        self.events.append((event_time, True, player_input))
+
+    def release(self, player_input, event_time):
+        self.events.append((event_time, False, player_input))
+
+    def clear(self):
+        self.events.clear()
+        self.held.clear()
+
+    def next_repeat(self):
+        if not self.held:
+            return None, None
+        player_input = min(self.held, key=self.held.get)
+        return self.held[player_input], player_input
+
+    def inputs(self, end):
+        result = []
+        while True:
+            repeat_time, repeat_input = self.next_repeat()
+            if self.events and self.events[0][0] <= end and \
+               (repeat_time is None or self.events[0][0] <= repeat_time):
+                event_time, pressed, player_input = self.events.popleft()
+                if not pressed:
+                    self.held.pop(player_input, None)
+                elif player_input not in self.held:
+                    result.append(player_input)
+                    if player_input in self.REPEAT:
+                        # The last pressed direction wins
+                        for other in self.REPEAT:
+                            self.held.pop(other, None)
+                        self.held[player_input] = event_time + self.das
+            elif repeat_time is not None and repeat_time <= end:
+                if self.arr > 0:
+                    result.append(repeat_input)
+                    self.held[repeat_input] = repeat_time + self.arr
+                else:
+                    result.extend([repeat_input] * PLWIDTH)  # to the wall
+                    self.held[repeat_input] = end + self.das
+            else:
+                return result
+
+
+def carry_over(counter, period):
+    """Restart a count down timer of period sec that reached counter
+
+    The time past 0 (up to one period) is carried over, so a timer keeps
+    its period on average whatever the step length is."""
+    return period + max(min(counter, 0), -period)
+
+
+class FixedStep():
+    """Turns variable frame times into a number of fixed-length steps
+
+    advance(dt) returns how many steps of tick sec to run for a frame of
+    dt sec, so the game runs at the same speed at any frame rate.  After
+    a long frame at most max_steps are run and the rest of the time is
+    dropped (counted in dropped), so that a slow machine doesn't fall
+    further behind by running more and more steps per frame.  alpha is
+    the fraction of a step not run yet, for interpolated rendering."""
+    def __init__(self, tick=TICK, max_steps=None):
+        self.tick = tick
+        if max_steps is None:
+            max_steps = max(1, round(MAX_CATCH_UP / tick))
+        self.max_steps = max_steps
+        self.time = 0.0  # sec not run yet
+        self.dropped = 0  # steps dropped so far
+
+    def advance(self, dt):
+        self.time += dt
+        steps = int(self.time / self.tick)
+        self.time -= steps * self.tick
+        if steps > self.max_steps:
+            self.dropped += steps - self.max_steps
+            steps = self.max_steps
+        return steps
+
+    @property
+    def alpha(self):
+        return self.time / self.tick
+
+
+class Match():
+    """Games played side by side; deleting lines attacks the others
+
+    Player i plays with seed + i.  targeting (a key of TARGETING) chooses
+    who gets the lines of an attack; players whose game is over are
+    never attacked.  Random targets come from a stream derived from
+    seed, so battles replay the same too."""
+    def __init__(self, num_players=1, bitboard=True, seed=None,
+                 targeting="all"):
+        if seed is None:
+            seed = random.getrandbits(32)
+        if targeting not in TARGETING:
+            raise ValueError(f"unknown targeting: {targeting}")
+        self.seed = seed
+        self.bitboard = bitboard
+        self.targeting = targeting
+        self.target_rng = Rng(seed + 0x7F4A7C15)
+        self.games = []
+        self.last_attacker = []  # by player, index of the last attacker
+        for i in range(num_players):
+            game = Game(bitboard, seed + i)
+            game.subscribe(self.on_game_event)
+            self.games.append(game)
+            self.last_attacker.append(None)
+
+    def on_game_event(self, game, event, data):
+        if event == ATTACK and data > 0:
+            attacker = self.games.index(game)
+            for target in self.targets(attacker):
+                self.games[target].add_garbage(data)
+                self.last_attacker[target] = attacker
+
+    def targets(self, attacker):
+        """Indexes of the players an attack of player attacker hits"""
+        alive = [i for i, game in enumerate(self.games)
+                 if i != attacker and not game.game_over]
+        if not alive:
+            return []
+        targeting = self.targeting
+        if targeting == "attacker":
+            if self.last_attacker[attacker] in alive:
+                return [self.last_attacker[attacker]]
+            targeting = "random"
+        if targeting == "all":
+            return alive
+        if targeting == "next":
+            # alive is sorted, so the first one after attacker or else
+            # the first one from the top
+            for i in alive:
+                if i > attacker:
+                    return [i]
+            return [alive[0]]
+        if targeting == "random":
+            return [alive[self.target_rng.randint(0, len(alive) - 1)]]
+        # leader; the first player of a tie
+        return [max(alive, key=lambda i: self.games[i].score)]
+
+    def snapshot(self):
+        """Return the state of all games as bytes (see Game.snapshot())"""
+        data = [MATCH_STATE.pack(self.target_rng.state, len(self.games)),
+                bytes(255 if attacker is None else attacker
+                      for attacker in self.last_attacker)]
+        for game in self.games:
+            game_data = game.snapshot()
+            data.append(struct.pack("<H", len(game_data)))
+            data.append(game_data)
+        return b"".join(data)
+
+    def restore(self, data):
+        """Set the state of all games from snapshot() bytes
+
+        Raises ValueError (and changes nothing) if data isn't a whole
+        snapshot of this many players."""
+        if len(data) < MATCH_STATE.size:
+            raise ValueError(f"match snapshot of {len(data)} bytes")
+        target_state, num_players = MATCH_STATE.unpack_from(data)
+        if num_players != len(self.games):
+            raise ValueError(f"snapshot of {num_players} players")
+        offset = MATCH_STATE.size
+        last_attacker = [None if attacker == 255 else attacker
+                         for attacker in data[offset:offset + num_players]]
+        offset += num_players
+        states = []
+        for game in self.games:
+            if offset + 2 > len(data):
+                raise ValueError(f"match snapshot of {len(data)} bytes")
+            length, = struct.unpack_from("<H", data, offset)
+            offset += 2
+            states.append(Game.parse_snapshot(data[offset:offset + length]))
+            offset += length
+        if offset != len(data):
+            raise ValueError(f"match snapshot of {len(data)} bytes")
+        self.target_rng.state = target_state
+        self.last_attacker = last_attacker
+        for game, state in zip(self.games, states):
+            game.set_state(*state)
+
+    @property
+    def over(self):
+        """True when every player's game is over"""
+        for game in self.games:
+            if not game.game_over:
+                return False
+        return True
+
+    def step(self, inputs, dt):
+        """Advance all games by dt seconds
+
+        inputs is a list of input collections, one per player"""
+        for game, game_inputs in zip(self.games, inputs):
+            game.step(game_inputs, dt)
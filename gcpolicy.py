@@ -0,0 +1,75 @@
+# Zen Tetris GC policy - keep garbage collections out of busy frames
+
+import gc
+
+
+class GcPolicy():
+    """Defers garbage collections during a game to safe points
+
+    start() (when a game is set up) collects once, then moves every object
+    alive - textures, sprites, game state - to the permanent generation
+    with gc.freeze(), so collections never scan them again, and turns
+    automatic collection off.  safe_point() runs the collection Python
+    would have run by now, at a moment the game can afford it: right after
+    a shape spawns, or on pause.  If no safe point comes while max_deferred
+    times the gen 0 threshold is reached, update() collects gen 0 anyway.
+    stop() (the game is over) unfreezes and restores automatic collection.
+
+    With enabled=False all of this is skipped, and Python collects as
+    usual."""
+    def __init__(self, enabled=True, max_deferred=10):
+        self.enabled = enabled
+        self.max_deferred = max_deferred
+        self.active = False
+        self.was_enabled = True  # gc.isenabled() before start()
+        self.collections = 0  # run by safe_point() and update()
+        self.forced = 0  # run by update() with no safe point in time
+
+    def start(self):
+        if not self.enabled or self.active:
+            return
+        gc.collect()
+        gc.freeze()
+        self.was_enabled = gc.isenabled()
+        gc.disable()
+        self.active = True
+
+    def stop(self):
+        if not self.active:
+            return
+        gc.unfreeze()
+        if self.was_enabled:
+            gc.enable()
+        self.active = False
+
+    def due(self):
+        """Return the oldest generation Python would collect now, or None"""
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        for generation in (2, 1, 0):
+            if thresholds[generation] and \
+               counts[generation] >= thresholds[generation]:
+                return generation
+        return None
+
+    def safe_point(self, full=False):
+        """Collect now if a collection is due (full: all generations)"""
+        if not self.active:
+            return
+        generation = 2 if full else self.due()
+        if generation is not None:
+            gc.collect(generation)
+            self.collections += 1
+
+    def update(self, safe=False):
+        """Call once per frame; safe: a safe point was reached"""
+        if not self.active:
+            return
+        threshold = gc.get_threshold()[0]
+        if safe:
+            self.safe_point()
+        elif threshold and \
+                gc.get_count()[0] >= threshold * self.max_deferred:
+            gc.collect(0)
+            self.collections += 1
+            self.forced += 1
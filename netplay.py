@@ -0,0 +1,532 @@
+# Zen Tetris network battle - input-delay lockstep over UDP
+# Both sides simulate the whole engine.Match from the same seed and only
+# exchange inputs, so shapes and garbage lines are the same on both sides.
+# Networking runs in an asyncio loop on a background thread; the game
+# loop only calls add_local() and step(), which never block.
+#
+#   python netplay.py test --latency 0.04 --loss 0.05  # localhost check
+#   python netplay.py proxy 5001 host:5000 --latency 0.04  # lossy relay
+
+import argparse
+import asyncio
+import random
+import struct
+import threading
+import time
+import zlib
+
+import engine
+
+PROTOCOL_VERSION = 2
+DEFAULT_PORT = 5000
+DEFAULT_DELAY = 4  # input delay in ticks (67 msec)
+TICK = 1/60  # sec per lockstep tick
+CHECK_INTERVAL = 60  # ticks between state hash checks
+MAX_INPUTS = 64  # max ticks of inputs per packet
+MAX_TICK_INPUTS = 255  # max inputs of a tick (e.g. --arr 0 repeats)
+HELLO_TIME = 0.2  # sec between connection requests
+TIMEOUT = 5.0  # sec without packets before the session is closed
+
+# Packet types
+HELLO = 1  # guest -> host: type, version
+WELCOME = 2  # host -> guest: type, version, seed, delay
+INPUTS = 3  # type, ack, check tick, check hash, first tick, count, then
+# count ticks of inputs: num of inputs n, n bytes of input (index in
+# engine.INPUT_ORDER)
+BYE = 4  # type
+
+HELLO_PACKET = struct.Struct("!BB")
+WELCOME_PACKET = struct.Struct("!BBIB")
+INPUTS_PACKET = struct.Struct("!BIIIIB")
+
+
+def encode_inputs(inputs):
+    """Return the inputs of a tick as bytes, in the order they are played
+    (see engine.ordered_inputs()), so repeated presses are kept"""
+    return bytes(engine.INPUT_ORDER.index(player_input) for player_input
+                 in engine.ordered_inputs(inputs)[:MAX_TICK_INPUTS])
+
+
+def decode_inputs(codes):
+    return [engine.INPUT_ORDER[code] for code in codes]
+
+
+def state_hash(match):
+    """Hash of the game state that both sides must agree on"""
+    state = []
+    for game in match.games:
+        state.append((game.score, game.level, game.shape, game.shape_cnt,
+                      game.x, game.y, game.game_over, game.game_area))
+    return zlib.crc32(repr(state).encode())
+
+
+class Lockstep():
+    """Input-delay lockstep of a two-player match, without networking
+
+    Local inputs given at tick t are played at tick t+delay, which leaves
+    delay ticks to send them to the other player.  A tick is simulated
+    only when the inputs of both players are known; while the other
+    player's inputs are late, the game waits (a stall).  index is the
+    local player, 0 (host) or 1 (guest)."""
+    def __init__(self, index, delay=DEFAULT_DELAY):
+        self.index = index
+        self.lock = threading.Lock()
+        self.reset(delay)
+
+    def reset(self, delay):
+        self.delay = delay
+        # The first delay ticks are played without inputs
+        # tick -> encode_inputs() bytes
+        self.local = {tick: b"" for tick in range(delay)}
+        self.remote = {tick: b"" for tick in range(delay)}
+        self.local_tick = delay  # next tick to give local inputs for
+        self.remote_tick = delay  # remote inputs are known up to here
+        self.tick = 0  # next tick to simulate
+        self.peer_ack = 0  # the other player has local inputs < peer_ack
+        self.checks = {}  # tick -> local state hash
+        self.remote_check = (0, 0)  # (tick, hash) from the other player
+        self.desync = None  # first tick whose state hashes differ
+        self.stalls = 0  # local ticks dropped while waiting
+
+    def add_local(self, inputs):
+        """Give the local inputs of the next tick
+
+        Returns False (and drops the tick) when the local player is delay
+        ticks ahead of the simulation, i.e. the other player is late."""
+        with self.lock:
+            if self.local_tick > self.tick + self.delay:
+                self.stalls += 1
+                return False
+            self.local[self.local_tick] = encode_inputs(inputs)
+            self.local_tick += 1
+        self.send()
+        return True
+
+    def step(self, match, dt=TICK):
+        """Simulate every tick whose inputs are known
+
+        Returns the inputs (one list per player) of the simulated ticks."""
+        stepped = []
+        while True:
+            with self.lock:
+                tick = self.tick
+                if tick >= self.local_tick or tick >= self.remote_tick:
+                    break
+                if tick < self.peer_ack:
+                    local = self.local.pop(tick)  # not to be sent again
+                else:
+                    local = self.local[tick]
+                codes = [local, self.remote.pop(tick)]
+            if self.index == 1:
+                codes.reverse()
+            inputs = [decode_inputs(tick_codes) for tick_codes in codes]
+            match.step(inputs, dt)
+            stepped.append(inputs)
+            with self.lock:
+                self.tick = tick + 1
+                if self.tick % CHECK_INTERVAL == 0:
+                    self.checks[self.tick] = state_hash(match)
+                    self.compare_checks()
+        return stepped
+
+    def compare_checks(self):
+        check_tick, check_hash = self.remote_check
+        local_hash = self.checks.get(check_tick)
+        if local_hash is not None and local_hash != check_hash and \
+           self.desync is None:
+            self.desync = check_tick
+        # Keep the hashes the other player hasn't sent yet
+        for tick in [tick for tick in self.checks if tick < check_tick]:
+            del self.checks[tick]
+
+    def inputs_packet(self):
+        """Local inputs not acknowledged yet, with the latest state hash"""
+        with self.lock:
+            first = max(self.peer_ack, self.local_tick - MAX_INPUTS)
+            ticks = bytearray()
+            for tick in range(first, self.local_tick):
+                ticks.append(len(self.local[tick]))
+                ticks += self.local[tick]
+            check_tick = max(self.checks, default=0)
+            check_hash = self.checks.get(check_tick, 0)
+            return INPUTS_PACKET.pack(INPUTS, self.remote_tick, check_tick,
+                                      check_hash, first,
+                                      self.local_tick - first) + ticks
+
+    def receive_inputs(self, data):
+        (kind, ack, check_tick, check_hash, first,
+         count) = INPUTS_PACKET.unpack_from(data)
+        offset = INPUTS_PACKET.size
+        ticks = []
+        for i in range(count):
+            if offset >= len(data) or \
+               offset + 1 + data[offset] > len(data):
+                break  # truncated packet: keep the complete ticks
+            ticks.append(data[offset + 1:offset + 1 + data[offset]])
+            offset += 1 + data[offset]
+        with self.lock:
+            if ack > self.peer_ack:
+                for tick in range(self.peer_ack, min(ack, self.tick)):
+                    self.local.pop(tick, None)
+                self.peer_ack = ack
+            for i, tick_codes in enumerate(ticks):
+                if first + i >= self.remote_tick:
+                    self.remote[first + i] = tick_codes
+            while self.remote_tick in self.remote:
+                self.remote_tick += 1
+            if check_tick > self.remote_check[0]:
+                self.remote_check = (check_tick, check_hash)
+                self.compare_checks()
+
+    def send(self):
+        """Send local inputs; Lockstep alone has no network"""
+
+
+class LoopThread():
+    """asyncio event loop running on a daemon thread"""
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.open())
+        finally:
+            self.started.set()
+        self.loop.run_forever()
+        # Let tasks reading closed connections finish
+        tasks = asyncio.all_tasks(self.loop)
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks, timeout=1.0))
+        self.loop.close()
+
+    async def open(self):
+        pass
+
+    def shutdown(self):
+        self.loop.stop()
+
+    def close(self):
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.shutdown)
+            self.thread.join(1.0)
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receive):
+        self.receive = receive
+
+    def datagram_received(self, data, addr):
+        self.receive(data, addr)
+
+    def error_received(self, exc):
+        pass  # e.g. the host isn't listening yet; HELLO is sent again
+
+
+class NetSession(Lockstep, LoopThread):
+    """Lockstep over UDP between a host and a guest
+
+    host=None listens on port (player 1), otherwise connects to host:port
+    (player 2).  The host chooses the seed and the input delay.  Call
+    start(), wait for connected, then create the match with seed."""
+    def __init__(self, host=None, port=DEFAULT_PORT, delay=DEFAULT_DELAY,
+                 seed=None):
+        Lockstep.__init__(self, 0 if host is None else 1, delay)
+        LoopThread.__init__(self)
+        self.host = host
+        self.port = port
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed if host is None else None  # guest: from host
+        self.connected = threading.Event()
+        self.closed = False
+        self.error = None
+        self.transport = None
+        self.peer = None  # address of the other player (host side)
+        self.last_receive = 0
+
+    async def open(self):
+        protocol = DatagramProtocol(self.receive)
+        try:
+            if self.host is None:
+                self.transport, p = await self.loop.create_datagram_endpoint(
+                    lambda: protocol, local_addr=("0.0.0.0", self.port))
+            else:
+                self.transport, p = await self.loop.create_datagram_endpoint(
+                    lambda: protocol, remote_addr=(self.host, self.port))
+                self.send_hello()
+        except OSError as e:
+            self.error = str(e)
+            self.closed = True
+            return
+        self.loop.call_later(TICK, self.timer)
+
+    def send_packet(self, data):
+        if self.transport is None:
+            return
+        if self.host is None:
+            if self.peer is not None:
+                self.transport.sendto(data, self.peer)
+        else:
+            self.transport.sendto(data)
+
+    def send_hello(self):
+        if not self.connected.is_set() and not self.closed:
+            self.send_packet(HELLO_PACKET.pack(HELLO, PROTOCOL_VERSION))
+            self.loop.call_later(HELLO_TIME, self.send_hello)
+
+    def send(self):
+        """Send local inputs now (called from the game thread)"""
+        if self.loop is not None and self.connected.is_set():
+            self.loop.call_soon_threadsafe(self.send_inputs)
+
+    def send_inputs(self):
+        if not self.closed:
+            self.send_packet(self.inputs_packet())
+
+    def timer(self):
+        """Send inputs every tick, so lost packets are sent again"""
+        if self.closed:
+            return
+        if self.connected.is_set():
+            if self.loop.time() - self.last_receive > TIMEOUT:
+                self.error = "connection timed out"
+                self.closed = True
+                return
+            self.send_inputs()
+        self.loop.call_later(TICK, self.timer)
+
+    def receive(self, data, addr):
+        if not data or self.closed:
+            return
+        kind = data[0]
+        if kind == HELLO and self.host is None:
+            if self.peer is None:
+                self.peer = addr
+            if addr != self.peer:
+                return  # a third player
+            version = HELLO_PACKET.unpack_from(data)[1]
+            if version != PROTOCOL_VERSION:
+                self.error = f"protocol version {version} is not supported"
+                self.closed = True
+                return
+            self.send_packet(WELCOME_PACKET.pack(
+                WELCOME, PROTOCOL_VERSION, self.seed, self.delay))
+            self.connect()
+        elif kind == WELCOME and self.host is not None:
+            if self.connected.is_set():
+                return
+            kind, version, seed, delay = WELCOME_PACKET.unpack_from(data)
+            if version != PROTOCOL_VERSION:
+                self.error = f"protocol version {version} is not supported"
+                self.closed = True
+                return
+            self.seed = seed
+            with self.lock:
+                self.reset(delay)
+            self.connect()
+        elif kind == INPUTS and self.connected.is_set():
+            if self.host is None and addr != self.peer:
+                return
+            self.last_receive = self.loop.time()
+            self.receive_inputs(data)
+        elif kind == BYE:
+            self.closed = True
+
+    def connect(self):
+        self.last_receive = self.loop.time()
+        self.connected.set()
+
+    def shutdown(self):
+        if self.transport is not None:
+            if not self.closed:
+                for i in range(3):  # the other player may miss one
+                    self.send_packet(bytes([BYE]))
+            self.transport.close()
+        self.closed = True
+        self.loop.stop()
+
+
+class LatencyProxy(LoopThread):
+    """UDP relay that delays and drops datagrams, to test on localhost
+
+    Datagrams to port are sent to target and the replies back to the
+    sender, each after latency + random jitter sec, and dropped with
+    probability loss."""
+    def __init__(self, port, target, latency=0.04, jitter=0.0, loss=0.0,
+                 seed=0):
+        super().__init__()
+        self.port = port
+        self.target = target
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.client = None  # address of the sender
+        self.dropped = 0
+        self.forwarded = 0
+
+    async def open(self):
+        self.listen, p = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self.from_client),
+            local_addr=("0.0.0.0", self.port))
+        self.upstream, p = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self.from_target),
+            remote_addr=self.target)
+
+    def delay(self, send, data):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        self.loop.call_later(
+            self.latency + self.random.uniform(0, self.jitter), send, data)
+
+    def from_client(self, data, addr):
+        self.client = addr
+        self.delay(self.upstream.sendto, data)
+
+    def from_target(self, data, addr):
+        if self.client is not None:
+            self.delay(lambda data: self.listen.sendto(data, self.client),
+                       data)
+
+    def shutdown(self):
+        self.listen.close()
+        self.upstream.close()
+        self.loop.stop()
+
+
+def script_inputs(rng):
+    """Random inputs of a busy player for tests, in order, with repeated
+    moves like a held key with --arr 0"""
+    inputs = []
+    for player_input, percent in ((engine.UP, 10), (engine.LEFT, 15),
+                                  (engine.RIGHT, 15), (engine.DOWN, 5),
+                                  (engine.HARD_DROP, 1)):
+        if rng.randint(0, 99) < percent:
+            inputs.append(player_input)
+    if rng.randint(0, 99) < 5:
+        inputs += [inputs[0] if inputs else engine.LEFT] * engine.PLWIDTH
+    return inputs
+
+
+def run_test(port, ticks, delay, latency, jitter, loss):
+    """Play a scripted match over a LatencyProxy on localhost
+
+    Returns a report dict; "ok" is True if both sides ended in the same
+    state and played the inputs of each player as given, in order."""
+    host = NetSession(port=port, delay=delay, seed=1)
+    proxy = LatencyProxy(port + 1, ("127.0.0.1", port), latency, jitter,
+                         loss)
+    guest = NetSession("127.0.0.1", port + 1)
+    for loop_thread in (host, proxy, guest):
+        loop_thread.start()
+    sessions = [host, guest]
+    try:
+        if not host.connected.wait(5) or not guest.connected.wait(5):
+            return {"ok": False, "error": "not connected"}
+        matches = [engine.Match(2, seed=session.seed) for session in sessions]
+        rngs = [engine.Rng(session.index + 1) for session in sessions]
+        # Inputs given by each player, and played by each side
+        given = [[[] for tick in range(session.delay)]
+                 for session in sessions]
+        played = [[] for session in sessions]
+        start_time = time.perf_counter()
+        next_time = start_time
+        deadline = start_time + ticks * TICK * 4 + TIMEOUT
+        while min(session.tick for session in sessions) < ticks:
+            if time.perf_counter() > deadline:
+                break
+            for session, match, rng, played_inputs in zip(
+                    sessions, matches, rngs, played):
+                if session.local_tick < ticks:
+                    inputs = script_inputs(rng)
+                    if session.add_local(inputs):
+                        given[session.index].append(inputs)
+                played_inputs += session.step(match)
+            next_time += TICK
+            time.sleep(max(0, next_time - time.perf_counter()))
+        elapsed = time.perf_counter() - start_time
+        hashes = [state_hash(match) for match in matches]
+        inputs_ok = all([tick_inputs[player] for tick_inputs in
+                         played_inputs] == given[player][:ticks]
+                        for played_inputs in played for player in (0, 1))
+        return {
+            "ok": hashes[0] == hashes[1] and host.desync is None and
+            guest.desync is None and host.tick == guest.tick == ticks and
+            inputs_ok,
+            "inputs_ok": inputs_ok,
+            "ticks": [session.tick for session in sessions],
+            "ticks_per_sec": min(host.tick, guest.tick) / elapsed,
+            "stalls": [session.stalls for session in sessions],
+            "desync": [session.desync for session in sessions],
+            "dropped": proxy.dropped,
+            "forwarded": proxy.forwarded,
+            }
+    finally:
+        for loop_thread in (guest, proxy, host):
+            loop_thread.close()
+
+
+def parse_address(address, default_port=DEFAULT_PORT):
+    """"host:port" or "host" -> (host, port)"""
+    host, sep, port = address.rpartition(":")
+    if not sep:
+        return address, default_port
+    return host, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Zen Tetris network battle tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    test = commands.add_parser(
+        "test", help="play a scripted match on localhost through a proxy")
+    test.add_argument("--port", type=int, default=DEFAULT_PORT + 100)
+    test.add_argument("--ticks", type=int, default=600)
+    test.add_argument("--delay", type=int, default=DEFAULT_DELAY,
+                      help=f"input delay in ticks (default: {DEFAULT_DELAY})")
+    proxy = commands.add_parser(
+        "proxy", help="relay UDP packets with latency and packet loss")
+    proxy.add_argument("port", type=int, help="port to listen on")
+    proxy.add_argument("target", help="HOST:PORT to relay to")
+    for command in (test, proxy):
+        command.add_argument("--latency", type=float, default=0.04,
+                             help="one-way latency in sec (default: 0.04)")
+        command.add_argument("--jitter", type=float, default=0.01,
+                             help="random extra latency up to this sec")
+        command.add_argument("--loss", type=float, default=0.05,
+                             help="packet loss ratio (default: 0.05)")
+    args = parser.parse_args(argv)
+
+    if args.command == "proxy":
+        relay = LatencyProxy(args.port, parse_address(args.target),
+                             args.latency, args.jitter, args.loss)
+        relay.start()
+        print(f"Relaying port {args.port} to {args.target}, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            relay.close()
+        return 0
+    report = run_test(args.port, args.ticks, args.delay, args.latency,
+                      args.jitter, args.loss)
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.1f}"
+        print(f"{key}: {value}")
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
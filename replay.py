@@ -0,0 +1,355 @@
+# Zen Tetris replays - record the inputs of a match and replay them
+# headless at maximum speed to check that the game plays the same
+# Replays are saved as JSON (*.json) or in a compact binary format with
+# keyframes, which viewers can seek in without reading the whole file.
+
+import argparse
+import bisect
+import collections
+import json
+import mmap
+import struct
+import time
+
+import engine
+
+REPLAY_VERSION = 4
+
+# Binary replay file:
+#   HEADER, input stream, keyframes (engine.Match.snapshot()), dt table
+#   (doubles), index (INDEX_ENTRY per keyframe), TRAILER
+# Input stream, one record per tick or run of ticks:
+#   0x00-0x7F: b+1 ticks without inputs, with dt table[0]
+#   0x80 | dt index, num of inputs n, n bytes of player << 3 | input
+#   (index in engine.INPUT_ORDER)
+# Runs never span a keyframe tick, so playing can start at the stream
+# offset of any keyframe.  The last keyframe is the state at the end.
+MAGIC = b"ZTRP"
+BINARY_VERSION = 2
+BINARY_EXTENSION = ".ztr"
+KEYFRAME_INTERVAL = 600  # ticks (5 sec of engine.TICK)
+HEADER = struct.Struct("<4sHB?BqII")  # magic, version, players, bitboard,
+# targeting (index in engine.TARGETING), seed, ticks, keyframe interval
+INDEX_ENTRY = struct.Struct("<IQQI")  # tick, stream offset, keyframe
+# offset, keyframe length
+TRAILER = struct.Struct("<QIQI4s")  # dt table offset, num of dts, index
+# offset, num of keyframes, magic
+MAX_RUN = 0x80
+MAX_DTS = 0x80
+
+
+def match_result(match):
+    """Final state of each player, compared when verifying a replay"""
+    result = []
+    for game in match.games:
+        result.append({
+            "score": game.score,
+            "level": game.level,
+            "game_over": game.game_over,
+            "game_area": [area_line[:] for area_line in game.game_area],
+            })
+    return result
+
+
+class Recorder():
+    """Records the settings of a match, the dt of each tick and player
+    inputs"""
+    def __init__(self, match):
+        self.match = match
+        self.dts = []  # dt of each tick
+        self.inputs = []  # [tick, player index, input]
+
+    def record(self, inputs, dt):
+        """Record inputs (one collection per player) and dt of a tick"""
+        tick = len(self.dts)
+        self.dts.append(dt)
+        for player, player_inputs in enumerate(inputs):
+            for player_input in engine.ordered_inputs(player_inputs):
+                self.inputs.append([tick, player, player_input])
+
+    def data(self):
+        return {
+            "version": REPLAY_VERSION,
+            "seed": self.match.seed,
+            "players": len(self.match.games),
+            "bitboard": self.match.bitboard,
+            "targeting": self.match.targeting,
+            "dts": self.dts,
+            "inputs": self.inputs,
+            "result": match_result(self.match),
+            }
+
+    def save(self, file_name):
+        """Save as JSON if file_name ends with .json, else binary"""
+        if file_name.endswith(".json"):
+            with open(file_name, "w") as f:
+                json.dump(self.data(), f)
+        else:
+            write_binary(self.data(), file_name)
+
+
+def is_binary(file_name):
+    with open(file_name, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load(file_name):
+    with open(file_name) as f:
+        data = json.load(f)
+    if data.get("version") != REPLAY_VERSION:
+        raise ValueError(f"{file_name}: unsupported replay version "
+                         f"{data.get('version')}")
+    return data
+
+
+def new_match(data):
+    return engine.Match(data["players"], data["bitboard"], data["seed"],
+                        data["targeting"])
+
+
+def ticks(data):
+    """Yield (dt, inputs of each player) of every recorded tick"""
+    inputs = data["inputs"]
+    next_input = 0
+    for tick, dt in enumerate(data["dts"]):
+        tick_inputs = [[] for i in range(data["players"])]
+        while next_input < len(inputs) and inputs[next_input][0] == tick:
+            player, player_input = inputs[next_input][1:]
+            tick_inputs[player].append(player_input)
+            next_input += 1
+        yield dt, tick_inputs
+
+
+def replay(data):
+    """Play a recorded match again and return it"""
+    match = new_match(data)
+    for dt, tick_inputs in ticks(data):
+        match.step(tick_inputs, dt)
+    return match
+
+
+def write_binary(data, file_name, keyframe_interval=KEYFRAME_INTERVAL):
+    """Save recorded data (see Recorder.data()) as a binary replay
+
+    The match is played again to take the keyframes, and it must end
+    the same as recorded."""
+    match = new_match(data)
+    # dt table, dts[0] is the most common one
+    dts = [dt for dt, count in collections.Counter(data["dts"]).most_common()]
+    if len(dts) > MAX_DTS:
+        raise ValueError(f"more than {MAX_DTS} different dt")
+    dt_index = {dt: i for i, dt in enumerate(dts)}
+    stream = bytearray()
+    keyframes = []  # (tick, stream offset, snapshot)
+    run = 0
+
+    def end_run():
+        if run:
+            stream.append(run - 1)
+        return 0
+
+    for tick, (dt, tick_inputs) in enumerate(ticks(data)):
+        if tick % keyframe_interval == 0:
+            run = end_run()
+            keyframes.append((tick, len(stream), match.snapshot()))
+        codes = bytes(player << 3 | engine.INPUT_ORDER.index(player_input)
+                      for player, player_inputs in enumerate(tick_inputs)
+                      for player_input in player_inputs)
+        if not codes and dt_index[dt] == 0:
+            run += 1
+            if run == MAX_RUN:
+                run = end_run()
+        else:
+            run = end_run()
+            stream += bytes([0x80 | dt_index[dt], len(codes)]) + codes
+        match.step(tick_inputs, dt)
+    run = end_run()
+    if "result" in data and match_result(match) != data["result"]:
+        raise ValueError("the match doesn't replay as recorded")
+    keyframes.append((len(data["dts"]), len(stream), match.snapshot()))
+
+    with open(file_name, "wb") as f:
+        f.write(HEADER.pack(
+            MAGIC, BINARY_VERSION, data["players"], data["bitboard"],
+            list(engine.TARGETING).index(data["targeting"]), data["seed"],
+            len(data["dts"]), keyframe_interval))
+        stream_offset = f.tell()
+        f.write(stream)
+        index = []
+        for tick, offset, snapshot in keyframes:
+            index.append(INDEX_ENTRY.pack(tick, stream_offset + offset,
+                                          f.tell(), len(snapshot)))
+            f.write(snapshot)
+        dt_offset = f.tell()
+        f.write(struct.pack(f"<{len(dts)}d", *dts))
+        index_offset = f.tell()
+        f.write(b"".join(index))
+        f.write(TRAILER.pack(dt_offset, len(dts), index_offset,
+                             len(keyframes), MAGIC))
+
+
+class ReplayFile():
+    """Binary replay, memory-mapped
+
+    Only the header, dt table and index are read on open; seek() reads
+    the nearest keyframe and the inputs from there on, so seeking takes
+    about the same time anywhere in a long file."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.players, self.bitboard, targeting, self.seed,
+         self.ticks, self.keyframe_interval) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != BINARY_VERSION:
+            self.close()
+            raise ValueError(f"{file_name}: not a binary replay of "
+                             f"version {BINARY_VERSION}")
+        self.targeting = list(engine.TARGETING)[targeting]
+        (dt_offset, num_dts, index_offset, num_keyframes,
+         magic) = TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+        self.dts = struct.unpack_from(f"<{num_dts}d", self.map, dt_offset)
+        self.index = [INDEX_ENTRY.unpack_from(self.map, index_offset +
+                                              i * INDEX_ENTRY.size)
+                      for i in range(num_keyframes)]
+        self.keyframe_ticks = [entry[0] for entry in self.index]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def new_match(self):
+        return engine.Match(self.players, self.bitboard, self.seed,
+                            self.targeting)
+
+    def keyframe(self, i):
+        tick, stream_offset, offset, length = self.index[i]
+        return self.map[offset:offset + length]
+
+    def final_state(self):
+        """Snapshot of the match at the end"""
+        return self.keyframe(len(self.index) - 1)
+
+    def frames(self, offset, count):
+        """Yield (dt, inputs of each player) of count ticks from the
+        stream offset of a keyframe"""
+        data = self.map
+        dts = self.dts
+        while count > 0:
+            record = data[offset]
+            if record < 0x80:
+                run = min(record + 1, count)
+                offset += 1
+                for i in range(run):
+                    yield dts[0], [[] for j in range(self.players)]
+                count -= run
+                continue
+            num_inputs = data[offset + 1]
+            tick_inputs = [[] for j in range(self.players)]
+            for code in data[offset + 2:offset + 2 + num_inputs]:
+                tick_inputs[code >> 3].append(engine.INPUT_ORDER[code & 7])
+            offset += 2 + num_inputs
+            yield dts[record & 0x7F], tick_inputs
+            count -= 1
+
+    def seek(self, tick, match=None):
+        """Set match (a new one if None) to the state at the start of tick
+
+        Returns (match, frames): frames yields (dt, inputs) of the ticks
+        from tick on, to continue playing."""
+        tick = max(0, min(tick, self.ticks))
+        i = bisect.bisect_right(self.keyframe_ticks, tick) - 1
+        keyframe_tick, stream_offset = self.index[i][:2]
+        if match is None:
+            match = self.new_match()
+        match.restore(self.keyframe(i))
+        frames = self.frames(stream_offset, self.ticks - keyframe_tick)
+        for i in range(tick - keyframe_tick):
+            dt, tick_inputs = next(frames)
+            match.step(tick_inputs, dt)
+        return match, frames
+
+
+def verify(file_name):
+    """Replay a file and compare the result with the recorded one
+
+    Returns (ok, message)."""
+    start_time = time.perf_counter()
+    if is_binary(file_name):
+        with ReplayFile(file_name) as replay_file:
+            match, frames = replay_file.seek(0)
+            for dt, tick_inputs in frames:
+                match.step(tick_inputs, dt)
+            num_ticks = replay_file.ticks
+            expected = replay_file.new_match()
+            expected.restore(replay_file.final_state())
+        data = {"result": match_result(expected)}
+    else:
+        data = load(file_name)
+        match = replay(data)
+        num_ticks = len(data["dts"])
+    elapsed = time.perf_counter() - start_time
+    speed = f"{num_ticks} ticks in {elapsed:.3f} sec " + \
+        f"({num_ticks / max(elapsed, 1e-9):.0f} ticks/sec)"
+    result = match_result(match)
+    if result == data["result"]:
+        return True, f"{file_name}: OK, {speed}"
+    differences = []
+    for player, (got, expected) in enumerate(zip(result, data["result"])):
+        for key in expected:
+            if got[key] != expected[key]:
+                differences.append(f"player {player + 1} {key}")
+    return False, f"{file_name}: MISMATCH ({', '.join(differences)}), {speed}"
+
+
+def seek_report(file_name, tick):
+    """Seek in a binary replay and describe the state at tick"""
+    start_time = time.perf_counter()
+    with ReplayFile(file_name) as replay_file:
+        match, frames = replay_file.seek(tick)
+        tick = max(0, min(tick, replay_file.ticks))
+    elapsed = time.perf_counter() - start_time
+    players = ", ".join(
+        f"player {i + 1}: score {game.score} level {game.level}" +
+        (" game over" if game.game_over else "")
+        for i, game in enumerate(match.games))
+    return f"{file_name} at tick {tick} ({elapsed * 1000:.1f} msec): " + \
+        players
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay Zen Tetris recordings and verify the results")
+    parser.add_argument("files", nargs="+", metavar="FILE")
+    parser.add_argument("--seek", type=int, metavar="TICK",
+                        help="show the state at TICK of binary replays")
+    parser.add_argument("--convert", action="store_true",
+                        help=f"save JSON replays as binary ({MAGIC.decode()}"
+                        f") *{BINARY_EXTENSION} files")
+    args = parser.parse_args()
+    if args.seek is not None:
+        for file_name in args.files:
+            print(seek_report(file_name, args.seek))
+        return 0
+    if args.convert:
+        for file_name in args.files:
+            out_name = file_name.rsplit(".", 1)[0] + BINARY_EXTENSION
+            write_binary(load(file_name), out_name)
+            print(f"{file_name} -> {out_name}")
+        return 0
+    failed = 0
+    for file_name in args.files:
+        ok, message = verify(file_name)
+        print(message)
+        if not ok:
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,483 @@
+# Zen Tetris spectators - broadcast live games to many viewers over TCP
+# The game publishes a snapshot of every player after each update; each
+# viewer gets a keyframe first and then deltas from the last state it
+# received.  A viewer that can't keep up is skipped until its socket
+# buffer drains, and then gets one delta covering everything it missed
+# (right away, even if the games don't change any more).
+#
+#   python spectate.py test --clients 200  # local load test
+
+import argparse
+import asyncio
+import socket
+import struct
+import threading
+import time
+
+import engine
+from engine import PLWIDTH, PLHEIGHT
+from netplay import LoopThread
+
+DEFAULT_PORT = 5100
+MAX_BUFFER = 64 * 1024  # bytes queued for a viewer before it's skipped
+
+# Messages (each one prefixed by its length, "!H")
+KEYFRAME = 1  # type, tick, num of players, then per player: state, cells
+DELTA = 2  # type, tick, num of players, then a bit mask of changed
+# players (so up to 8 players), and per changed player: state, num of
+# changed cells, and (cell index, color) pairs.  cell index is
+# y * PLWIDTH + x.
+
+LENGTH = struct.Struct("!H")
+MESSAGE = struct.Struct("!BIB")
+MASK = struct.Struct("!B")
+# score, level, flags, shape, shape_cnt, x, y, delete animation index,
+# delete animation lines (bit y set: line y)
+PLAYER_STATE = struct.Struct("!IBBBBbbBI")
+COUNT = struct.Struct("!B")
+GAME_OVER_FLAG = 1
+DELETE_ANIMATION_FLAG = 2
+
+
+def snapshot(match):
+    """Return the state of each player as (state tuple, cells bytes)"""
+    players = []
+    for game in match.games:
+        flags = 0
+        if game.game_over:
+            flags |= GAME_OVER_FLAG
+        if game.delete_animation:
+            flags |= DELETE_ANIMATION_FLAG
+        lines = 0
+        for y in game.delete_animation_lines:
+            lines |= 1 << y
+        state = (game.score & 0xFFFFFFFF, game.level, flags, game.shape,
+                 game.shape_cnt, game.x, game.y,
+                 game.delete_animation_index, lines)
+        cells = bytes(color for area_line in game.game_area
+                      for color in area_line)
+        players.append((state, cells))
+    return tuple(players)
+
+
+def encode_keyframe(tick, players):
+    parts = [MESSAGE.pack(KEYFRAME, tick, len(players))]
+    for state, cells in players:
+        parts.append(PLAYER_STATE.pack(*state))
+        parts.append(cells)
+    message = b"".join(parts)
+    return LENGTH.pack(len(message)) + message
+
+
+def encode_delta(tick, old, players):
+    """Delta message from old players to players, or a keyframe if the
+    num of players changed"""
+    if len(old) != len(players):
+        return encode_keyframe(tick, players)
+    mask = 0
+    parts = []
+    for i, ((old_state, old_cells), (state, cells)) in \
+            enumerate(zip(old, players)):
+        if old_state == state and old_cells == cells:
+            continue
+        mask |= 1 << i
+        parts.append(PLAYER_STATE.pack(*state))
+        changed = []
+        if old_cells != cells:
+            for index, (old_color, color) in \
+                    enumerate(zip(old_cells, cells)):
+                if old_color != color:
+                    changed.append(index)
+                    changed.append(color)
+        parts.append(COUNT.pack(len(changed) // 2))
+        parts.append(bytes(changed))
+    message = MESSAGE.pack(DELTA, tick, len(players)) + MASK.pack(mask) + \
+        b"".join(parts)
+    return LENGTH.pack(len(message)) + message
+
+
+def decode(message, players):
+    """Apply a message (without its length) to players, a list of
+    [state tuple, cells bytearray]; returns (tick, players)"""
+    kind, tick, num_players = MESSAGE.unpack_from(message)
+    offset = MESSAGE.size
+    if kind == KEYFRAME:
+        players = []
+        for i in range(num_players):
+            state = PLAYER_STATE.unpack_from(message, offset)
+            offset += PLAYER_STATE.size
+            cells = bytearray(message[offset:offset + PLWIDTH * PLHEIGHT])
+            offset += PLWIDTH * PLHEIGHT
+            players.append([state, cells])
+        return tick, players
+    if kind != DELTA:
+        raise ValueError(f"unknown message type {kind}")
+    mask = MASK.unpack_from(message, offset)[0]
+    offset += MASK.size
+    for i in range(num_players):
+        if not mask & (1 << i):
+            continue
+        players[i][0] = PLAYER_STATE.unpack_from(message, offset)
+        offset += PLAYER_STATE.size
+        count = COUNT.unpack_from(message, offset)[0]
+        offset += COUNT.size
+        cells = players[i][1]
+        for j in range(offset, offset + count * 2, 2):
+            cells[message[j]] = message[j + 1]
+        offset += count * 2
+    return tick, players
+
+
+class BroadcastServer(LoopThread):
+    """Sends published snapshots to every connected viewer
+
+    Call publish(match) from the game loop after each update; it only
+    takes a snapshot and hands it to the server thread."""
+    def __init__(self, port=DEFAULT_PORT, max_buffer=MAX_BUFFER):
+        super().__init__()
+        self.port = port
+        self.max_buffer = max_buffer
+        self.clients = {}  # writer -> tick of the state it has (None: none)
+        self.catch_ups = {}  # writer -> task waiting for its buffer to drain
+        self.states = {}  # tick -> snapshot, for the ticks clients have
+        self.tick = 0
+        self.state = None
+        self.coalesced = 0  # updates skipped for slow viewers
+        self.sent_bytes = 0
+
+    async def open(self):
+        self.server = await asyncio.start_server(self.on_connect,
+                                                 port=self.port)
+
+    async def on_connect(self, reader, writer):
+        # Writing pauses (and drain() waits) above max_buffer
+        writer.transport.set_write_buffer_limits(high=self.max_buffer)
+        self.clients[writer] = None
+        if self.state is not None:
+            self.send(writer, {})
+        try:
+            await reader.read()  # viewers don't send anything
+        except ConnectionError:
+            pass
+        finally:
+            del self.clients[writer]
+            writer.close()
+
+    def publish(self, match):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast, snapshot(match))
+
+    def broadcast(self, state):
+        if state == self.state:
+            return
+        self.tick += 1
+        self.state = state
+        self.states[self.tick] = state
+        messages = {}  # tick -> message, shared by viewers at the same tick
+        for writer in list(self.clients):
+            self.send(writer, messages)
+        # Forget states no viewer has any more
+        ticks = set(self.clients.values())
+        for tick in list(self.states):
+            if tick not in ticks and tick != self.tick:
+                del self.states[tick]
+
+    def send(self, writer, messages):
+        tick = self.clients[writer]
+        if tick == self.tick:
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.coalesced += 1  # the catch-up delta covers this one
+            if writer not in self.catch_ups:
+                self.catch_ups[writer] = self.loop.create_task(
+                    self.catch_up(writer))
+            return
+        message = messages.get(tick)
+        if message is None:
+            if tick is None:
+                message = encode_keyframe(self.tick, self.state)
+            else:
+                message = encode_delta(self.tick, self.states[tick],
+                                       self.state)
+            messages[tick] = message
+        writer.write(message)
+        self.sent_bytes += len(message)
+        self.clients[writer] = self.tick
+
+    async def catch_up(self, writer):
+        """Send a skipped viewer what it missed once its buffer drained"""
+        try:
+            await writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            del self.catch_ups[writer]
+        if writer in self.clients:
+            self.send(writer, {})
+
+    def shutdown(self):
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+        self.loop.stop()
+
+
+class RemoteGame():
+    """Read-only stand-in for engine.Game showing a broadcast player
+
+    Has the attributes tet.Player draws and emits MOVE, BOARD and
+    GAME_OVER when they change."""
+    def __init__(self):
+        self.listeners = []
+        self.score = 0
+        self.level = 0
+        self.shape = 0
+        self.shape_cnt = 0
+        self.x = 0
+        self.y = 0
+        self.game_over = False
+        self.delete_animation = False
+        self.delete_animation_index = 0
+        self.delete_animation_lines = []
+        self.game_area = [[0] * PLWIDTH for y in range(PLHEIGHT)]
+        self.cells = bytes(PLWIDTH * PLHEIGHT)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, event, data=None):
+        for listener in self.listeners:
+            listener(self, event, data)
+
+    def set_state(self, state, cells):
+        (score, level, flags, shape, shape_cnt, x, y, index,
+         lines) = state
+        game_over = bool(flags & GAME_OVER_FLAG)
+        delete_animation = bool(flags & DELETE_ANIMATION_FLAG)
+        moved = (shape, shape_cnt, x, y) != \
+            (self.shape, self.shape_cnt, self.x, self.y)
+        board_changed = cells != self.cells or \
+            delete_animation != self.delete_animation or \
+            index != self.delete_animation_index
+        self.score = score
+        self.level = level
+        self.shape = shape
+        self.shape_cnt = shape_cnt
+        self.x = x
+        self.y = y
+        self.delete_animation = delete_animation
+        self.delete_animation_index = index
+        self.delete_animation_lines = [line for line in range(PLHEIGHT)
+                                       if lines & (1 << line)]
+        if cells != self.cells:
+            self.cells = bytes(cells)
+            for line in range(PLHEIGHT):
+                self.game_area[line][:] = \
+                    self.cells[line * PLWIDTH:(line + 1) * PLWIDTH]
+        if game_over and not self.game_over:
+            self.game_over = True
+            self.emit(engine.GAME_OVER)
+        if moved:
+            self.emit(engine.MOVE)
+        if board_changed:
+            self.emit(engine.BOARD)
+
+
+class RemoteMatch():
+    """Read-only stand-in for engine.Match fed by a SpectatorClient"""
+    def __init__(self, num_players):
+        self.games = [RemoteGame() for i in range(num_players)]
+
+    @property
+    def over(self):
+        for game in self.games:
+            if not game.game_over:
+                return False
+        return True
+
+    def set_state(self, players):
+        for game, (state, cells) in zip(self.games, players):
+            game.set_state(state, cells)
+
+
+class SpectatorClient(LoopThread):
+    """Receives a broadcast in a background thread
+
+    poll() returns the latest players (list of [state, cells]) once per
+    update received, or None; intermediate updates are skipped."""
+    def __init__(self, host="localhost", port=DEFAULT_PORT):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.players = None
+        self.tick = 0
+        self.updated = False
+        self.received = threading.Event()  # set on the first keyframe
+        self.closed = False
+        self.error = None
+        self.writer = None
+
+    async def open(self):
+        try:
+            reader, self.writer = await asyncio.open_connection(self.host,
+                                                                self.port)
+        except OSError as e:
+            self.error = str(e)
+            self.closed = True
+            return
+        self.loop.create_task(self.receive(reader))
+
+    async def receive(self, reader):
+        players = None
+        try:
+            while True:
+                size = LENGTH.unpack(await reader.readexactly(LENGTH.size))[0]
+                message = await reader.readexactly(size)
+                tick, players = decode(message, players)
+                with self.lock:
+                    self.tick = tick
+                    self.players = [[state, bytes(cells)]
+                                    for state, cells in players]
+                    self.updated = True
+                self.received.set()
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.error = str(e) or "disconnected"
+        self.closed = True
+
+    def poll(self):
+        with self.lock:
+            if not self.updated:
+                return None
+            self.updated = False
+            return self.players
+
+    def shutdown(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.closed = True
+        self.loop.stop()
+
+
+def run_test(port, num_clients, seconds, slow, max_buffer=MAX_BUFFER,
+             num_players=2):
+    """Broadcast a CPU battle to num_clients viewers on localhost
+
+    slow viewers have small socket buffers and stop reading until the
+    battle is over, so they are skipped and must catch up after the last
+    update.  Returns a report dict; "ok" is True if every viewer ends
+    with the server's state and slow viewers were skipped."""
+    import bot
+    server = BroadcastServer(port, max_buffer)
+    server.start()
+    match = engine.Match(num_players, seed=1)
+    bots = [bot.BotController(game, "normal", worker=None)
+            for game in match.games]
+    results = {}
+    slow_ports = set()  # local ports of the slow viewers
+
+    async def viewer(i):
+        sock = None
+        if i < slow:
+            # Little kernel buffering, so the server's buffer fills up
+            # while the viewer doesn't read
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(
+                sock, ("127.0.0.1", port))
+            # (and the reader stops reading from it above limit)
+            reader, writer = await asyncio.open_connection(sock=sock,
+                                                           limit=256)
+            slow_ports.add(sock.getsockname()[1])
+        else:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        players = None
+        tick = 0
+        received = 0
+        deadline = time.perf_counter() + 2 * seconds + 2
+        try:
+            while time.perf_counter() < deadline:
+                if i < slow and received == 10:
+                    await asyncio.sleep(seconds + 0.5)  # stop reading
+                size = LENGTH.unpack(await asyncio.wait_for(
+                    reader.readexactly(LENGTH.size), 1.0))[0]
+                message = await reader.readexactly(size)
+                tick, players = decode(message, players)
+                received += 1
+        except asyncio.TimeoutError:
+            pass  # no more updates
+        writer.close()
+        results[i] = (tick, players, received)
+
+    async def viewers():
+        await asyncio.gather(*[viewer(i) for i in range(num_clients)])
+
+    thread = threading.Thread(target=asyncio.run, args=(viewers(),))
+    thread.start()
+    time.sleep(0.5)  # let the viewers connect
+    for writer in list(server.clients):
+        if writer.get_extra_info("peername")[1] in slow_ports:
+            writer.get_extra_info("socket").setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, 1024)
+    start_time = time.perf_counter()
+    next_time = start_time
+    publish_time = 0
+    ticks = 0
+    while time.perf_counter() - start_time < seconds:
+        match.step([player_bot.inputs(1/60) for player_bot in bots], 1/60)
+        now = time.perf_counter()
+        server.publish(match)
+        publish_time += time.perf_counter() - now
+        ticks += 1
+        next_time += 1/60
+        time.sleep(max(0, next_time - time.perf_counter()))
+    thread.join()
+    server.close()
+    final = [[state, bytearray(cells)] for state, cells in snapshot(match)]
+    ok = len(results) == num_clients and all(
+        players == final and tick == server.tick
+        for tick, players, received in results.values()) and \
+        (server.coalesced > 0 or slow == 0)
+    received = sum(result[2] for result in results.values())
+    return {
+        "ok": ok,
+        "viewers": len(results),
+        "updates": server.tick,
+        "messages_per_viewer": received / max(len(results), 1),
+        "bytes_per_viewer_sec": server.sent_bytes / max(len(results), 1) /
+        seconds,
+        "coalesced": server.coalesced,
+        "publish_usec": publish_time / max(ticks, 1) * 1e6,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Zen Tetris spectator broadcast tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    test = commands.add_parser(
+        "test", help="broadcast a CPU battle to many local viewers")
+    test.add_argument("--port", type=int, default=DEFAULT_PORT + 100)
+    test.add_argument("--clients", type=int, default=200)
+    test.add_argument("--seconds", type=float, default=5)
+    test.add_argument("--players", type=int, default=4,
+                      help="CPU players of the battle (default: 4)")
+    test.add_argument("--slow", type=int, default=10,
+                      help="viewers that stop reading until the battle "
+                      "is over")
+    test.add_argument("--max-buffer", type=int, default=4096,
+                      help="bytes queued for a viewer before it's skipped "
+                      f"(default: 4096, in the game: {MAX_BUFFER})")
+    args = parser.parse_args(argv)
+    report = run_test(args.port, args.clients, args.seconds, args.slow,
+                      args.max_buffer, args.players)
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.1f}"
+        print(f"{key}: {value}")
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
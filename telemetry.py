@@ -0,0 +1,264 @@
+# Zen Tetris frame telemetry - per-phase frame times in a ring buffer
+
+from array import array
+import collections
+import csv
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+PERCENTILES = [50, 95, 99]
+
+
+class FrameTelemetry():
+    """Records the time of each frame phase for the last size frames
+
+    Call add(phase, seconds) while a frame runs (a phase can be added more
+    than once per frame) and end_frame(seconds) once the frame is done.
+    Memory is allocated per phase up front, so recording doesn't create
+    objects."""
+    def __init__(self, size=3600):
+        self.size = size
+        self.frames = 0  # num of frames recorded so far
+        self.loop = array('d', [0.0] * size)  # whole frame (loop) time
+        self.phases = {}  # phase -> array of times
+        self.phase_start = {}  # phase -> frame number it was first seen
+        self.current = {}  # phase -> time within the current frame
+        self.gc_time = 0.0  # GC pauses within the current frame
+        self.cpu = CpuMeter()  # CPU usage by frame rate state
+
+    def add(self, phase, seconds):
+        self.current[phase] = self.current.get(phase, 0.0) + seconds
+
+    def add_gc(self, seconds):
+        """Add a GC pause to the "gc" phase
+
+        A collection can run anywhere, also in end_frame() while it
+        iterates current, so pauses are only summed here and moved to
+        current when the frame ends."""
+        self.gc_time += seconds
+
+    def end_frame(self, seconds):
+        gc_time = self.gc_time
+        if gc_time:
+            self.gc_time -= gc_time  # keeps a pause added meanwhile
+            self.add("gc", gc_time)
+        index = self.frames % self.size
+        self.loop[index] = seconds
+        for phase, times in self.phases.items():
+            times[index] = self.current.pop(phase, 0.0)
+        for phase, phase_time in self.current.items():
+            # First time this phase is seen
+            self.phases[phase] = array('d', [0.0] * self.size)
+            self.phases[phase][index] = phase_time
+            self.phase_start[phase] = self.frames
+        self.current.clear()
+        self.frames += 1
+
+    def values(self, phase=None):
+        """Recorded times of a phase (None: loop time), oldest first"""
+        if phase is None:
+            times = self.loop
+            start = 0
+        else:
+            times = self.phases[phase]
+            start = self.phase_start[phase]
+        count = min(self.frames - start, self.size)
+        end = self.frames % self.size
+        if count < self.size:
+            begin = (end - count) % self.size
+            if begin < end or count == 0:
+                return list(times[begin:end])
+            return list(times[begin:]) + list(times[:end])
+        return list(times[end:]) + list(times[:end])
+
+    def stats(self, phase=None):
+        """Return {"p50", "p95", "p99", "max"} of a phase in seconds"""
+        values = sorted(self.values(phase))
+        result = {}
+        for percentile in PERCENTILES:
+            if values:
+                index = min(len(values) - 1,
+                            int(len(values) * percentile / 100))
+                result[f"p{percentile}"] = values[index]
+            else:
+                result[f"p{percentile}"] = 0.0
+        result["max"] = values[-1] if values else 0.0
+        return result
+
+    def summary(self):
+        """Stats of the loop time and of every phase"""
+        summary = {"loop": self.stats()}
+        for phase in self.phases:
+            summary[phase] = self.stats(phase)
+        return summary
+
+    def dump_json(self, file_name):
+        data = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "frames": self.frames,
+            "summary": self.summary(),
+            "cpu": self.cpu.summary(),
+            "loop": self.values(),
+            "phases": {phase: self.values(phase) for phase in self.phases},
+            }
+        with open(file_name, "w") as f:
+            json.dump(data, f)
+
+    def dump_csv(self, file_name):
+        """One line per frame; phases not recorded yet are left empty"""
+        loop = self.values()
+        first_frame = self.frames - len(loop)
+        columns = []
+        for phase in self.phases:
+            values = self.values(phase)
+            columns.append([None] * (len(loop) - len(values)) + values)
+        with open(file_name, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "loop"] + list(self.phases))
+            for i, loop_time in enumerate(loop):
+                writer.writerow([first_frame + i, loop_time] +
+                                [column[i] for column in columns])
+
+    def dump(self, prefix):
+        """Write prefix.json and prefix.csv"""
+        self.dump_json(prefix + ".json")
+        self.dump_csv(prefix + ".csv")
+
+
+class CpuMeter():
+    """CPU time of this process per wall clock time, by state
+
+    Call update(state) now and then; the time since the last call is
+    counted to state.  CPU time is that of all threads, but not of child
+    processes."""
+    def __init__(self):
+        self.wall = {}  # state -> sec
+        self.cpu = {}  # state -> CPU sec
+        self.last = None  # (wall, CPU) time of the last update
+
+    def update(self, state):
+        now = (time.perf_counter(), time.process_time())
+        if self.last is not None:
+            self.wall[state] = self.wall.get(state, 0.0) + now[0] - \
+                self.last[0]
+            self.cpu[state] = self.cpu.get(state, 0.0) + now[1] - \
+                self.last[1]
+        self.last = now
+
+    def usage(self):
+        """Return {state: CPU usage} (1.0: one core busy all the time)"""
+        return {state: self.cpu[state] / wall
+                for state, wall in self.wall.items() if wall > 0}
+
+    def summary(self):
+        usage = self.usage()
+        return {state: {"seconds": self.wall[state], "usage": usage[state]}
+                for state in usage}
+
+
+class GcMonitor():
+    """Logs every garbage collection with its duration and the frame it
+    ran in (the frame telemetry is recording)
+
+    The time of collections is also added to the telemetry as the "gc"
+    phase, so it shows in the frame time percentiles."""
+    def __init__(self, telemetry, size=1000):
+        self.telemetry = telemetry
+        # (frame, generation, seconds, objects collected), newest last
+        self.pauses = collections.deque(maxlen=size)
+        self.count = 0  # collections so far (also those not in pauses)
+        self.max = 0.0  # longest pause in sec
+        self.start_time = None
+
+    def start(self):
+        gc.callbacks.append(self.callback)
+
+    def stop(self):
+        if self.callback in gc.callbacks:
+            gc.callbacks.remove(self.callback)
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.start_time = time.perf_counter()
+            return
+        if self.start_time is None:
+            return  # started before start()
+        seconds = time.perf_counter() - self.start_time
+        self.start_time = None
+        self.pauses.append((self.telemetry.frames, info["generation"],
+                            seconds, info["collected"]))
+        self.count += 1
+        self.max = max(self.max, seconds)
+        self.telemetry.add_gc(seconds)
+
+    def dump_csv(self, file_name):
+        with open(file_name, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "generation", "seconds", "collected"])
+            writer.writerows(self.pauses)
+
+
+class AllocationTracker():
+    """Counts memory blocks allocated per frame by call site (tracemalloc)
+
+    A snapshot is taken at the end of every interval frames and compared
+    with the one before, so what is seen is what the frames left
+    allocated (new sprites, lists kept in the game state, ...); objects
+    created and freed within a frame cancel out.  Tracing slows the game
+    down a lot, so use it to find allocations, not to time frames."""
+    def __init__(self, interval=1, depth=1):
+        self.interval = interval
+        self.depth = depth  # stack frames per call site
+        self.frames = 0
+        self.sites = {}  # traceback -> [blocks, bytes] allocated
+        self.previous = None
+
+    def start(self):
+        tracemalloc.start(self.depth)
+        self.previous = self.take_snapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+    def take_snapshot(self):
+        # Leave out what tracing itself allocates
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            ])
+
+    def end_frame(self):
+        self.frames += 1
+        if self.previous is None or self.frames % self.interval:
+            return
+        snapshot = self.take_snapshot()
+        key_type = "traceback" if self.depth > 1 else "lineno"
+        for stat in snapshot.compare_to(self.previous, key_type):
+            if stat.count_diff > 0:
+                site = self.sites.setdefault(stat.traceback, [0, 0])
+                site[0] += stat.count_diff
+                site[1] += max(stat.size_diff, 0)
+        self.previous = snapshot
+
+    def top(self, limit=10):
+        """Return [(blocks per frame, bytes per frame, site)], most
+        blocks first; site is "file:line" (innermost call first)"""
+        frames = max(1, self.frames - self.frames % self.interval)
+        result = []
+        for traceback, (blocks, size) in sorted(
+                self.sites.items(), key=lambda item: -item[1][0])[:limit]:
+            site = " < ".join(f"{os.path.basename(frame.filename)}:"
+                              f"{frame.lineno}" for frame in traceback)
+            result.append((blocks / frames, size / frames, site))
+        return result
+
+    def dump(self, file_name, limit=50):
+        with open(file_name, "w") as f:
+            f.write(f"{self.frames} frames, allocated blocks and bytes per "
+                    "frame by call site\n")
+            for blocks, size, site in self.top(limit):
+                f.write(f"{blocks:10.2f} {size:12.1f}  {site}\n")
@@ -0,0 +1,78 @@
+# Tests of the audio mixer on the null backend: python -m pytest
+
+import audio
+
+
+def sounding(played, length, play_time):
+    """Num of effects of the schedule sounding at play_time"""
+    return sum(1 for start, sound, volume in played
+               if start <= play_time < start + length)
+
+
+def test_voice_cap():
+    requests = [(0.0, f"effect{i}") for i in range(10)]
+    mixer = audio.simulate(requests, max_voices=4)
+    assert mixer.played == 4
+    assert mixer.dropped == 6
+    assert mixer.skipped == 0
+
+
+def test_voices_never_over_cap():
+    # 8 players locking shapes and clearing lines in the same frames
+    frame = 1/60
+    requests = []
+    for player in range(8):
+        requests.append((player * frame / 4, "lock"))
+        requests.append((10 * frame, "line_clear"))
+        requests.append((11 * frame + player * frame * 4, "attacked"))
+    mixer = audio.simulate(requests, max_voices=3, length=0.1)
+    played = mixer.backend.played
+    assert played
+    for start, sound, volume in played:
+        assert sounding(played, 0.1, start) <= 3
+    assert mixer.played + mixer.skipped + mixer.dropped == len(requests)
+
+
+def test_voice_freed_after_length():
+    requests = [(0.0, "a"), (0.0, "b"), (0.6, "c")]
+    mixer = audio.simulate(requests, max_voices=2, length=0.5)
+    assert [sound for start, sound, volume in mixer.backend.played] == \
+        ["a", "b", "c"]
+    assert mixer.dropped == 0
+
+
+def test_cooldown():
+    requests = [(0.0, "lock"), (0.01, "lock"), (0.2, "lock")]
+    mixer = audio.simulate(requests, cooldowns={"lock": 0.05})
+    assert mixer.played == 2
+    assert mixer.skipped == 1
+
+
+def test_queue_full():
+    mixer = audio.Mixer(audio.NullBackend(), threaded=False)
+    mixer.add("lock", "lock", cooldown=0)
+    for i in range(audio.QUEUE_SIZE + 5):
+        mixer.play("lock")
+    assert mixer.dropped == 5
+    mixer.pump()
+    assert mixer.played == audio.MAX_VOICES
+
+
+def test_unknown_effect_ignored():
+    mixer = audio.Mixer(audio.NullBackend(), threaded=False)
+    mixer.play("missing")
+    mixer.pump()
+    assert mixer.played == mixer.dropped == 0
+
+
+def test_worker_thread():
+    backend = audio.NullBackend()
+    mixer = audio.Mixer(backend, max_voices=8, volume=0.5)
+    for name in ("lock", "line_clear", "attacked"):
+        mixer.add(name, name)
+    for name in ("lock", "line_clear", "attacked"):
+        mixer.play(name)
+    mixer.close()
+    assert [(sound, volume) for start, sound, volume in backend.played] == \
+        [("lock", 0.5), ("line_clear", 0.5), ("attacked", 0.5)]
+    assert mixer.thread is None
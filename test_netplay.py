@@ -0,0 +1,130 @@
+# Tests of the network battle lockstep: python -m pytest
+
+import random
+import socket
+
+import engine
+import netplay
+
+
+class LinkedLockstep(netplay.Lockstep):
+    """Lockstep whose packets go to a peer's inbox, some of them lost and
+    the rest delivered out of order"""
+    def __init__(self, index, delay, loss, rng):
+        super().__init__(index, delay)
+        self.peer = None
+        self.inbox = []
+        self.loss = loss
+        self.rng = rng
+
+    def send(self):
+        if self.rng.random() >= self.loss:
+            self.peer.inbox.append(self.inputs_packet())
+
+    def deliver(self):
+        self.rng.shuffle(self.inbox)
+        for data in self.inbox:
+            self.receive_inputs(data)
+        self.inbox = []
+
+
+def play_linked(ticks, delay=netplay.DEFAULT_DELAY, loss=0.2, seed=0,
+                tamper_tick=None):
+    """Play a scripted match on a pair of LinkedLockstep
+
+    Returns (sides, matches, given, played) like netplay.run_test()."""
+    rng = random.Random(seed)
+    sides = [LinkedLockstep(index, delay, loss, rng) for index in (0, 1)]
+    sides[0].peer, sides[1].peer = sides[1], sides[0]
+    matches = [engine.Match(2, seed=seed) for side in sides]
+    scripts = [engine.Rng(index + 1) for index in (0, 1)]
+    given = [[[] for tick in range(delay)] for side in sides]
+    played = [[] for side in sides]
+    for frame in range(ticks * 4):
+        if min(side.tick for side in sides) >= ticks:
+            break
+        for side, match, script, side_played in zip(sides, matches, scripts,
+                                                    played):
+            if side.local_tick < ticks:
+                inputs = netplay.script_inputs(script)
+                if side.add_local(inputs):
+                    given[side.index].append(inputs)
+            else:
+                side.send()  # resend what wasn't acknowledged
+            side_played += side.step(match)
+            if side.tick == tamper_tick and side.index == 1:
+                match.games[0].score += 1
+        for side in sides:
+            side.deliver()
+    return sides, matches, given, played
+
+
+def free_port_pair():
+    """A UDP port that is free, with the next one free too"""
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as first:
+            first.bind(("127.0.0.1", 0))
+            port = first.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as second:
+                try:
+                    second.bind(("127.0.0.1", port + 1))
+                except OSError:
+                    continue
+        return port
+
+
+def test_encode_inputs_keeps_order_and_repeats():
+    inputs = [engine.DOWN, engine.LEFT, engine.LEFT, engine.UP,
+              engine.HARD_DROP]
+    codes = netplay.encode_inputs(inputs)
+    assert netplay.decode_inputs(codes) == engine.ordered_inputs(inputs)
+    assert netplay.decode_inputs(codes).count(engine.LEFT) == 2
+
+
+def test_encode_inputs_capped():
+    codes = netplay.encode_inputs([engine.LEFT] * 1000)
+    assert len(codes) == netplay.MAX_TICK_INPUTS
+
+
+def test_truncated_packet_keeps_complete_ticks():
+    # The packet has ticks 0-4, the receiver only knows ticks 0-1
+    sender = netplay.Lockstep(0, delay=4)
+    sender.add_local([engine.RIGHT, engine.RIGHT])
+    receiver = netplay.Lockstep(1, delay=2)
+    receiver.receive_inputs(sender.inputs_packet()[:-1])
+    assert receiver.remote_tick == 4
+    assert 4 not in receiver.remote
+    receiver.receive_inputs(sender.inputs_packet())
+    assert receiver.remote_tick == 5
+    assert receiver.remote[4] == \
+        netplay.encode_inputs([engine.RIGHT, engine.RIGHT])
+
+
+def test_lockstep_never_desyncs():
+    ticks = 600
+    sides, matches, given, played = play_linked(ticks, loss=0.3)
+    assert [side.tick for side in sides] == [ticks, ticks]
+    assert [side.desync for side in sides] == [None, None]
+    assert netplay.state_hash(matches[0]) == \
+        netplay.state_hash(matches[1])
+    for side_played in played:
+        for player in (0, 1):
+            assert [tick_inputs[player] for tick_inputs in side_played] == \
+                given[player][:ticks]
+
+
+def test_lockstep_detects_desync():
+    tamper_tick = netplay.CHECK_INTERVAL // 2
+    sides, matches, given, played = play_linked(
+        netplay.CHECK_INTERVAL * 4, loss=0.0, tamper_tick=tamper_tick)
+    assert sides[0].desync == sides[1].desync == netplay.CHECK_INTERVAL
+
+
+def test_latency_proxy_match():
+    report = netplay.run_test(free_port_pair(), ticks=180,
+                              delay=netplay.DEFAULT_DELAY, latency=0.03,
+                              jitter=0.01, loss=0.05)
+    assert report["ok"], report
+    assert report["inputs_ok"]
+    assert report["desync"] == [None, None]
+    assert report["forwarded"] > 0
@@ -3,34 +3,381 @@
 # Background images are from https://pixabay.com/
 # Sound data are from 魔王魂 at https://maoudamashii.jokersounds.com/
 
+import time
+START_TIME = time.perf_counter()  # before importing arcade (see --startup)
+
+import argparse
+import os
+import sys
+
+import replay
+import tournament
+
+# Where tet.py was started from; tet.py changes to its own directory to
+# load images and sounds, so file names given as arguments are resolved
+# against this
+CALLER_DIR = os.getcwd()
+
+
+def caller_path(file_name):
+    """Absolute path of a file name given on the command line"""
+    return os.path.abspath(os.path.join(CALLER_DIR, file_name))
+
+
+def headless_main(argv):
+    """Run a command that doesn't open a window (tournament, --replay)
+    and return its exit status, or None if argv is for the game
+
+    This runs before arcade is imported, which needs a display."""
+    if argv[:1] == ["tournament"]:
+        return tournament.main(argv[1:])
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--replay", nargs="+")
+    args, rest = parser.parse_known_args(argv)
+    if not args.replay or "-h" in rest or "--help" in rest:
+        return None
+    failed = False
+    for file_name in args.replay:
+        ok, message = replay.verify(caller_path(file_name))
+        print(message)
+        failed = failed or not ok
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    status = headless_main(sys.argv[1:])
+    if status is not None:
+        raise SystemExit(status)
+
 import arcade
 from arcade import Matrix3x3
-import random
-import os
+import collections
+import concurrent.futures
+import PIL.Image
+import struct
 import timeit
 
+import engine
+from engine import PLWIDTH, PLHEIGHT, TETRIS_SHAPES
+from engine import BLUE, RED, PURPLE, GREEN, AQUA, YELLOW, ORANGE, GRAY
+from telemetry import FrameTelemetry, GcMonitor, AllocationTracker
+from gcpolicy import GcPolicy
+import audio
+import bot
+import netplay
+import spectate
+
 WIDTH = 800  # window width in pixel
 HEIGHT = 600  # window height in pixel
 ASPECT = 1  # background image aspect ratio
 SPRITE_SCALING = 0.7
 
-PLWIDTH = 10  # game area width in number of blocks
-PLHEIGHT = 20  # game area height in number of blocks
-
 PLLEFT = 320  # game area left edge location within window in pixel
 PLBOTTOM = 80  # game area top edge location within window in pixel
 PLLEFT1 = 120  # PLLEFT for player 1 in two-player game mode
 PLLEFT2 = 480  # PLLEFT for player 2 in two-player game mode
-
-# Tetris shape colors
-BLUE = 1
-RED = 2
-PURPLE = 3
-GREEN = 4
-AQUA = 5
-YELLOW = 6
-ORANGE = 7
-GRAY = 8  # for wall/frame
+MAX_PLAYERS = 8  # boards in a battle (and in a broadcast)
+HUD_HEIGHT = 40  # pixels above the boards for high score, score and level
+
+# What a view shows, for the frame rate (see FramePacer)
+ACTIVE = "active"  # a game is played: full frame rate
+AMBIENT = "ambient"  # only the background moves: --idle-fps
+STATIC = "static"  # nothing moves: draw once, then wait for input
+FRAME_RATE = 1/60  # sec per frame while ACTIVE
+IDLE_FPS = 15  # default frames per sec while AMBIENT
+STATIC_RATE = 1  # sec per frame while STATIC (in case the window is exposed)
+HINT_BUDGET = 0.002  # sec per frame for the placement hint search (H key)
+HINT_ALPHA = 90  # opacity of the hint blocks
+GHOST_ALPHA = 60  # opacity of the ghost piece (where the shape lands)
+UNDO_PLACEMENTS = 100  # placements that can be undone in practice mode
+
+# Player keys (player one also plays 1-player game)
+PLAYER1_KEYS = {
+    arcade.key.UP: engine.UP, arcade.key.W: engine.UP,
+    arcade.key.LEFT: engine.LEFT, arcade.key.A: engine.LEFT,
+    arcade.key.RIGHT: engine.RIGHT, arcade.key.D: engine.RIGHT,
+    arcade.key.DOWN: engine.DOWN, arcade.key.S: engine.DOWN,
+    arcade.key.ENTER: engine.HARD_DROP, arcade.key.E: engine.HARD_DROP,
+    }
+PLAYER2_KEYS = {
+    arcade.key.I: engine.UP,
+    arcade.key.J: engine.LEFT,
+    arcade.key.L: engine.RIGHT,
+    arcade.key.K: engine.DOWN,
+    arcade.key.O: engine.HARD_DROP,
+    }
+# Replay viewer keys (--view), sec to seek back/forward
+REPLAY_SEEK_KEYS = {
+    arcade.key.LEFT: -10, arcade.key.RIGHT: 10,
+    arcade.key.DOWN: -60, arcade.key.UP: 60,
+    }
+
+
+# Image and sound files
+BLOCK_IMAGES = {
+    BLUE: "images/blue32.png",
+    RED: "images/red32.png",
+    PURPLE: "images/purple32.png",
+    GREEN: "images/green32.png",
+    AQUA: "images/aqua32.png",
+    YELLOW: "images/yellow32.png",
+    ORANGE: "images/orange32.png",
+    GRAY: "images/gray32.png",
+    }
+TITLE_IMAGE = "images/buddha-4263091_1280.jpg"
+CACHE_DIR = "cache"  # window sized copies of backgrounds
+# A game left running when the window is closed, resumed on the next launch
+SUSPEND_FILE = os.path.join(CACHE_DIR, "suspended.bin")
+SUSPEND_MAGIC = b"ZTSP"
+SUSPEND_VERSION = 1
+# magic, version, game mode, vs CPU, num of players, targeting and CPU
+# level (indexes), seed, high score, time played, then Match.snapshot()
+SUSPEND_STATE = struct.Struct("<4sBB?BBBqId")
+BACKGROUND_IMAGES = [
+    "images/mandala-1094811_1280.jpg",  # 1-player mode
+    "images/fractal-1832617_1280.jpg",  # 2-player mode
+    ]
+EVENT_SOUNDS = {
+    engine.LOCK: "sounds/se_maoudamashii_se_sound16.wav",
+    engine.LINE_CLEAR: "sounds/se_maoudamashii_battle07.wav",
+    engine.ATTACKED: "sounds/se_maoudamashii_system26.wav",
+    engine.LEVEL_UP: "sounds/se_maoudamashii_system29.wav",
+    engine.GAME_OVER: "sounds/se_maoudamashii_retro30.wav",
+    }
+# Sec before the same sound effect can start again (see audio.Mixer)
+SOUND_COOLDOWNS = {
+    engine.LOCK: 0.05,
+    engine.LINE_CLEAR: 0.1,
+    engine.ATTACKED: 0.1,
+    engine.LEVEL_UP: 0.5,
+    engine.GAME_OVER: 1.0,
+    }
+
+
+def background_cache_file(file_name):
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(CACHE_DIR, f"{stem}-{WIDTH}x{HEIGHT}.bmp")
+
+
+def background_cached(file_name):
+    """True if the disk cache has an up-to-date copy of a background"""
+    try:
+        return os.path.getmtime(background_cache_file(file_name)) >= \
+            os.path.getmtime(file_name)
+    except OSError:
+        return False
+
+
+def load_background(file_name):
+    """Return an image downscaled to the window size (RGBA)
+
+    Decoding a full size JPEG and resizing it takes much longer than
+    reading an uncompressed window sized copy, so the copy is kept in
+    CACHE_DIR.  Uses PIL only, so it can run in any thread."""
+    cache_file = background_cache_file(file_name)
+    if background_cached(file_name):
+        return PIL.Image.open(cache_file).convert("RGBA")
+    image = PIL.Image.open(file_name).convert("RGBA")
+    image = image.resize((WIDTH, HEIGHT), PIL.Image.LANCZOS)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        image.convert("RGB").save(cache_file + ".tmp", "BMP")
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        pass  # e.g. read-only folder; decode again next time
+    return image
+
+
+class Assets():
+    """Textures and sounds owned by the window
+
+    Each file (or sub-image) is loaded and decoded once, and the same
+    texture/sound object is handed out to every view afterwards.
+    Backgrounds can be prefetched in a background thread."""
+    def __init__(self):
+        self.textures = {}
+        self.sounds = {}
+        self.images = {}  # file name -> future of load_background()
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.preloaded = False
+
+    def texture(self, file_name, x=0, y=0, width=0, height=0):
+        key = (file_name, x, y, width, height)
+        texture = self.textures.get(key)
+        if texture is None:
+            texture = arcade.load_texture(file_name, x, y, width, height)
+            self.textures[key] = texture
+        return texture
+
+    def prefetch(self, file_names):
+        """Start loading backgrounds in the background thread"""
+        for file_name in file_names:
+            if file_name not in self.images:
+                self.images[file_name] = self.executor.submit(
+                    load_background, file_name)
+
+    def background_ready(self, file_name):
+        """True if background() returns without waiting"""
+        future = self.images.get(file_name)
+        return future is not None and future.done()
+
+    def background(self, file_name):
+        """Texture of an image downscaled to the window size
+
+        Backgrounds are always drawn to the whole window, so a window
+        sized copy looks the same and costs much less fill rate.  Waits
+        for the background thread if the image is being prefetched."""
+        key = (file_name, WIDTH, HEIGHT)
+        texture = self.textures.get(key)
+        if texture is None:
+            self.prefetch([file_name])
+            image = self.images[file_name].result()
+            texture = arcade.Texture(f"{file_name}-{WIDTH}x{HEIGHT}", image)
+            self.textures[key] = texture
+        return texture
+
+    def sound(self, file_name):
+        sound = self.sounds.get(file_name)
+        if sound is None:
+            sound = arcade.load_sound(file_name)
+            self.sounds[file_name] = sound
+        return sound
+
+    def block_textures(self, color):
+        """Textures of a block color, one per delete animation frame"""
+        return [self.texture(BLOCK_IMAGES[color], 32*i, 0, 32, 32)
+                for i in range(engine.DELETE_ANIMATION_FRAMES + 1)]
+
+    def frame_texture(self):
+        """The gray wall around a game area baked into one texture
+
+        One cell of 32x32 per block, (PLWIDTH+2) x (PLHEIGHT+2) cells,
+        transparent inside.  The wall never changes, so a board draws it
+        as one sprite instead of one per block."""
+        key = ("frame", PLWIDTH, PLHEIGHT)
+        texture = self.textures.get(key)
+        if texture is None:
+            block = self.block_textures(GRAY)[0].image
+            image = PIL.Image.new("RGBA", ((PLWIDTH+2) * 32,
+                                           (PLHEIGHT+2) * 32))
+            for x in range(PLWIDTH+2):
+                image.paste(block, (x * 32, 0))
+                image.paste(block, (x * 32, (PLHEIGHT+1) * 32))
+            for y in range(1, PLHEIGHT+1):
+                image.paste(block, (0, y * 32))
+                image.paste(block, ((PLWIDTH+1) * 32, y * 32))
+            texture = arcade.Texture(f"frame-{PLWIDTH}x{PLHEIGHT}", image)
+            self.textures[key] = texture
+        return texture
+
+    def preload(self):
+        """Load every block texture and sound effect"""
+        for color in BLOCK_IMAGES:
+            self.block_textures(color)
+        self.frame_texture()
+        for file_name in EVENT_SOUNDS.values():
+            self.sound(file_name)
+        self.preloaded = True
+
+
+class FramePacer():
+    """Lowers the frame rate while the view doesn't need it
+
+    Views call update(self.animation()) in on_update, with ACTIVE,
+    AMBIENT or STATIC.  arcade draws the window after each update, so
+    the update rate is the frame rate.  Call wake() on input (or a view
+    change) to draw the next frame without waiting for a slow one."""
+    def __init__(self, window, idle_fps=IDLE_FPS):
+        self.window = window
+        self.rates = {ACTIVE: FRAME_RATE, AMBIENT: 1 / idle_fps,
+                      STATIC: STATIC_RATE}
+        self.state = ACTIVE
+
+    def update(self, state):
+        # The time since the last update was spent in the old state
+        self.window.telemetry.cpu.update(self.state)
+        if state != self.state:
+            self.state = state
+            self.window.set_update_rate(self.rates[state])
+
+    def wake(self):
+        self.update(ACTIVE)
+
+
+class HudText():
+    """Text label drawn as a sprite of a shared sprite list
+
+    The text image is rendered only when the text changes, so drawing a
+    label costs about the same as drawing a sprite."""
+    def __init__(self, sprite_list, text, x, y, font_size=14,
+                 anchor_x="left", font_name=("calibri", "arial")):
+        self.x = x
+        self.y = y
+        self.font_size = font_size
+        self.anchor_x = anchor_x
+        self.font_name = font_name
+        self.text = None
+        self.sprite = arcade.Sprite()
+        self.set_text(text)
+        sprite_list.append(self.sprite)
+
+    def set_text(self, text):
+        """Change text; re-render only if it's different"""
+        if text == self.text:
+            return
+        self.text = text
+        image = arcade.get_text_image(text, arcade.color.WHITE,
+                                      self.font_size,
+                                      font_name=self.font_name)
+        self.sprite.texture = arcade.Texture(
+            f"hud-{self.font_size}-{self.font_name}-{text}", image)
+        self.sprite.width = image.width
+        self.sprite.height = image.height
+        # Same anchors as arcade.draw_text() (anchor_y="baseline")
+        if self.anchor_x == "center":
+            self.sprite.center_x = self.x
+        else:
+            self.sprite.center_x = self.x + image.width / 2
+        self.sprite.center_y = self.y + image.height / 2
+
+    def set_visible(self, visible):
+        self.sprite.alpha = 255 if visible else 0
+
+
+def board_layout(num_boards):
+    """Return (left_edge, bottom_edge, scale) of each player's game area
+
+    left_edge and bottom_edge are the center of the bottom left cell.
+    One or two boards keep their usual places.  More boards are put in
+    one or two rows, whichever gives larger blocks, below the HUD_HEIGHT
+    strip of the high score and with room for labels above each board."""
+    if num_boards == 1:
+        return [(PLLEFT, PLBOTTOM, SPRITE_SCALING)]
+    if num_boards == 2:
+        return [(PLLEFT1, PLBOTTOM, SPRITE_SCALING),
+                (PLLEFT2, PLBOTTOM, SPRITE_SCALING)]
+    best = None
+    for rows in (1, 2):
+        columns = -(-num_boards // rows)
+        cell_width = WIDTH / columns
+        cell_height = (HEIGHT - HUD_HEIGHT) / rows
+        # Blocks of the game area and the wall around it
+        block_size = min(32*SPRITE_SCALING,
+                         (cell_width - 10) / (PLWIDTH+2),
+                         (cell_height - HUD_HEIGHT) / (PLHEIGHT+2))
+        if best is None or block_size > best[0]:
+            best = (block_size, rows, columns, cell_width, cell_height)
+    block_size, rows, columns, cell_width, cell_height = best
+    layout = []
+    for i in range(num_boards):
+        row, column = divmod(i, columns)
+        center_x = cell_width * (column + 0.5)
+        center_y = cell_height * (rows - 1 - row) + \
+            (cell_height - HUD_HEIGHT) / 2
+        layout.append((center_x - block_size * (PLWIDTH-1) / 2,
+                       center_y - block_size * (PLHEIGHT-1) / 2,
+                       block_size / 32))
+    return layout
 
 
 class TitleView(arcade.View):
@@ -38,42 +385,120 @@ class TitleView(arcade.View):
     def __init__(self):
         super().__init__()
         self.camera_x = 0
+        self.session = None  # netplay.NetSession while connecting
+        self.spectator = None  # spectate.SpectatorClient while connecting
 
     def on_show(self):
         arcade.set_background_color(arcade.color.AMAZON)
-        self.background = arcade.load_texture("images/buddha-4263091_1280.jpg")
+        self.window.pacer.wake()
+        # Shown when the background thread has it (at startup)
+        self.background = None
+
+        # Texts don't change while the title is shown
+        self.hud = arcade.SpriteList()
+        if self.window.game_over:
+            HudText(self.hud, "Game Over", WIDTH/2, HEIGHT/2, 50, "center")
+            HudText(self.hud, f"High Score: {self.window.high_score}",
+                    WIDTH/2-40, HEIGHT-30, 14)
+        else:
+            HudText(self.hud, "Zen Tetris", WIDTH/2, HEIGHT/2, 50, "center")
+        num_players = self.window.num_players
+        if num_players == 2:
+            battles = "T (Two players) or C (vs CPU)"
+        else:
+            battles = f"T ({num_players} players) or C (vs " + \
+                f"{num_players - 1} CPUs)"
+        HudText(self.hud, f"Push O (One player), {battles}",
+                WIDTH/2, HEIGHT/2 - 72, 16, "center")
+        if self.window.net is not None:
+            self.net_text = HudText(self.hud, "Push N (Network battle)",
+                                    WIDTH/2, HEIGHT/2 - 100, 16, "center")
+        if self.window.watch is not None:
+            self.watch_text = HudText(self.hud, "Push W (Watch a game)",
+                                      WIDTH/2, HEIGHT/2 - 128, 16, "center")
+
+    def animation(self):
+        return AMBIENT  # the background scrolls
 
     def on_update(self, delta_time: float):
-        self.camera_x += 2
+        self.window.pacer.update(self.animation())
+        self.camera_x += 120 * delta_time  # px/sec
+        assets = self.window.assets
+        if self.background is None and assets.background_ready(TITLE_IMAGE):
+            self.background = assets.background(TITLE_IMAGE)
+        if self.window.first_frame_time is not None and \
+           not assets.preloaded:
+            # Blocks and sounds are needed by GameView only, so they are
+            # loaded after the first frame is shown
+            assets.preload()
+            if self.window.startup:
+                self.report_startup()
+        if self.spectator is not None:
+            self.update_spectator()
+        session = self.session
+        if session is None:
+            return
+        if session.closed:
+            self.net_text.set_text(f"Network error: {session.error}")
+            self.session = None
+        elif session.connected.is_set():
+            # Both players are there, start the battle
+            self.session = None
+            self.window.game_over = False
+            self.window.game_mode = 1  # two-player game
+            self.window.vs_cpu = False
+            game_view = GameView()
+            game_view.window = self.window
+            game_view.session = session
+            game_view.setup()
+            self.window.show_view(game_view)
+
+    def update_spectator(self):
+        spectator = self.spectator
+        if spectator.closed:
+            self.watch_text.set_text(f"Network error: {spectator.error}")
+            self.spectator = None
+        elif spectator.received.is_set():
+            # The first keyframe tells the num of players
+            self.spectator = None
+            self.window.game_over = False
+            self.window.game_mode = 0 if len(spectator.players) == 1 else 1
+            self.window.vs_cpu = False
+            game_view = GameView()
+            game_view.window = self.window
+            game_view.spectator = spectator
+            game_view.setup()
+            self.window.show_view(game_view)
 
     def on_draw(self):
         arcade.start_render()
 
-        for z in [300, 200]:
-            opacity = 100
-            scale = 150 / z
-            translate = scale / 500
-            self.background.draw_transformed(
-                0, 0, WIDTH, HEIGHT, 0, opacity,
-                Matrix3x3().scale(scale, scale).translate(-self.camera_x
-                                                          * translate, 0))
-
-        if self.window.game_over:
-            arcade.draw_text("Game Over", WIDTH/2, HEIGHT/2,
-                             arcade.color.WHITE, font_size=50,
-                             anchor_x="center")
-            arcade.draw_text(f"High Score: {self.window.high_score}",
-                             WIDTH/2-40, HEIGHT-30, arcade.color.WHITE, 14)
-        else:
-            arcade.draw_text("Zen Tetris", WIDTH/2, HEIGHT/2,
-                             arcade.color.WHITE, font_size=50,
-                             anchor_x="center")
-
-        arcade.draw_text("Push O (One player) or T (Two players) to play",
-                         WIDTH/2, HEIGHT/2 - 72,
-                         arcade.color.WHITE, font_size=16, anchor_x="center")
+        if self.background is not None:
+            for z in [300, 200]:
+                opacity = 100
+                scale = 150 / z
+                translate = scale / 500
+                self.background.draw_transformed(
+                    0, 0, WIDTH, HEIGHT, 0, opacity,
+                    Matrix3x3().scale(scale, scale).translate(
+                        -self.camera_x * translate, 0))
+
+        self.hud.draw()
+        if self.window.first_frame_time is None:
+            self.window.first_frame_time = time.perf_counter() - START_TIME
+
+    def report_startup(self):
+        """Print the time to the first frame and quit (--startup)"""
+        assets = self.window.assets
+        for file_name in [TITLE_IMAGE] + BACKGROUND_IMAGES:
+            assets.background(file_name)  # wait for the background thread
+        print(f"First frame: {self.window.first_frame_time:.3f} sec, "
+              f"all assets loaded: {time.perf_counter() - START_TIME:.3f} "
+              f"sec ({self.window.startup} cache)")
+        arcade.close_window()
 
     def on_key_press(self, key, modifiers):
+        self.window.pacer.wake()
         if key == arcade.key.O:
             self.window.game_over = False
             self.window.game_mode = 0  # one-player game
@@ -81,13 +506,34 @@ class TitleView(arcade.View):
             game_view.window = self.window
             game_view.setup()
             self.window.show_view(game_view)
-        if key == arcade.key.T:
+        if key == arcade.key.T or key == arcade.key.C:
             self.window.game_over = False
-            self.window.game_mode = 1  # two-player game
+            self.window.game_mode = 1  # battle
+            # C: all but player one are CPUs, T: all but players one and
+            # two (see GameView.setup())
+            self.window.vs_cpu = key == arcade.key.C
             game_view = GameView()
             game_view.window = self.window
             game_view.setup()
             self.window.show_view(game_view)
+        if key == arcade.key.N and self.window.net is not None and \
+           self.session is None:
+            net = self.window.net
+            self.session = netplay.NetSession(net["host"], net["port"],
+                                              net["delay"], self.window.seed)
+            self.session.start()
+            if net["host"] is None:
+                self.net_text.set_text(
+                    f"Waiting for the other player on port {net['port']}")
+            else:
+                self.net_text.set_text(
+                    f"Connecting to {net['host']}:{net['port']}")
+        if key == arcade.key.W and self.window.watch is not None and \
+           self.spectator is None:
+            host, port = self.window.watch
+            self.spectator = spectate.SpectatorClient(host, port)
+            self.spectator.start()
+            self.watch_text.set_text(f"Connecting to {host}:{port}")
 
 
 class PauseView(arcade.View):
@@ -98,13 +544,25 @@ class PauseView(arcade.View):
 
     def on_show(self):
         arcade.set_background_color(arcade.color.BLACK)
+        self.hud = arcade.SpriteList()
+        HudText(self.hud, "Press Space to return", WIDTH/2, HEIGHT/2, 20,
+                "center")
+        # Nothing moves now, so take the time for a full collection
+        self.window.gc_policy.safe_point(full=True)
+        self.window.pacer.wake()  # draw it once at once
+
+    def animation(self):
+        return STATIC
+
+    def on_update(self, delta_time):
+        self.window.pacer.update(self.animation())
 
     def on_draw(self):
         arcade.start_render()
-        arcade.draw_text("Press Space to return", WIDTH/2, HEIGHT/2,
-                         arcade.color.WHITE, font_size=20, anchor_x="center")
+        self.hud.draw()
 
     def on_key_press(self, key, _modifiers):
+        self.window.pacer.wake()
         if key == arcade.key.SPACE:
             self.window.show_view(self.game_view)
 
@@ -113,106 +571,140 @@ class GameView(arcade.View):
     """Tetris game main"""
     def __init__(self):
         super().__init__()
-
-        # Tetris shapes
-        # A shape consists of four blocks, each is assigned a location
-        # number in 4x4 matrix.  The first line are 0-3, the 2nd: 4-7, etc.
-        self.tetris_shapes = [
-            [RED, [[2, 6, 10, 14], [4, 5, 6, 7]]],
-            [YELLOW, [[1, 2, 5, 6]]],
-            [AQUA, [[1, 4, 5, 6], [1, 4, 5, 9], [4, 5, 6, 9],
-                    [1, 5, 6, 9]]],
-            [BLUE, [[1, 2, 5, 9], [0, 4, 5, 6], [1, 5, 8, 9],
-                    [4, 5, 6, 10]]],
-            [ORANGE, [[0, 1, 5, 9], [4, 5, 6, 8], [1, 5, 9, 10],
-                      [2, 4, 5, 6]]],
-            [GREEN, [[1, 5, 6, 10], [1, 2, 4, 5]]],
-            [PURPLE, [[1, 4, 5, 8], [0, 1, 5, 6]]],
-            ]
-
-        self.block_images = {
-            BLUE: "images/blue32.png",
-            RED: "images/red32.png",
-            PURPLE: "images/purple32.png",
-            GREEN: "images/green32.png",
-            AQUA: "images/aqua32.png",
-            YELLOW: "images/yellow32.png",
-            ORANGE: "images/orange32.png",
-            GRAY: "images/gray32.png",
-            }
-
-        # Load sounds
-        self.bottom_sound = arcade.load_sound(
-            "sounds/se_maoudamashii_se_sound16.wav")
-        self.delete_sound = arcade.load_sound(
-            "sounds/se_maoudamashii_battle07.wav")
-        self.attacked_sound = arcade.load_sound(
-            "sounds/se_maoudamashii_system26.wav")
-        self.levelup_sound = arcade.load_sound(
-            "sounds/se_maoudamashii_system29.wav")
-        self.gameover_sound = arcade.load_sound(
-            "sounds/se_maoudamashii_retro30.wav")
-
-        # Fall speed by level (in sec)
-        self.fall_counter_init = [60/60, 50/60, 40/60, 30/60,
-                                  25/60, 20/60, 15/60, 10/60,
-                                  7/60, 5/60, 3/60]
+        self.background = None
+        self.session = None  # netplay.NetSession in network battles
+        self.spectator = None  # spectate.SpectatorClient when watching
+        self.bot_executor = None  # search processes shared by CPU players
+        self.replay_file = None  # replay.ReplayFile when viewing a replay
+        # (time played, restored engine.Match) of a suspended game
+        self.resume = None
 
     def setup(self):
-        # Setup player objects
+        # Shared textures and sounds
+        assets = self.window.assets
+        self.block_textures = {}  # by color, one per delete animation frame
+        for color in BLOCK_IMAGES:
+            self.block_textures[color] = assets.block_textures(color)
+        for event, file_name in EVENT_SOUNDS.items():
+            self.window.mixer.add(event, assets.sound(file_name),
+                                  SOUND_COOLDOWNS[event])
+
+        # Blocks of all players (walls, game areas and falling shapes) are
+        # sprites of this one list, so every board is drawn from the same
+        # texture atlas in one draw call
+        self.block_list = arcade.SpriteList()
+        textures = []
+        for color_textures in self.block_textures.values():
+            textures.extend(color_textures)
+        textures.append(assets.frame_texture())
+        self.block_list.preload_textures(textures)
+
+        # Setup game engine and player objects
+        if self.spectator is not None:
+            # Read-only, updated from the broadcast
+            num_players = len(self.spectator.players)
+            self.match = spectate.RemoteMatch(num_players)
+        elif self.session is not None:
+            num_players = 2
+            self.match = engine.Match(2, seed=self.session.seed)  # host's
+        elif self.replay_file is not None:
+            num_players = self.replay_file.players
+            self.match, self.replay_frames = self.replay_file.seek(0)
+            self.replay_tick = 0
+            self.replay_time = 0  # sec played of the next tick
+            self.replay_next = next(self.replay_frames, None)
+        elif self.resume is not None:
+            self.match = self.resume[1]
+            num_players = len(self.match.games)
+        else:
+            num_players = 1 if self.window.game_mode == 0 else \
+                self.window.num_players
+            self.match = engine.Match(num_players, seed=self.window.seed,
+                                      targeting=self.window.targeting)
+        if self.session is None and self.spectator is None and \
+           self.replay_file is None:
+            humans = 1 if self.window.vs_cpu else 2  # the others are CPUs
+        else:
+            humans = num_players
         self.players = []
-        if self.window.game_mode == 0:
-            # 1-player mode
+        for i, (game, (left_edge, bottom_edge, scale)) in enumerate(zip(
+                self.match.games, board_layout(num_players))):
+            game.subscribe(self.on_game_event)
             player = Player()
             player.game_view = self
-            player.left_edge = PLLEFT
-            player.bottom_edge = PLBOTTOM
+            player.game = game
+            player.left_edge = left_edge
+            player.bottom_edge = bottom_edge
+            player.scale = scale
+            player.player_num = i + 1 if num_players > 1 else 0
             player.setup()
-            player.player_num = 0  # only player
+            if i >= humans:
+                if self.bot_executor is None:
+                    self.bot_executor = \
+                        concurrent.futures.ProcessPoolExecutor(
+                            min(num_players - humans, os.cpu_count() or 1))
+                player.bot = bot.BotController(game, self.window.bot_level,
+                                               worker=self.bot_executor)
+            if self.session is not None:
+                player.remote = i != self.session.index
+            if self.spectator is not None or self.replay_file is not None:
+                player.remote = True
+            player.ghost = self.window.ghost and player.bot is None and \
+                not player.remote
             self.players.append(player)
+        # Practice mode: snapshots of the match at each spawn to undo
+        # placements (see on_update() and undo())
+        self.undo_ring = None
+        if self.window.practice and num_players == 1 and \
+           self.spectator is None and self.replay_file is None:
+            self.undo_ring = collections.deque(maxlen=UNDO_PLACEMENTS)
+            self.undo_ring.append(self.match.snapshot())
+        self.spawned = False  # a shape spawned in the last step
+        # An undo or a resumed game doesn't replay from the start
+        if self.window.record and self.spectator is None and \
+           self.replay_file is None and self.undo_ring is None and \
+           self.resume is None:
+            self.recorder = replay.Recorder(self.match)
         else:
-            # 2-player mode
-            player = Player()
-            player.game_view = self
-            player.left_edge = PLLEFT1
-            player.bottom_edge = PLBOTTOM
-            player.setup()
-            player.player_num = 1  # player one
-            self.players.append(player)
-
-            player = Player()
-            player.game_view = self
-            player.left_edge = PLLEFT2
-            player.bottom_edge = PLBOTTOM
-            player.setup()
-            player.player_num = 2  # player two
-            self.players.append(player)
+            self.recorder = None
+        # Placement hint of a local 1-player game, searched a little
+        # every frame (see update_hint())
+        self.hint = None
+        self.hint_key = None  # position hint is searching or has found
+        if num_players == 1 and self.spectator is None and \
+           self.replay_file is None:
+            self.hint = bot.LookaheadSearch()
 
         # Setup background rotation
         self.time_passed = 0
+        self.fixed_step = engine.FixedStep()
+        if self.session is not None:
+            # Lockstep ticks; don't catch up more than the input delay
+            self.net_step = engine.FixedStep(netplay.TICK,
+                                             self.session.delay)
         self.window.game_over = False
         self.loop_time = timeit.default_timer()
-        self.tmp_block = arcade.Sprite(
-            self.block_images[1], SPRITE_SCALING,
-            0, 0, 32, 32)
-        self.update_time = timeit.default_timer()
-        self.background = None
         self.angle = 0
+        self.background_transform = Matrix3x3()
         self.update_counter = 0
+        self.debug_lines = []
+        self.setup_hud()
+        if self.resume is not None:
+            self.time_passed = self.resume[0]
+            self.restored()
+        # Everything created so far lives until the game is over
+        self.gc_safe = False  # a shape spawned, see on_game_event()
+        self.window.gc_policy.start()
 
     def on_show(self):
         arcade.set_background_color(arcade.color.BLACK)
         self.window.set_mouse_visible(False)
-        if self.window.game_mode == 0:
-            # image for 1-player mode
-            self.background = arcade.load_texture(
-                "images/mandala-1094811_1280.jpg")
-        else:
-            # image for 2-player mode
-            self.background = arcade.load_texture(
-                "images/fractal-1832617_1280.jpg")
+        self.window.pacer.wake()
+        self.background = self.window.assets.background(
+            BACKGROUND_IMAGES[self.window.game_mode])
 
     def on_draw(self):
+        telemetry = self.window.telemetry
         draw_time = timeit.default_timer()
         arcade.start_render()
 
@@ -222,410 +714,907 @@ class GameView(arcade.View):
             ratio = 60  # rotation speed slow
         else:
             ratio = 5  # rotation speed a little faster
-        if self.update_counter % 10 == 0:
-            self.angle += 0.1
+        # Every frame at a lower frame rate (see FramePacer)
+        if self.update_counter % 10 == 0 or \
+           self.window.pacer.state != ACTIVE:
+            self.angle = self.time_passed * 0.6  # degrees, 0.6/sec
+            self.background_transform = Matrix3x3().rotate(self.angle)
         self.background.draw_transformed(
-            0, 0, WIDTH, HEIGHT, 0, 255, Matrix3x3().rotate(self.angle))
+            0, 0, WIDTH, HEIGHT, 0, 255, self.background_transform)
+        phase_time = timeit.default_timer()
+        telemetry.add("background", phase_time - draw_time)
 
         # Display sprites
-        for player in self.players:
-            player.player_list.draw()
-            player.wall_list.draw()
-            player.block_list.draw()
+        self.block_list.draw()
+        now_time = timeit.default_timer()
+        telemetry.add("sprite_draw", now_time - phase_time)
+        phase_time = now_time
 
-        # Display scores
-        arcade.draw_text(f"High Score: {self.window.high_score}", WIDTH/2-60,
-                         HEIGHT-30, arcade.color.WHITE, 14)
-        if self.window.game_mode == 0:
-            for player in self.players:
-                arcade.draw_text(f"Score: {player.score}", 10, HEIGHT-30,
-                                 arcade.color.WHITE, 14)
-                arcade.draw_text(f"Level: {player.level}", WIDTH-70,
-                                 HEIGHT-30, arcade.color.WHITE, 14)
-        else:
-            for player in self.players:
-                arcade.draw_text(f"Level: {player.level}", player.left_edge+50,
-                                 HEIGHT-30, arcade.color.WHITE, 14)
-                arcade.draw_text(f"Score: {player.score}", player.left_edge+50,
-                                 HEIGHT-50, arcade.color.WHITE, 14)
+        # Display scores and game over
+        self.update_hud()
+        self.hud.draw()
+        telemetry.add("text_draw", timeit.default_timer() - phase_time)
 
-        # Display game over
-        for player in self.players:
-            if player.game_over:
-                arcade.draw_text(f"Game Over",
-                                 player.left_edge+25,
-                                 HEIGHT/2+20, arcade.color.WHITE, 24)
-                arcade.draw_text(f"ESC to quit",
-                                 player.left_edge+50,
-                                 HEIGHT/2-20, arcade.color.WHITE, 16)
         # Display performance info (debug mode)
         if self.window.debug is True:
+            self.draw_debug()
+
+        now_time = timeit.default_timer()
+        telemetry.end_frame(now_time - self.loop_time)
+        if self.window.alloc_tracker is not None:
+            # Not part of the frame time
+            self.window.alloc_tracker.end_frame()
             now_time = timeit.default_timer()
-            loop_time = now_time - self.loop_time
-            self.loop_time = now_time
-            draw_time = now_time - draw_time
-            arcade.draw_text(
-                f"Loop time: {loop_time * 1000:.3f} " +
-                f"(Update time: {self.update_time * 1000:.3f}, " +
-                f"Draw time: {draw_time * 1000:.3f})",
-                60, 0, arcade.color.WHITE, 14)
+        self.loop_time = now_time
+
+    def setup_hud(self):
+        """Create score, level and game over labels"""
+        self.hud = arcade.SpriteList()
+        self.high_score_text = HudText(
+            self.hud, f"High Score: {self.window.high_score}",
+            WIDTH/2-60, HEIGHT-30)
+        for player in self.players:
+            score = f"Score: {player.game.score}"
+            level = f"Level: {player.game.level}"
+            if self.window.game_mode == 0:
+                player.score_text = HudText(self.hud, score, 10, HEIGHT-30)
+                player.level_text = HudText(self.hud, level, WIDTH-70,
+                                            HEIGHT-30)
+            elif len(self.players) == 2:
+                player.level_text = HudText(self.hud, level,
+                                            player.left_edge+50, HEIGHT-30)
+                player.score_text = HudText(self.hud, score,
+                                            player.left_edge+50, HEIGHT-50)
+            else:
+                # Smaller boards (see board_layout()), labels on top
+                block_size = 32 * player.scale
+                x = player.left_edge - block_size / 2
+                y = player.bottom_edge + block_size * (PLHEIGHT+0.5) + 4
+                player.score_text = HudText(self.hud, score, x, y, 10)
+                player.level_text = HudText(self.hud, level, x, y+16, 10)
+            if len(self.players) <= 2:
+                player.game_over_texts = [
+                    HudText(self.hud, "Game Over", player.left_edge+25,
+                            HEIGHT/2+20, 24),
+                    HudText(self.hud, "ESC to quit", player.left_edge+50,
+                            HEIGHT/2-20, 16),
+                    ]
+            else:
+                block_size = 32 * player.scale
+                x = player.left_edge + block_size * (PLWIDTH-1) / 2
+                y = player.bottom_edge + block_size * (PLHEIGHT-1) / 2
+                player.game_over_texts = [
+                    HudText(self.hud, "Game Over", x, y, 16, "center")]
+            for text in player.game_over_texts:
+                text.set_visible(False)
+        if self.replay_file is not None:
+            self.replay_text = HudText(self.hud, "", 10, 10, 12)
+        if self.undo_ring is not None:
+            self.undo_text = HudText(self.hud, "", 10, 10, 12)
+        self.debug_hud = arcade.SpriteList()
+        self.debug_texts = []
+
+    def update_hud(self):
+        """Set label texts; labels are re-rendered only on change"""
+        self.high_score_text.set_text(f"High Score: {self.window.high_score}")
+        for player in self.players:
+            player.score_text.set_text(f"Score: {player.game.score}")
+            player.level_text.set_text(f"Level: {player.game.level}")
+            for text in player.game_over_texts:
+                text.set_visible(player.game.game_over)
+        if self.replay_file is not None:
+            tick_time = self.replay_file.dts[0]
+            self.replay_text.set_text(
+                f"Replay {format_time(self.replay_tick * tick_time)} / "
+                f"{format_time(self.replay_file.ticks * tick_time)}  "
+                "(Left/Right: 10 sec, Down/Up: 1 min)")
+        if self.undo_ring is not None:
+            self.undo_text.set_text(
+                f"Practice: Z to undo ({len(self.undo_ring) - 1} "
+                "placements)")
+
+    def draw_debug(self):
+        """Show frame time percentiles (in msec) of the last frames"""
+        telemetry = self.window.telemetry
+        # Sorting all recorded frames is not cheap, so refresh twice a sec
+        if self.update_counter % 30 == 0 or not self.debug_lines:
+            gc_monitor = self.window.gc_monitor
+            gc_policy = self.window.gc_policy
+            cpu_usage = telemetry.cpu.usage()
+            self.debug_lines = [
+                "cpu: " + ", ".join(f"{state} {cpu_usage[state]:.0%}"
+                                    for state in (ACTIVE, AMBIENT, STATIC)
+                                    if state in cpu_usage),
+                f"gc: {gc_monitor.count} pauses, max "
+                f"{gc_monitor.max * 1000:.2f} msec" +
+                (f", deferred ({gc_policy.forced} forced)"
+                 if gc_policy.active else "")]
+            if self.hint is not None:
+                self.debug_lines.append(
+                    f"hint: {self.hint.nodes_per_sec():.0f} nodes/sec, "
+                    f"cache hit rate {self.hint.cache.hit_rate():.0%}, "
+                    f"{len(self.hint.cache.table)} boards")
+            if self.window.alloc_tracker is not None:
+                for blocks, size, site in \
+                        self.window.alloc_tracker.top(3)[::-1]:
+                    self.debug_lines.append(
+                        f"alloc {blocks:7.1f} blocks/frame  {site}")
+            for phase, stats in telemetry.summary().items():
+                self.debug_lines.append(
+                    f"{phase:<12}" +
+                    " ".join(f"{stats[key] * 1000:7.2f}"
+                             for key in ("p50", "p95", "p99", "max")))
+            self.debug_lines.append(f"{'(msec)':<12}" + "".join(
+                f"{key:>8}" for key in ("p50", "p95", "p99", "max")))
+            for i, line in enumerate(self.debug_lines):
+                if i == len(self.debug_texts):
+                    self.debug_texts.append(HudText(
+                        self.debug_hud, line, 10, 10 + 14*i, 10,
+                        font_name=("courier new", "courier")))
+                self.debug_texts[i].set_text(line)
+        self.debug_hud.draw()
 
     def on_update(self, delta_time):
         # If ESC key is pressed (eg, gameover), switch to TitleView
         if self.window.game_over:
+            self.save_recording()
+            for player in self.players:
+                if player.bot is not None:
+                    player.bot.close()
+            if self.bot_executor is not None:
+                self.bot_executor.shutdown(wait=False)
+                self.bot_executor = None
+            if self.session is not None:
+                self.session.close()
+            if self.spectator is not None:
+                self.spectator.close()
+            if self.replay_file is not None:
+                self.replay_file.close()
+            self.window.gc_policy.stop()
             title_view = TitleView()
             self.window.show_view(title_view)
+            return
 
-        update_time = timeit.default_timer()
+        self.window.pacer.update(self.animation())
+        telemetry = self.window.telemetry
         self.time_passed += delta_time
+        if self.session is not None:
+            self.net_update(delta_time)
+            return
+        if self.spectator is not None:
+            self.spectator_update()
+            return
+        if self.replay_file is not None:
+            self.replay_update(delta_time)
+            return
+        for player in self.players:
+            if player.bot is not None:
+                player.inputs.extend(player.bot.inputs(delta_time))
+
+        # Run the game in fixed steps, so it plays at the same speed at
+        # any frame rate.  Each step plays the keys pressed up to its end
+        # time; if no step is due in this frame, they wait for the next.
+        now = timeit.default_timer()
+        steps = self.fixed_step.advance(delta_time)
+        for step in range(steps):
+            step_end = now - self.fixed_step.time - \
+                (steps - 1 - step) * engine.TICK
+            for player in self.players:
+                player.inputs.extend(player.input_queue.inputs(step_end))
+            if self.recorder is not None:
+                self.recorder.record(
+                    [player.inputs for player in self.players], engine.TICK)
+
+            # Same as self.match.step(), but timed per player
+            for i, player in enumerate(self.players):
+                update_time = timeit.default_timer()
+                player.game.step(player.inputs, engine.TICK)
+                player.inputs.clear()
+                telemetry.add(f"player{i+1}",
+                              timeit.default_timer() - update_time)
+            if self.spawned and self.undo_ring is not None:
+                # After the whole step (a shape that can't spawn is game
+                # over in the same step)
+                self.undo_ring.append(self.match.snapshot())
+            self.spawned = False
+
+        self.update_hint()
+        self.update_players()
+
+    def undo(self):
+        """Undo the last placement (practice mode): back to the spawn of
+        the shape before, or of the current shape if it's the first"""
+        if len(self.undo_ring) > 1:
+            self.undo_ring.pop()
+        self.match.restore(self.undo_ring[-1])
+        self.restored()
+
+    def restored(self):
+        """The match state was restored (no game events were sent)"""
+        for player in self.players:
+            player.player_moved = True
+            player.block_changed = True
+            player.input_queue.clear()
+            if player.bot is not None:
+                player.bot.cancel()
+                game = player.game
+                if not (game.game_over or game.delete_animation or
+                        game.generate_tetris):
+                    player.bot.start_search()
+        if not self.match.over:
+            self.window.gc_policy.start()
+        self.hint_key = None
+
+    def suspend(self):
+        """Save a game in play to SUSPEND_FILE, to resume on the next
+        launch (see load_suspended())"""
+        if self.session is not None or self.spectator is not None or \
+           self.replay_file is not None or self.window.game_over or \
+           self.match.over:
+            return
+        window = self.window
+        data = SUSPEND_STATE.pack(
+            SUSPEND_MAGIC, SUSPEND_VERSION, window.game_mode, window.vs_cpu,
+            len(self.match.games),
+            list(engine.TARGETING).index(self.match.targeting),
+            list(bot.LEVELS).index(window.bot_level), self.match.seed,
+            window.high_score, self.time_passed) + self.match.snapshot()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(SUSPEND_FILE + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(SUSPEND_FILE + ".tmp", SUSPEND_FILE)
+
+    def update_hint(self):
+        """Search the best placement of the falling shape (2-ply, see
+        bot.LookaheadSearch) for at most HINT_BUDGET sec and show it
+
+        The search starts over when the shape moves or the board
+        changes; the hint shown stays until the new search is done,
+        unless it's for another shape."""
+        if self.hint is None:
+            return
+        player = self.players[0]
+        game = player.game
+        if not self.window.hint or game.game_over or \
+           game.delete_animation or game.generate_tetris:
+            if self.hint_key is not None:
+                self.hint_key = None
+                player.show_hint(None)
+            return
+        update_time = timeit.default_timer()
+        key = (game.board.packed, game.shape, game.shape_cnt, game.x,
+               game.y)
+        if key != self.hint_key:
+            if self.hint_key is None or key[:2] != self.hint_key[:2]:
+                player.show_hint(None)  # a new shape or board
+            self.hint_key = key
+            self.hint.start(game.board.rows, game.shape, game.shape_cnt,
+                            game.x, game.y, game.next_shape())
+        if not self.hint.done and self.hint.step(HINT_BUDGET):
+            player.show_hint(self.hint.best)
+        self.window.telemetry.add("hint", timeit.default_timer() -
+                                  update_time)
 
+    def animation(self):
+        """ACTIVE while a game is played, AMBIENT once it's over (only
+        the background turns)"""
+        if self.replay_file is not None:
+            return ACTIVE if self.replay_next is not None else AMBIENT
+        if self.session is not None or self.spectator is not None:
+            return ACTIVE  # the next game state can come any time
         for player in self.players:
-            player.fall_counter -= delta_time
-
-            if player.game_over is True:
-                # Gameover effect (turn blocks to GRAY)
-                player.player_game_over()
-            elif player.delete_animation is True:
-                # Delete animation
-                player.delete_animation_counter -= delta_time
-                player.animation()
-            else:
-                # Player key move and fall
-                player.player_attacked()
-                player.shape_move()
-                player.shape_fall()
-
-                if player.score > self.window.high_score:
-                    self.window.high_score = player.score
-
-            # Update player_list
-            # Only when player tetris moves, rotates or is generated
-            if player.player_moved:
-                player.player_moved = False
-                for i in range(len(player.player_list)):
-                    player.player_list.pop()
-                color = self.tetris_shapes[player.shape][0]
-                for pos in (self.tetris_shapes[player.shape][1]
-                            [player.shape_cnt]):
-                    x = player.x + pos % 4
-                    y = player.y - pos // 4
-                    block = player.display_block(color, x, y)
-                    player.player_list.append(block)
-
-            # Update block_list
-            # Only when in animation, added or deleted
-            if player.block_changed:
-                for i in range(len(player.block_list)):
-                    player.block_list.pop()
-                for y in range(0, PLHEIGHT):
-                    for x in range(0, PLWIDTH):
-                        if player.game_area[y][x] != 0:
-                            block = player.display_block(
-                                player.game_area[y][x], x, y)
-                            player.block_list.append(block)
-
-        self.update_time = timeit.default_timer() - update_time
+            game = player.game
+            if not game.game_over or game.gameover_counter < PLHEIGHT:
+                return ACTIVE
+        return AMBIENT
+
+    def update_players(self):
+        telemetry = self.window.telemetry
+        update_time = timeit.default_timer()
+        for player in self.players:
+            game = player.game
+            if game.score > self.window.high_score:
+                self.window.high_score = game.score
+
+            player.update_sprites()
+        telemetry.add("sprites", timeit.default_timer() - update_time)
+        if self.window.broadcast is not None:
+            update_time = timeit.default_timer()
+            self.window.broadcast.publish(self.match)
+            telemetry.add("broadcast", timeit.default_timer() - update_time)
+        if self.match.over:
+            # Nothing to keep smooth on the game over screen: collect
+            # automatically again (until the next game or an undo)
+            self.window.gc_policy.stop()
+        else:
+            self.window.gc_policy.update(self.gc_safe)
+        self.gc_safe = False
+
+    def spectator_update(self):
+        """Show the latest broadcast state"""
+        if self.spectator.closed:
+            self.window.game_over = True
+            return
+        players = self.spectator.poll()
+        if players is not None:
+            self.match.set_state(players)
+        self.update_players()
+
+    def replay_update(self, delta_time):
+        """Play the replay at its recorded speed"""
+        self.replay_time = min(self.replay_time + delta_time,
+                               engine.MAX_CATCH_UP)
+        while self.replay_next is not None and \
+                self.replay_time >= self.replay_next[0]:
+            dt, inputs = self.replay_next
+            self.replay_time -= dt
+            self.match.step(inputs, dt)
+            self.replay_tick += 1
+            self.replay_next = next(self.replay_frames, None)
+        self.update_players()
+
+    def seek_replay(self, tick):
+        """Jump to tick of the replay (the nearest keyframe and re-play)"""
+        tick = max(0, min(tick, self.replay_file.ticks))
+        self.match, self.replay_frames = self.replay_file.seek(tick,
+                                                               self.match)
+        self.replay_tick = tick
+        self.replay_time = 0
+        self.replay_next = next(self.replay_frames, None)
+        for player in self.players:
+            # Restored without events, so redraw everything
+            player.player_moved = True
+            player.block_changed = True
+
+    def net_update(self, delta_time):
+        """Play a network battle in lockstep ticks of netplay.TICK sec"""
+        session = self.session
+        if session.closed:
+            # The other player quit or the connection is lost
+            self.window.game_over = True
+            return
+        update_time = timeit.default_timer()
+        local = self.players[session.index]
+        steps = self.net_step.advance(delta_time)
+        for step in range(steps):
+            step_end = update_time - self.net_step.time - \
+                (steps - 1 - step) * netplay.TICK
+            local.inputs.extend(local.input_queue.inputs(step_end))
+            # Inputs of a dropped tick (the other player is late) are kept
+            # for the next one
+            if session.add_local(local.inputs):
+                local.inputs.clear()
+        for inputs in session.step(self.match):
+            if self.recorder is not None:
+                self.recorder.record(inputs, netplay.TICK)
+        if session.desync is not None:
+            print(f"Network battle desync at tick {session.desync}")
+            self.window.game_over = True
+        self.window.telemetry.add("net", timeit.default_timer() - update_time)
+        self.update_players()
+
+    def save_recording(self):
+        """Save inputs of this game (--record) for replay
+
+        Writing a binary replay plays the game again for the keyframes,
+        so it runs in the Assets thread instead of the game loop."""
+        if self.recorder is not None:
+            self.window.assets.executor.submit(
+                save_replay, self.recorder.data(),
+                time.strftime(f"{self.window.record}-%Y%m%d-%H%M%S") +
+                replay.BINARY_EXTENSION)
+            self.recorder = None
+
+    def on_game_event(self, game, event, data):
+        """Play sound effects for game events"""
+        if event == engine.SPAWN:
+            # Nothing animates right after a spawn: the collections the
+            # GC policy deferred can run at the end of this update
+            self.gc_safe = True
+            self.spawned = True
+        # Queued only, the mixer thread starts it
+        self.window.mixer.play(event)
 
     def on_key_press(self, key, modifiers):
+        input_time = timeit.default_timer()
+        self.window.pacer.wake()
         if key == arcade.key.ESCAPE:
             # Switch to TitleView
             self.window.game_over = True
         if key == arcade.key.SPACE:
-            # Temporalily switch to PauseView
+            # Temporalily switch to PauseView (key releases are not seen
+            # there, so forget held keys)
+            for player in self.players:
+                player.input_queue.clear()
             pause = PauseView(self)
             self.window.show_view(pause)
+        if key == arcade.key.F1:
+            # Show/hide performance info
+            self.window.debug = not self.window.debug
+        if key == arcade.key.H:
+            # Show/hide the placement hint (1-player mode)
+            self.window.hint = not self.window.hint
+        if key == arcade.key.Z and self.undo_ring is not None:
+            self.undo()
+        if key == arcade.key.F2:
+            # Save frame times and GC pauses
+            dump_telemetry(self.window,
+                           time.strftime("telemetry-%Y%m%d-%H%M%S"))
+
+        if self.replay_file is not None and key in REPLAY_SEEK_KEYS:
+            self.seek_replay(self.replay_tick + round(
+                REPLAY_SEEK_KEYS[key] / self.replay_file.dts[0]))
+
+        for player, player_input in self.key_inputs(key):
+            player.input_queue.press(player_input, input_time)
+        self.window.telemetry.add("input", timeit.default_timer() - input_time)
+
+    def on_key_release(self, key, modifiers):
+        for player, player_input in self.key_inputs(key):
+            player.input_queue.release(player_input, timeit.default_timer())
+
+    def key_inputs(self, key):
+        """Return (player, engine input) of the players a key is for"""
+        result = []
+        for player in self.players:
+            if player.bot is not None or player.remote:
+                continue  # played by CPU or over the network
+            # Players three and up are always CPUs
+            if player.player_num == 2 and self.session is None:
+                player_input = PLAYER2_KEYS.get(key)
+            else:
+                player_input = PLAYER1_KEYS.get(key)
+            if player_input is not None:
+                result.append((player, player_input))
+        return result
+
+
+def load_suspended(window):
+    """Return a GameView that continues the game in SUSPEND_FILE, or None
+
+    The file is removed, so a game is resumed once."""
+    try:
+        with open(SUSPEND_FILE, "rb") as f:
+            data = f.read()
+        os.remove(SUSPEND_FILE)
+    except OSError:
+        return None
+    try:
+        (magic, version, game_mode, vs_cpu, num_players, targeting, level,
+         seed, high_score, time_passed) = SUSPEND_STATE.unpack_from(data)
+    except struct.error:
+        return None
+    if magic != SUSPEND_MAGIC or version != SUSPEND_VERSION or \
+       not 1 <= num_players <= MAX_PLAYERS or \
+       (game_mode == 0 and num_players != 1) or \
+       targeting >= len(engine.TARGETING) or level >= len(bot.LEVELS):
+        return None
+    # The battle size and targeting are the suspended game's own;
+    # --players and --targeting of this launch stay for the next battles
+    match = engine.Match(num_players, seed=seed,
+                         targeting=list(engine.TARGETING)[targeting])
+    try:
+        match.restore(data[SUSPEND_STATE.size:])
+    except (struct.error, ValueError):
+        return None  # a broken or truncated snapshot
+    window.game_over = False
+    window.game_mode = game_mode
+    window.vs_cpu = vs_cpu
+    window.bot_level = list(bot.LEVELS)[level]
+    window.high_score = max(window.high_score, high_score)
+    game_view = GameView()
+    game_view.window = window
+    game_view.resume = (time_passed, match)
+    game_view.setup()
+    return game_view
 
-        if key == arcade.key.UP or key == arcade.key.W:
-            for player in self.players:
-                if player.player_num != 2 and \
-                   player.delete_animation is False:
-                    player.up_pressed = True
-        if key == arcade.key.LEFT or key == arcade.key.A:
-            for player in self.players:
-                if player.player_num != 2 and \
-                   player.delete_animation is False:
-                    player.left_pressed = True
-        if key == arcade.key.RIGHT or key == arcade.key.D:
-            for player in self.players:
-                if player.player_num != 2 and player.delete_animation is False:
-                    player.right_pressed = True
-        if key == arcade.key.DOWN or key == arcade.key.S:
-            for player in self.players:
-                if player.player_num != 2 and player.delete_animation is False:
-                    player.down_pressed = True
 
-        if key == arcade.key.I:
-            for player in self.players:
-                if player.player_num == 2 and player.delete_animation is False:
-                    player.up_pressed = True
-        if key == arcade.key.J:
-            for player in self.players:
-                if player.player_num == 2 and player.delete_animation is False:
-                    player.left_pressed = True
-        if key == arcade.key.L:
-            for player in self.players:
-                if player.player_num == 2 and player.delete_animation is False:
-                    player.right_pressed = True
-        if key == arcade.key.K:
-            for player in self.players:
-                if player.player_num == 2 and player.delete_animation is False:
-                    player.down_pressed = True
+def save_replay(data, file_name):
+    """Write recorded data (replay.Recorder.data()) as a binary replay,
+    or print why it can't be"""
+    try:
+        replay.write_binary(data, file_name)
+    except (ValueError, OSError) as e:
+        # ValueError: the game doesn't play again as recorded
+        print(f"Replay not saved to {file_name}: {e}")
+
+
+def dump_telemetry(window, prefix):
+    """Save frame times to prefix.json/.csv, GC pauses to prefix-gc.csv
+    and, with --trace-alloc, allocations to prefix-alloc.txt"""
+    window.telemetry.dump(prefix)
+    window.gc_monitor.dump_csv(prefix + "-gc.csv")
+    if window.alloc_tracker is not None:
+        window.alloc_tracker.dump(prefix + "-alloc.txt")
+
+
+def format_time(sec):
+    return f"{int(sec) // 60}:{int(sec) % 60:02}"
 
 
 class Player():
-    """Represents a player to achieve two-player game battle"""
+    """Sprites of a player's game area (see engine.Game for the rules)"""
     def __init__(self):
         # Initialized in GameView
-        # player_num - 0: only player, 1: right player, 2: left player
+        # player_num - 0: only player, 1..: battle players from the left
         self.player_num = 0
         self.left_edge = 0
         self.bottom_edge = 0
+        self.scale = SPRITE_SCALING  # of 32x32 block images
         self.game_view = None
-        self.game_over = False
+        self.game = None
+        self.bot = None  # bot.BotController if played by CPU
+        self.remote = False  # True if played over the network
+        self.ghost = False  # show where the falling shape lands
 
     def setup(self):
-        # Sprite lists
-        self.wall_list = arcade.SpriteList(is_static=True)
-        self.player_list = arcade.SpriteList(is_static=True)
-        self.block_list = arcade.SpriteList(is_static=True)
-
-        self.score = 0
-        self.fall_counter = 0
-        self.level = 0
-        self.delete_counter = 0
-        self.x = 4
-        self.y = PLHEIGHT-1
-        self.shape = random.randint(0, 6)
-        self.shape_cnt = 0
-        self.fall_flag = False
-        self.generate_tetris = True
-        self.delete_animation = False
-        self.delete_animation_counter = 0
-        self.delete_animation_index = 0
-        self.delete_animation_lines = []
-        self.player_moved = True  # player_list is updated only when it's True
-        self.block_changed = True  # block_list is updated only when it's True
-        self.up_pressed = False
-        self.down_pressed = False
-        self.right_pressed = False
-        self.left_pressed = False
-        self.damage_lines = 0  # Num of lines to be added by the other player
-
-        # Wall/frame surrounding the game area
-        for x in range(-1, PLWIDTH+1):
-            wall = self.display_block(GRAY, x, -1)
-            self.wall_list.append(wall)
-            wall = self.display_block(GRAY, x, PLHEIGHT)
-            self.wall_list.append(wall)
-        for y in range(0, PLHEIGHT):
-            wall = self.display_block(GRAY, -1, y)
-            self.wall_list.append(wall)
-            wall = self.display_block(GRAY, PLWIDTH, y)
-            self.wall_list.append(wall)
-
-        # Initialize game area
-        # 0: no block, color: block of color is there
-        self.game_area = []
+        # Sprites are added to the block_list of GameView, once here, and
+        # updated in place by update_sprites()
+        block_list = self.game_view.block_list
+        self.block_size = 32 * self.scale
+        self.player_moved = True  # shape_blocks are updated only when True
+        self.block_changed = True  # block_grid is updated only when True
+        self.inputs = []  # engine.UP/DOWN/LEFT/RIGHT/... for the next step
+        # Key presses/releases with time, played in the step they fall in
+        self.input_queue = engine.InputQueue(self.game_view.window.das,
+                                             self.game_view.window.arr)
+        self.game.subscribe(self.on_game_event)
+
+        # Wall/frame surrounding the game area (never changes), one sprite
+        # of the baked frame texture
+        frame = arcade.Sprite(scale=self.scale)
+        frame.texture = self.game_view.window.assets.frame_texture()
+        frame.center_x = self.left_edge + self.block_size * (PLWIDTH-1) / 2
+        frame.center_y = self.bottom_edge + \
+            self.block_size * (PLHEIGHT-1) / 2
+        block_list.append(frame)
+
+        # Four blocks of the placement hint (1-player mode, H key)
+        self.hint_blocks = []
+        for i in range(4):
+            block = self.display_block(GRAY, 0, 0)
+            block.alpha = 0
+            self.hint_blocks.append(block)
+            block_list.append(block)
+
+        # Four blocks of the ghost piece (where the falling shape lands)
+        self.ghost_blocks = []
+        for i in range(4):
+            block = self.display_block(GRAY, 0, 0)
+            block.alpha = 0
+            self.ghost_blocks.append(block)
+            block_list.append(block)
+
+        # Four blocks of the falling shape
+        self.shape_blocks = []
+        for i in range(4):
+            block = self.display_block(GRAY, 0, 0)
+            block.alpha = 0
+            self.shape_blocks.append(block)
+            block_list.append(block)
+
+        # One block per game area cell, invisible while the cell is empty
+        # block_grid[y][x] is the sprite, block_shown[y][x] what it shows
+        self.block_grid = []
+        self.block_shown = []
         for y in range(0, PLHEIGHT):
-            area_line = []
+            grid_line = []
             for x in range(0, PLWIDTH):
-                area_line.append(0)
-            self.game_area.append(area_line)
+                block = self.display_block(GRAY, x, y)
+                block.alpha = 0
+                grid_line.append(block)
+                block_list.append(block)
+            self.block_grid.append(grid_line)
+            self.block_shown.append([None] * PLWIDTH)
+
+    def show_hint(self, target):
+        """Show where the shape lands at target (shape_cnt, x), or hide
+        the hint (None)"""
+        game = self.game
+        y = None
+        if target is not None:
+            y = game.board.landing(game.shape, target[0], target[1], game.y)
+        if y is None:
+            for block in self.hint_blocks:
+                block.alpha = 0
+            return
+        self.place_blocks(self.hint_blocks, target[0], target[1], y,
+                          HINT_ALPHA)
+
+    def place_blocks(self, blocks, shape_cnt, x, y, alpha):
+        """Show four blocks as the falling shape rotated shape_cnt times
+        at x, y"""
+        shape = self.game.shape
+        texture = self.game_view.block_textures[TETRIS_SHAPES[shape][0]][0]
+        for block, pos in zip(blocks, TETRIS_SHAPES[shape][1][shape_cnt]):
+            block.texture = texture
+            block.center_x = int(self.left_edge + self.block_size
+                                 * (x + pos % 4))
+            block.center_y = int(self.bottom_edge + self.block_size
+                                 * (y - pos // 4))
+            block.alpha = alpha
+
+    def on_game_event(self, game, event, data):
+        """Mark sprite lists to be updated"""
+        if event in (engine.SPAWN, engine.MOVE, engine.GAME_OVER):
+            self.player_moved = True
+        elif event == engine.BOARD:
+            self.block_changed = True
 
     def display_block(self, color, x, y):
         # Create a block sprite with the specified color and
         # position (in num of blocks) within game area window,
         # and return the sprite
-        if self.delete_animation is True and y in self.delete_animation_lines:
-            block = arcade.Sprite(self.game_view.block_images[color],
-                                  SPRITE_SCALING,
-                                  32*self.delete_animation_index, 0, 32, 32)
-        else:
-            block = arcade.Sprite(self.game_view.block_images[color],
-                                  SPRITE_SCALING, 0, 0, 32, 32)
-            block.alpha = 255
-        block.center_x = int(self.left_edge + 32*SPRITE_SCALING*x)
-        block.center_y = int(self.bottom_edge + 32*SPRITE_SCALING*y)
+        block = arcade.Sprite(scale=self.scale)
+        block.texture = self.game_view.block_textures[color][0]
+        block.center_x = int(self.left_edge + self.block_size*x)
+        block.center_y = int(self.bottom_edge + self.block_size*y)
         return block
 
-    def can_move(self):
-        """Check if shape can be located in current x, y, rotation count"""
-        for pos in self.game_view.tetris_shapes[self.shape][1][self.shape_cnt]:
-            x = int(self.x + pos % 4)
-            y = int(self.y - pos // 4)
-            if x < 0 or x >= PLWIDTH:
-                return False
-            if y < 0:
-                return False
-            if self.game_area[y][x] != 0:
-                return False
-        return True
-
-    def animation(self):
-        """Delete animation"""
-        # Animate to-be-deleted lines before actually delete them
-        if self.delete_animation_counter <= 0:
-            self.block_changed = True
-            self.delete_animation_counter = 0.1  # 0.1 sec/frame
-            self.delete_animation_index += 1
-            if self.delete_animation_index > 7:
-                # Animation done
-                self.delete_animation = False
-                self.generate_tetris = True
-                self.delete_animation_index = 0
-                self.delete_counter += len(self.delete_animation_lines)
-                # delete 4 lines -> level up
-                if self.delete_counter >= 4:
-                    self.delete_counter = 0
-                    if self.level < len(self.game_view.fall_counter_init):
-                        self.level += 1
-                        arcade.play_sound(self.game_view.levelup_sound)
-                self.score += 10 * (2**(len(self.delete_animation_lines)-1))
-                # Attack the other player
-                if self.game_view.window.game_mode == 1:
-                    for player in self.game_view.players:
-                        if self != player:
-                            player.damage_lines = \
-                                len(self.delete_animation_lines) - 1
-
-                # Delete lines and append new lines
-                for y in self.delete_animation_lines:
-                    del self.game_area[y]
-                    area_line = []
-                    for x in range(0, PLWIDTH):
-                        area_line.append(0)
-                    self.game_area.append(area_line)
-                self.delete_animation_lines = []
-                arcade.play_sound(self.game_view.delete_sound)
-
-    def shape_move(self):
-        """Move player shape based on key input"""
-        if self.up_pressed:
-            self.player_moved = True
-            prev_cnt = self.shape_cnt
-            self.shape_cnt += 1
-            if self.shape_cnt >= \
-               len(self.game_view.tetris_shapes[self.shape][1]):
-                self.shape_cnt = 0
-            if not self.can_move():
-                self.shape_cnt = prev_cnt
-            self.up_pressed = False
-        if self.left_pressed:
-            self.player_moved = True
-            prev_x = self.x
-            self.x -= 1
-            if not self.can_move():
-                self.x = prev_x
-            self.left_pressed = False
-        if self.right_pressed:
-            self.player_moved = True
-            prev_x = self.x
-            self.x += 1
-            if not self.can_move():
-                self.x = prev_x
-            self.right_pressed = False
-        if self.down_pressed:
-            self.player_moved = True
-            self.fall_flag = True
-            self.down_pressed = False
-
-    def shape_fall(self):
-        """Drop player shape one line or reach the bottom"""
-        if self.fall_counter <= 0 or self.fall_flag is True:
-            self.fall_counter = self.game_view.fall_counter_init[self.level]
-            self.player_moved = True
-            if self.generate_tetris is True:
-                # Generate new shape at top of game area
-                self.shape = random.randint(0, 6)
-                self.shape_cnt = 0
-                self.x = PLWIDTH/2 - 2
-                self.y = PLHEIGHT - 1
-                self.fall_flag = False
-                self.generate_tetris = False
-                # Gameover check
-                if not self.can_move():
-                    self.game_over = True
-                    self.gameover_counter = 0
-                    self.player_moved = True
-                    arcade.play_sound(self.game_view.gameover_sound)
+    def update_sprites(self):
+        """Update falling shape and game area sprites that changed"""
+        game = self.game
+        block_textures = self.game_view.block_textures
+
+        # Update ghost_blocks
+        # The landing y comes from the column heights of the board (a few
+        # operations), so it's looked up whenever the shape or board
+        # changed
+        if self.ghost and (self.player_moved or self.block_changed):
+            y = None
+            if not game.game_over and not game.delete_animation and \
+               not game.generate_tetris:
+                y = game.landing_y()
+            if y is None or y == game.y:
+                for block in self.ghost_blocks:
+                    block.alpha = 0
             else:
-                # Fall one line
-                prev_y = self.y
-                self.y -= 1
-                self.score += 2
-                if not self.can_move():
-                    # Stuck at bottom and can't move anymore
-                    arcade.play_sound(self.game_view.bottom_sound)
-                    self.y = prev_y
-                    color = self.game_view.tetris_shapes[self.shape][0]
-                    for pos in (self.game_view.tetris_shapes
-                                [self.shape][1][self.shape_cnt]):
-                        x = int(self.x + pos % 4)
-                        y = int(self.y - pos // 4)
-                        self.game_area[y][x] = color
-
-                    # Delete line check (and delete)
-                    for y in range(0, PLHEIGHT):
-                        if 0 not in self.game_area[PLHEIGHT-y-1]:
-                            # Start delete animation
-                            self.delete_animation = True
-                            self.delete_animation_counter = 0.1  # 0.1 sec
-                            self.delete_animation_index = 1
-                            self.delete_animation_lines.append(PLHEIGHT-y-1)
-                    if self.delete_animation is False:
-                        # No delete line
-                        self.generate_tetris = True
-
-    def player_attacked(self):
-        """The other player deleted two or more lines and incurred
-        additional lines to me"""
-        for i in range(self.damage_lines):
-            del self.game_area[PLHEIGHT-1]
-            area_line = []
-            for x in range(PLWIDTH):
-                if random.randint(0, 99) < 50:  # 50%
-                    area_line.append(0)
+                self.place_blocks(self.ghost_blocks, game.shape_cnt, game.x,
+                                  y, GHOST_ALPHA)
+
+        # Update shape_blocks
+        # Only when player tetris moves, rotates or is generated
+        if self.player_moved:
+            self.player_moved = False
+            if game.game_over:
+                for block in self.shape_blocks:
+                    block.alpha = 0
+            else:
+                self.place_blocks(self.shape_blocks, game.shape_cnt, game.x,
+                                  game.y, 255)
+
+        # Update block_grid
+        # Only when in animation, added or deleted, and only changed cells
+        if self.block_changed:
+            self.block_changed = False
+            for y in range(0, PLHEIGHT):
+                if game.delete_animation is True and \
+                   y in game.delete_animation_lines:
+                    frame = game.delete_animation_index
                 else:
-                    area_line.append(GRAY)
-            self.game_area.insert(0, area_line)
-        if self.damage_lines != 0:
-            arcade.play_sound(self.game_view.attacked_sound)
-            self.damage_lines = 0
-
-    def player_game_over(self):
-        """Change block color to GRAY from bottom to top"""
-        if self.gameover_counter == 0:
-            # Move player sprites to block_list
-            # Without this, player sprites doesn't turn to GRAY
-            for sprite in self.player_list:
-                self.block_list.append(sprite)
-            self.player_list = arcade.SpriteList()
-        elif self.gameover_counter >= PLHEIGHT:
-            return
-
-        for x in range(PLWIDTH):
-            if self.game_area[self.gameover_counter][x] != 0:
-                self.game_area[self.gameover_counter][x] = GRAY
-        self.gameover_counter += 1
-        self.block_changed = True
-
+                    frame = 0
+                area_line = game.game_area[y]
+                shown_line = self.block_shown[y]
+                for x in range(0, PLWIDTH):
+                    color = area_line[x]
+                    # color and frame as one small int (no new object)
+                    shown = color << 4 | frame if color != 0 else None
+                    if shown_line[x] == shown:
+                        continue
+                    shown_line[x] = shown
+                    block = self.block_grid[y][x]
+                    if shown is None:
+                        block.alpha = 0
+                    else:
+                        block.texture = block_textures[color][frame]
+                        block.alpha = 255
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    status = headless_main(argv)
+    if status is not None:
+        return status
+
+    parser = argparse.ArgumentParser(
+        description="Zen Tetris",
+        epilog="Run \"tet.py tournament -h\" for headless CPU tournaments.")
+    parser.add_argument("--debug", action="store_true",
+                        help="show performance info (toggle with F1)")
+    parser.add_argument("--telemetry", metavar="PREFIX",
+                        help="save frame times to PREFIX.json/.csv and GC "
+                        "pauses to PREFIX-gc.csv on exit")
+    parser.add_argument("--trace-alloc", nargs="?", type=int, const=1,
+                        metavar="FRAMES",
+                        help="count allocations by call site (tracemalloc, "
+                        "slow) every FRAMES frames (default: 1), shown by "
+                        "F1 and saved with the telemetry")
+    parser.add_argument("--idle-fps", type=float, default=IDLE_FPS,
+                        metavar="FPS",
+                        help="frame rate when only the background moves, "
+                        f"e.g. title and game over (default: {IDLE_FPS})")
+    parser.add_argument("--practice", action="store_true",
+                        help="1-player games keep the last "
+                        f"{UNDO_PLACEMENTS} placements, undo with Z (not "
+                        "recorded)")
+    parser.add_argument("--new", action="store_true",
+                        help="don't resume the game left running last time")
+    parser.add_argument("--no-ghost", action="store_true",
+                        help="don't show where the falling shape lands")
+    parser.add_argument("--hint", action="store_true",
+                        help="show the best placement of the falling shape "
+                        "in 1-player games (toggle with H)")
+    parser.add_argument("--max-voices", type=int, default=audio.MAX_VOICES,
+                        metavar="N",
+                        help="sound effects playing at the same time "
+                        f"(default: {audio.MAX_VOICES})")
+    parser.add_argument("--mute", action="store_true",
+                        help="no sound effects")
+    parser.add_argument("--gc", choices=["defer", "auto"], default="defer",
+                        help="defer: freeze objects of a game and collect "
+                        "garbage on spawn and pause, auto: let Python "
+                        "collect any time (default: defer)")
+    parser.add_argument("--seed", type=int,
+                        help="random seed of games (default: random)")
+    parser.add_argument("--record", metavar="PREFIX",
+                        help="save inputs of each game to PREFIX-*"
+                        f"{replay.BINARY_EXTENSION}")
+    parser.add_argument("--cpu-level", choices=list(bot.LEVELS),
+                        default="normal",
+                        help="CPU opponent difficulty (default: normal)")
+    parser.add_argument("--players", type=int, default=2,
+                        choices=range(2, MAX_PLAYERS+1), metavar="N",
+                        help="boards in battles (T, C), players three and "
+                        f"up are CPUs (2-{MAX_PLAYERS}, default: 2)")
+    parser.add_argument("--targeting", choices=list(engine.TARGETING),
+                        default="all",
+                        help="who gets the lines of an attack in battles "
+                        "(default: all)")
+    parser.add_argument("--das", type=float, default=engine.DAS,
+                        metavar="SEC",
+                        help="delay before a held left/right key repeats "
+                        f"(default: {engine.DAS:.3f})")
+    parser.add_argument("--arr", type=float, default=engine.ARR,
+                        metavar="SEC",
+                        help="sec between repeats of a held key, 0: move "
+                        f"to the wall (default: {engine.ARR:.3f})")
+    parser.add_argument("--host", nargs="?", type=int, metavar="PORT",
+                        const=netplay.DEFAULT_PORT,
+                        help="host network battles on PORT (default: "
+                        f"{netplay.DEFAULT_PORT})")
+    parser.add_argument("--join", metavar="HOST[:PORT]",
+                        help="join a network battle hosted on HOST")
+    parser.add_argument("--input-delay", type=int,
+                        default=netplay.DEFAULT_DELAY, metavar="TICKS",
+                        help="network battle input delay in 1/60 sec "
+                        f"(default: {netplay.DEFAULT_DELAY}, set by host)")
+    parser.add_argument("--broadcast", nargs="?", type=int, metavar="PORT",
+                        const=spectate.DEFAULT_PORT,
+                        help="broadcast games to spectators on TCP PORT "
+                        f"(default: {spectate.DEFAULT_PORT})")
+    parser.add_argument("--watch", metavar="HOST[:PORT]",
+                        help="watch games broadcast by HOST")
+    parser.add_argument("--startup", action="store_true",
+                        help="print the time to the first frame and quit")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="delete the background cache first (cold "
+                        "start)")
+    parser.add_argument("--replay", nargs="+", metavar="FILE",
+                        help="replay recorded games headless, check results")
+    parser.add_argument("--view", metavar="FILE",
+                        help="watch a recorded game (binary replay), seek "
+                        "with the arrow keys")
+    args = parser.parse_args(argv)
+    if args.record:
+        args.record = caller_path(args.record)
+    if args.view:
+        args.view = caller_path(args.view)
+    if args.telemetry:
+        args.telemetry = caller_path(args.telemetry)
+
+    if args.clear_cache:
+        for file_name in [TITLE_IMAGE] + BACKGROUND_IMAGES:
+            if os.path.exists(background_cache_file(file_name)):
+                os.remove(background_cache_file(file_name))
+    cache = "warm"
+    for file_name in [TITLE_IMAGE] + BACKGROUND_IMAGES:
+        if not background_cached(file_name):
+            cache = "cold"
+    # Decode backgrounds while the window opens and the title is shown
+    assets = Assets()
+    assets.prefetch([TITLE_IMAGE] + BACKGROUND_IMAGES)
 
-def main():
     window = arcade.Window(WIDTH, HEIGHT, "Tetris")
     window.high_score = 0
     window.game_over = False
     window.game_mode = 0  # game mode dummy number
-    window.debug = False  # Show performamce info
+    window.debug = args.debug  # Show performamce info
+    window.telemetry = FrameTelemetry()
+    window.pacer = FramePacer(window, args.idle_fps)
+    window.mixer = audio.Mixer(
+        audio.NullBackend() if args.mute else audio.ArcadeBackend(),
+        args.max_voices)
+    window.gc_monitor = GcMonitor(window.telemetry)  # log of GC pauses
+    window.gc_monitor.start()
+    window.gc_policy = GcPolicy(args.gc == "defer")
+    window.alloc_tracker = None
+    if args.trace_alloc:
+        window.alloc_tracker = AllocationTracker(args.trace_alloc)
+        window.alloc_tracker.start()
+    window.seed = args.seed
+    window.vs_cpu = False  # True: players two and up are played by CPU
+    window.hint = args.hint  # placement hint in 1-player games
+    window.ghost = not args.no_ghost  # ghost piece of human players
+    window.practice = args.practice  # undo placements in 1-player games
+    window.bot_level = args.cpu_level
+    window.num_players = args.players  # boards in battles
+    window.targeting = args.targeting
+    window.das = args.das  # key auto-repeat (see engine.InputQueue)
+    window.arr = args.arr
+    window.record = args.record
+    window.net = None  # network battle settings
+    if args.host is not None:
+        window.net = {"host": None, "port": args.host,
+                      "delay": args.input_delay}
+    elif args.join:
+        host, port = netplay.parse_address(args.join)
+        window.net = {"host": host, "port": port, "delay": args.input_delay}
+    window.broadcast = None  # spectate.BroadcastServer
+    if args.broadcast is not None:
+        window.broadcast = spectate.BroadcastServer(args.broadcast)
+        window.broadcast.start()
+    window.watch = None  # (host, port) to watch games from
+    if args.watch:
+        window.watch = netplay.parse_address(args.watch,
+                                             spectate.DEFAULT_PORT)
+    window.assets = assets
+    window.startup = cache if args.startup else None  # --startup report
+    window.first_frame_time = None  # sec from start to the first frame
     width, height = window.get_size()
     window.set_viewport(0, width, 0, height)
-    title_view = TitleView()
-    title_view.window = window
-    window.show_view(title_view)
+    resumed = None
+    if args.new:
+        if os.path.exists(SUSPEND_FILE):
+            os.remove(SUSPEND_FILE)
+    elif not args.view and not args.startup:
+        resumed = load_suspended(window)
+    if args.view:
+        game_view = GameView()
+        game_view.window = window
+        game_view.replay_file = replay.ReplayFile(args.view)
+        window.game_mode = 0 if game_view.replay_file.players == 1 else 1
+        game_view.setup()
+        window.show_view(game_view)
+    elif resumed is not None:
+        window.show_view(resumed)
+    else:
+        title_view = TitleView()
+        title_view.window = window
+        window.show_view(title_view)
     arcade.run()
+    if isinstance(window.current_view, PauseView):
+        window.current_view.game_view.suspend()
+    if isinstance(window.current_view, GameView):
+        window.current_view.suspend()
+        window.current_view.save_recording()
+        if window.current_view.session is not None:
+            window.current_view.session.close()
+        if window.current_view.spectator is not None:
+            window.current_view.spectator.close()
+        if window.current_view.replay_file is not None:
+            window.current_view.replay_file.close()
+    if window.broadcast is not None:
+        window.broadcast.close()
+    window.mixer.close()
+    window.gc_policy.stop()
+    if args.telemetry:
+        dump_telemetry(window, args.telemetry)
+    return 0
 
 
 file_path = os.path.dirname(os.path.abspath(__file__))
 os.chdir(file_path)
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
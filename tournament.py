@@ -0,0 +1,208 @@
+# Zen Tetris tournament - play many headless CPU games in parallel
+# Run as "python tet.py tournament ..." or "python tournament.py ...";
+# neither opens a window.
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import engine
+import bot
+import replay
+
+DT = 1/60  # sec per tick, same as the game window
+
+
+def play_game(config):
+    """Play one headless game of bots and return per-player stats
+
+    config: {"seed", "bots": [{"level", "weights"}, ...], "max_pieces",
+    "targeting", "replays"}; if replays is a folder, the game is saved
+    there as a binary replay."""
+    bots_config = config["bots"]
+    match = engine.Match(len(bots_config), seed=config["seed"],
+                         targeting=config.get("targeting", "all"))
+    bots = []
+    stats = []
+    for game, bot_config in zip(match.games, bots_config):
+        bots.append(bot.BotController(
+            game, bot_config["level"],
+            bot_config.get("weights", bot.WEIGHTS), worker=None,
+            limit="nodes"))
+        stats.append({"score": 0, "lines": 0, "level": 0, "pieces": 0,
+                      "garbage_sent": 0, "garbage_received": 0,
+                      "game_over": False})
+
+    def count(game, event, data):
+        player_stats = stats[match.games.index(game)]
+        if event == engine.LINE_CLEAR:
+            player_stats["lines"] += len(data)
+        elif event == engine.ATTACK and len(match.games) > 1:
+            player_stats["garbage_sent"] += data
+        elif event == engine.ATTACKED:
+            player_stats["garbage_received"] += data
+
+    for game in match.games:
+        game.subscribe(count)
+
+    recorder = None
+    if config.get("replays"):
+        recorder = replay.Recorder(match)
+    ticks = 0
+    max_pieces = config["max_pieces"]
+    while not match.over:
+        if max(player_bot.pieces for player_bot in bots) > max_pieces:
+            break
+        inputs = [player_bot.inputs(DT) for player_bot in bots]
+        if recorder is not None:
+            recorder.record(inputs, DT)
+        match.step(inputs, DT)
+        ticks += 1
+    if recorder is not None:
+        recorder.save(os.path.join(
+            config["replays"],
+            f"game-{config['seed']}{replay.BINARY_EXTENSION}"))
+
+    for game, player_bot, player_stats in zip(match.games, bots, stats):
+        player_stats["score"] = game.score
+        player_stats["level"] = game.level
+        player_stats["pieces"] = min(player_bot.pieces, max_pieces)
+        player_stats["game_over"] = game.game_over
+    alive = [i for i, game in enumerate(match.games) if not game.game_over]
+    winner = None
+    if len(match.games) > 1 and len(alive) == 1:
+        winner = alive[0]
+    return {"seed": config["seed"], "ticks": ticks, "winner": winner,
+            "players": stats}
+
+
+def summarize(values):
+    if not values:
+        return {"mean": 0, "min": 0, "max": 0}
+    return {"mean": sum(values) / len(values), "min": min(values),
+            "max": max(values)}
+
+
+def report(results, bots_config, elapsed, workers, targeting="all"):
+    """Aggregate game results into a report"""
+    players = []
+    for i, bot_config in enumerate(bots_config):
+        player = {"bot": bot_config}
+        for key in ("score", "lines", "level", "pieces", "garbage_sent",
+                    "garbage_received"):
+            player[key] = summarize([result["players"][i][key]
+                                     for result in results])
+        player["game_over_rate"] = sum(
+            result["players"][i]["game_over"] for result in results) / \
+            max(len(results), 1)
+        if len(bots_config) > 1:
+            player["wins"] = sum(result["winner"] == i for result in results)
+        players.append(player)
+    pieces = sum(player["pieces"] for result in results
+                 for player in result["players"])
+    return {
+        "games": len(results),
+        "workers": workers,
+        "targeting": targeting,
+        "elapsed": elapsed,
+        "games_per_sec": len(results) / max(elapsed, 1e-9),
+        "pieces_per_sec": pieces / max(elapsed, 1e-9),
+        "players": players,
+        }
+
+
+def run(bots_config, games, seed=0, max_pieces=500, workers=None,
+        targeting="all", replays=None):
+    """Play games with seeds seed, seed+1, ... and return the report
+
+    Each player of a battle plays with its own seed (see engine.Match),
+    so seeds should be apart by the num of players or more to avoid
+    replaying the same shapes; that's done here."""
+    workers = workers or os.cpu_count() or 1
+    configs = [{"seed": seed + i * len(bots_config), "bots": bots_config,
+                "max_pieces": max_pieces, "targeting": targeting,
+                "replays": replays}
+               for i in range(games)]
+    start_time = time.perf_counter()
+    if workers == 1:
+        results = [play_game(config) for config in configs]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            chunksize = max(1, games // (workers * 8))
+            results = list(pool.imap_unordered(play_game, configs,
+                                               chunksize))
+    elapsed = time.perf_counter() - start_time
+    results.sort(key=lambda result: result["seed"])
+    return report(results, bots_config, elapsed, workers, targeting), \
+        results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tet.py tournament",
+        description="Play headless Zen Tetris games of CPU players")
+    parser.add_argument("--games", type=int, default=100,
+                        help="num of games (default: 100)")
+    parser.add_argument("--bot", action="append", choices=list(bot.LEVELS),
+                        help="level of a CPU player; give one per player "
+                        "for battle games (default: one hard player)")
+    parser.add_argument("--weights", metavar="FILE",
+                        help="JSON file with heuristic weights, a dict "
+                        "for all players or a list with one per player")
+    parser.add_argument("--targeting", choices=list(engine.TARGETING),
+                        default="all",
+                        help="who gets the lines of an attack in battle "
+                        "games (default: all)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first game (default: 0)")
+    parser.add_argument("--max-pieces", type=int, default=500,
+                        help="stop a game after this many shapes per "
+                        "player (default: 500)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--report", metavar="FILE",
+                        help="save the JSON report to FILE (default: print)")
+    parser.add_argument("--games-out", metavar="FILE",
+                        help="also save the result of every game")
+    parser.add_argument("--replays", metavar="DIR",
+                        help="save every game to DIR/game-SEED"
+                        f"{replay.BINARY_EXTENSION}")
+    args = parser.parse_args(argv)
+
+    levels = args.bot or ["hard"]
+    weights = [bot.WEIGHTS] * len(levels)
+    if args.weights:
+        with open(args.weights) as f:
+            loaded = json.load(f)
+        if isinstance(loaded, dict):
+            loaded = [loaded] * len(levels)
+        if len(loaded) != len(levels):
+            parser.error(f"--weights has {len(loaded)} entries for "
+                         f"{len(levels)} players")
+        weights = [dict(bot.WEIGHTS, **player_weights)
+                   for player_weights in loaded]
+    bots_config = [{"level": level, "weights": player_weights}
+                   for level, player_weights in zip(levels, weights)]
+
+    if args.replays:
+        os.makedirs(args.replays, exist_ok=True)
+    result, games = run(bots_config, args.games, args.seed, args.max_pieces,
+                        args.workers, args.targeting, args.replays)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"{result['games']} games in {result['elapsed']:.1f} sec "
+              f"({result['games_per_sec']:.1f} games/sec, "
+              f"{result['workers']} workers), report: {args.report}")
+    else:
+        print(json.dumps(result, indent=2))
+    if args.games_out:
+        with open(args.games_out, "w") as f:
+            json.dump(games, f)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())